@@ -0,0 +1,60 @@
+""" Measures how long `import flowthings` takes in a fresh interpreter, and
+which heavyweight modules it pulls in. Exits with a non-zero status when the
+median exceeds `--max-ms` or a deferred module is imported eagerly, so it can
+guard against regressions in CI:
+
+    python benchmarks/import_time.py --runs 20 --max-ms 150
+"""
+
+from __future__ import print_function
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+
+DEFERRED = ('requests', 'websocket', 'numpy', 'multiprocessing')
+
+SCRIPT = '''
+import sys, json, time
+start = time.time()
+import flowthings
+elapsed = time.time() - start
+print(json.dumps([elapsed * 1000, sorted(m for m in sys.modules if '.' not in m)]))
+'''
+
+
+def measure(runs):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    times = []
+    modules = set()
+    for _ in range(runs):
+        out = subprocess.check_output([sys.executable, '-c', SCRIPT], cwd=root)
+        ms, mods = json.loads(out.decode('utf-8'))
+        times.append(ms)
+        modules.update(mods)
+    return sorted(times), modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--max-ms', type=float, default=None)
+    args = parser.parse_args()
+
+    times, modules = measure(args.runs)
+    median = times[len(times) // 2]
+    eager = [m for m in DEFERRED if m in modules]
+
+    print('import flowthings: median %.1fms, min %.1fms, max %.1fms over %d runs' % (
+        median, times[0], times[-1], len(times)))
+    if eager:
+        print('eagerly imported: %s' % ', '.join(eager))
+
+    if eager or (args.max_ms is not None and median > args.max_ms):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
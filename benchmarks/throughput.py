@@ -0,0 +1,233 @@
+""" Measures client throughput and latency against the in-process fake
+platform (`flowthings.testing.FakeServer`), so performance changes can be
+validated offline. Each scenario reports requests/sec, p50/p99 latency and
+peak memory allocated by the client:
+
+    python benchmarks/throughput.py --requests 2000 --latency-ms 1
+    python benchmarks/throughput.py --async-lib eventlet --scenarios async,lazy
+    python benchmarks/throughput.py --scenarios sync --tail-ms 200 --hedge
+
+Scenarios: `sync` reads one resource per request, `async` and `lazy` run the
+same reads through `api.async()` / `api.lazy()` (these need eventlet), `bulk`
+reads `--batch` resources per MGET, and `ws` pipelines reads over a
+WebSocket session.
+"""
+
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+SCENARIOS = ('sync', 'async', 'lazy', 'bulk', 'ws')
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+class Measurement(object):
+    """ Collects per-operation latencies, and the peak memory allocated while
+    running (with tracemalloc when available). """
+
+    def __init__(self, name, memory=True):
+        self.name = name
+        self.memory = memory
+        self.latencies = []
+        self.ops = 0
+        self.peak = None
+
+    def __enter__(self):
+        try:
+            import tracemalloc
+        except ImportError:
+            tracemalloc = None
+        if not self.memory:
+            tracemalloc = None
+        self._tracemalloc = tracemalloc
+        if tracemalloc:
+            tracemalloc.start()
+        self._start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.time() - self._start
+        if self._tracemalloc:
+            self.peak = self._tracemalloc.get_traced_memory()[1]
+            self._tracemalloc.stop()
+
+    def timed(self, fn, *args, **kwargs):
+        start = time.time()
+        res = fn(*args, **kwargs)
+        self.latencies.append(time.time() - start)
+        return res
+
+    def report(self):
+        return {
+            'scenario': self.name,
+            'ops': self.ops,
+            'rps': self.ops / self.elapsed if self.elapsed else 0.0,
+            'p50_ms': percentile(self.latencies, 0.50) * 1000,
+            'p99_ms': percentile(self.latencies, 0.99) * 1000,
+            'peak_kib': self.peak / 1024.0 if self.peak is not None else None,
+        }
+
+
+def run_sync(api, flow_id, ids, args):
+    service = api.drop(flow_id)
+    with Measurement('sync', args.memory) as m:
+        for id in ids:
+            m.timed(service.read, id)
+            m.ops += 1
+    return m
+
+
+def run_async(api, flow_id, ids, args):
+    with Measurement('async', args.memory) as m:
+        for i in range(0, len(ids), args.concurrency):
+            chunk = ids[i:i + args.concurrency]
+            proxy = api.async()
+            service = proxy.drop(flow_id)
+            start = time.time()
+            for id in chunk:
+                service.read(id)
+            proxy.results()
+            m.latencies.extend([time.time() - start] * len(chunk))
+            m.ops += len(chunk)
+    return m
+
+
+def run_lazy(api, flow_id, ids, args):
+    with Measurement('lazy', args.memory) as m:
+        for i in range(0, len(ids), args.concurrency):
+            chunk = ids[i:i + args.concurrency]
+            service = api.lazy().drop(flow_id)
+            start = time.time()
+            thunks = [service.read(id) for id in chunk]
+            for thunk in thunks:
+                thunk.force()
+            m.latencies.extend([time.time() - start] * len(chunk))
+            m.ops += len(chunk)
+    return m
+
+
+def run_bulk(api, flow_id, ids, args):
+    service = api.drop(flow_id)
+    with Measurement('bulk', args.memory) as m:
+        for i in range(0, len(ids), args.batch):
+            chunk = ids[i:i + args.batch]
+            m.timed(service.read_many, chunk)
+            m.ops += len(chunk)
+    return m
+
+
+def run_ws(api, flow_id, ids, args):
+    done = threading.Event()
+    sent = {}
+    m = Measurement('ws', args.memory)
+
+    def on_reply(ws, n):
+        m.latencies.append(time.time() - sent.pop(n))
+        m.ops += 1
+        if m.ops == len(ids):
+            done.set()
+            ws._app.close()
+
+    def on_open(ws):
+        # Ids repeat when there are more requests than drops, so sends are
+        # keyed by their position instead.
+        for n, id in enumerate(ids):
+            sent[n] = time.time()
+            ws.send({ 'object': 'drop', 'type': 'find', 'flowId': flow_id, 'id': id },
+                    lambda ws, body, n=n: on_reply(ws, n))
+
+    client = api.websocket.connect(on_open=on_open)
+    with m:
+        thread = threading.Thread(target=client.run)
+        thread.daemon = True
+        thread.start()
+        done.wait(60)
+    return m
+
+
+RUNNERS = {
+    'sync': run_sync,
+    'async': run_async,
+    'lazy': run_lazy,
+    'bulk': run_bulk,
+    'ws': run_ws,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--batch', type=int, default=100)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--tail-ms', type=float, default=0,
+                        help='extra latency for a --tail-rate fraction of requests')
+    parser.add_argument('--tail-rate', type=float, default=0.02)
+    parser.add_argument('--hedge', action='store_true', help='hedge reads with Hedging()')
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--async-lib', choices=('eventlet',), default=None)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+                        help='skip memory tracing, which slows requests down')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    async_lib = None
+    if args.async_lib == 'eventlet':
+        import eventlet
+        eventlet.monkey_patch()
+        async_lib = eventlet
+
+    import random
+    from flowthings import Hedging
+    from flowthings.testing import FakeServer
+
+    tail = random.Random(0)
+    def latency(method, path):
+        if args.tail_ms and tail.random() < args.tail_rate:
+            return (args.latency_ms + args.tail_ms) / 1000.0
+        return args.latency_ms / 1000.0
+
+    server = FakeServer(latency=latency, error_rate=args.error_rate, seed=0).start()
+    try:
+        api = server.api(async_lib=async_lib, hedging=Hedging() if args.hedge else None)
+        flow = api.flow.create({ 'path': '/acc/benchmark' })
+        service = api.drop(flow['id'])
+        ids = [service.create({ 'elems': { 'n': i } })['id']
+               for i in range(min(args.requests, 1000))]
+        ids = (ids * (args.requests // len(ids) + 1))[:args.requests]
+
+        results = []
+        for name in args.scenarios.split(','):
+            if name in ('async', 'lazy') and async_lib is None:
+                print('%-6s skipped: needs --async-lib' % name, file=sys.stderr)
+                continue
+            results.append(RUNNERS[name](api, flow['id'], ids, args).report())
+    finally:
+        server.stop()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print('%-6s %8s %10s %9s %9s %10s' % ('', 'ops', 'req/s', 'p50 ms', 'p99 ms', 'peak KiB'))
+    for r in results:
+        peak = '%10.0f' % r['peak_kib'] if r['peak_kib'] is not None else '%10s' % '-'
+        print('%-6s %8d %10.0f %9.2f %9.2f %s' % (
+            r['scenario'], r['ops'], r['rps'], r['p50_ms'], r['p99_ms'], peak))
+
+
+if __name__ == '__main__':
+    main()
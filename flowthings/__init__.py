@@ -2,9 +2,12 @@ from .exceptions import *
 from .builders import *
 from .api import API
 from .default import defaults
+from .utils import Compression, ConditionalCache, Hedging
 
 __all__ = (
     'API',
+    'Compression',
+    'ConditionalCache',
     'Token',
     'FlowThingsBadRequest',
     'FlowThingsError',
@@ -12,8 +15,10 @@ __all__ = (
     'FlowThingsForbidden',
     'FlowThingsNotFound',
     'FlowThingsServerError',
+    'Hedging',
     'M',
     'P',
+    'Tracked',
     'mem',
     'AGE',
     'EXISTS',
@@ -0,0 +1,170 @@
+from __future__ import absolute_import
+from datetime import datetime
+from functools import partial
+
+import six
+
+from .builders import member_getter, MISSING, NUMBERS
+from .exceptions import FlowThingsError
+
+
+__all__ = ('LocalAggregation',)
+
+
+DATE_GROUPS = {
+    '$year'  : lambda d: d.year,
+    '$month' : lambda d: d.month,
+    '$day'   : lambda d: d.day,
+    '$hour'  : lambda d: d.hour,
+    '$minute': lambda d: d.minute,
+}
+
+OPERATIONS = ('$count', '$sum', '$min', '$max', '$avg')
+
+
+class LocalAggregation(object):
+    """ A client-side equivalent of the platform's `/aggregate` endpoint.
+    Drops are reduced page by page into mergeable partial aggregates
+    (count, sum, min, max, avg), optionally in a process pool, and merged
+    into rows of the same shape the platform returns: one dict per group
+    holding the `group_by` values and each output.
+
+    Output fields and group fields name a rule, or else an element of the
+    drop (`foo` is read from `elems.foo`; dotted paths are read from the drop
+    itself). Rules are filters evaluated per drop, counting as 1 or 0. """
+
+    def __init__(self, output, group_by=None, rules=None, sorts=None):
+        outputs = [output] if isinstance(output, six.string_types) else list(output)
+        for o in outputs:
+            if o.split(':', 1)[0] not in OPERATIONS:
+                raise FlowThingsError('Unsupported aggregate output: %s' % o)
+        self.outputs = outputs
+        self.group_by = list(group_by or [])
+        self.rules = dict(rules or {})
+        self.sorts = list(sorts or [])
+
+    def reduce(self, pages, processes=None):
+        """ Reduces an iterable of drop pages into the final rows. With
+        `processes` of 1 pages are reduced inline, otherwise in a process pool
+        (sized to the CPU count when `processes` is None). """
+
+        spec = (self.outputs, self.group_by, self.rules)
+        if processes == 1:
+            partials = (reduce_page(spec, page) for page in pages)
+            return self.finalize(merge_partials(self.outputs, partials))
+
+        import multiprocessing
+        pool = multiprocessing.Pool(processes)
+        try:
+            partials = pool.imap_unordered(partial(reduce_page, spec), pages)
+            merged = merge_partials(self.outputs, partials)
+        finally:
+            pool.close()
+            pool.join()
+        return self.finalize(merged)
+
+    def finalize(self, merged):
+        rows = []
+        for group, accs in six.iteritems(merged):
+            row = dict(zip(self.group_by, group))
+            for o, acc in zip(self.outputs, accs):
+                row[o] = finalize_acc(o.split(':', 1)[0], acc)
+            rows.append(row)
+
+        for key in reversed(self.sorts):
+            desc = key.startswith('-')
+            key = key.lstrip('-+')
+            rows.sort(key=lambda r: (r.get(key) is None, r.get(key)), reverse=desc)
+        return rows
+
+
+def field_getter(name, rules):
+    if name in rules:
+        predicate = rules[name].compile()
+        return lambda drop: 1 if predicate(drop) else 0
+    if name in DATE_GROUPS:
+        part = DATE_GROUPS[name]
+        get = member_getter('creationDate')
+        def get_date(drop):
+            ms = get(drop)
+            if not isinstance(ms, NUMBERS):
+                return None
+            return part(datetime.utcfromtimestamp(ms / 1000.0))
+        return get_date
+    get = member_getter(name if '.' in name else 'elems.' + name)
+    def get_field(drop):
+        val = get(drop)
+        return None if val is MISSING else val
+    return get_field
+
+
+def reduce_page(spec, page):
+    """ Reduces one page of drops into `{group: [acc, ...]}`. Runs in the
+    worker processes, so it only takes picklable arguments. """
+
+    outputs, group_by, rules = spec
+    groups = [field_getter(g, rules) for g in group_by]
+    ops = []
+    for o in outputs:
+        op, _, field = o.partition(':')
+        ops.append((op, field_getter(field, rules) if field else None))
+
+    partials = {}
+    for drop in page:
+        key = tuple(get(drop) for get in groups)
+        accs = partials.get(key)
+        if accs is None:
+            accs = partials[key] = [empty_acc(op) for op, _ in ops]
+        for i, (op, get) in enumerate(ops):
+            accs[i] = add_value(op, accs[i], get(drop) if get else None)
+    return partials
+
+
+def empty_acc(op):
+    if op == '$avg':
+        return (0, 0)
+    if op in ('$count', '$sum'):
+        return 0
+    return None
+
+
+def add_value(op, acc, val):
+    if op == '$count':
+        return acc + 1
+    if not isinstance(val, NUMBERS):
+        return acc
+    if op == '$sum':
+        return acc + val
+    if op == '$avg':
+        return (acc[0] + val, acc[1] + 1)
+    if acc is None:
+        return val
+    return min(acc, val) if op == '$min' else max(acc, val)
+
+
+def merge_acc(op, a, b):
+    if op in ('$count', '$sum'):
+        return a + b
+    if op == '$avg':
+        return (a[0] + b[0], a[1] + b[1])
+    if a is None or b is None:
+        return b if a is None else a
+    return min(a, b) if op == '$min' else max(a, b)
+
+
+def merge_partials(outputs, partials):
+    ops = [o.split(':', 1)[0] for o in outputs]
+    merged = {}
+    for part in partials:
+        for key, accs in six.iteritems(part):
+            if key in merged:
+                merged[key] = [merge_acc(op, a, b) for op, a, b in zip(ops, merged[key], accs)]
+            else:
+                merged[key] = accs
+    return merged
+
+
+def finalize_acc(op, acc):
+    if op == '$avg':
+        return float(acc[0]) / acc[1] if acc[1] else None
+    return acc
@@ -1,9 +1,15 @@
 from __future__ import absolute_import
-from collections import MutableMapping
+import os
+import threading
+from collections import MutableMapping, OrderedDict
+
+from functools import partial
 
 from . import services
 from .exceptions import FlowThingsException
+from .concurrency import PriorityLanes
 from .default import defaults
+from .utils import default, fork_aware
 
 
 __all__ = ('API',)
@@ -49,13 +55,19 @@ class API(RootRequestProxy):
     """ Creates a new API context with the given credentials. All requests
     made through the context will be called as the provided actor. """
 
+    view_cache_size = 256
+
     def __init__(self, creds, async_lib=DEFAULT, verify_ssl=True, *args, **kwargs):
         self._creds = creds
         self._verify_ssl = verify_ssl
         self._args = args
         self._kwargs = kwargs
         self._services = {}
-        self._create_services()
+        self._service_classes = dict(DEFAULT_SERVICES)
+        self._views = OrderedDict()
+        self._views_lock = threading.Lock()
+        self._priorities = {}
+        fork_aware(self)
 
         if async_lib is DEFAULT:
             self._async_lib = defaults.async_lib
@@ -65,17 +77,95 @@ class API(RootRequestProxy):
         if self._async_lib:
             self._async_map = ASYNC_LIBS[self._async_lib.__name__]
 
-    def _create_services(self):
-        for name, cls in DEFAULT_SERVICES.items():
-            self.add_service(name, cls)
+    def __getattr__(self, name):
+        """ Services are only instantiated the first time they are used. """
+
+        if name.startswith('_') or name not in self._service_classes:
+            raise AttributeError(name)
+        return self._create_service(name)
+
+    def _create_service(self, name):
+        cls = self._service_classes[name]
+        service = cls(self._creds, *self._args, verify_ssl=self._verify_ssl, **self._kwargs)
+        self._services[name] = service
+        setattr(self, name, service)
+        return service
 
     def add_service(self, name, cls):
         """ Add custom services that extend BaseService or
         AbstractServiceFactory. Given a name and a class, will instantiate the
         service with the API's options and add it to the API instance. """
 
-        self._services[name] = cls(self._creds, *self._args, verify_ssl=self._verify_ssl, **self._kwargs)
-        setattr(self, name, self._services[name])
+        self._service_classes[name] = cls
+        self._create_service(name)
+
+    def with_creds(self, creds):
+        """ Returns a view of the API that makes its requests with other
+        credentials. Views are cheap: they copy this API's services as they
+        are used, sharing their options, transport and connection pool, and
+        the `view_cache_size` most recently used views are reused. The API
+        itself is never changed, so views are safe to use concurrently. """
+
+        with self._views_lock:
+            view = self._views.pop(creds, None)
+            if view is None:
+                view = CredentialsView(self, creds)
+                if len(self._views) >= self.view_cache_size:
+                    self._views.popitem(last=False)
+            self._views[creds] = view
+        return view
+
+    def with_priority(self, priority):
+        """ Returns an API with the same options whose requests go through
+        the `priority` lane of its `PriorityLanes`, eg. `'batch'` for
+        background work. Its async and lazy proxies use that lane too. Raises
+        ValueError if `concurrency` isn't a `PriorityLanes` with that lane. """
+
+        lanes = default(self._kwargs.get('concurrency'), defaults.concurrency)
+        if not isinstance(lanes, PriorityLanes):
+            raise ValueError('with_priority requires concurrency to be PriorityLanes')
+        lanes.lane(priority)
+
+        with self._views_lock:
+            api = self._priorities.get(priority)
+            if api is None:
+                kwargs = dict(self._kwargs, priority=priority)
+                api = self._priorities[priority] = API(self._creds, self._async_lib,
+                                                       self._verify_ssl, *self._args, **kwargs)
+                api._service_classes.update(self._service_classes)
+        return api
+
+    def parallel_map(self, fn, items, processes=None, chunksize=1):
+        """ Calls `fn(api, item)` for every item in a pool of `processes`
+        worker processes (one per CPU by default), and returns the results in
+        order. Workers are forked with this API (whatever the default start
+        method), and each makes its requests over its own connection pool.
+        Raises NotImplementedError where processes can't be forked. `fn`,
+        the items and the results must be picklable, so `fn` should be a
+        module-level function:
+
+            >>> def summarize(api, flow_id):
+            ...     return len(api.drop(flow_id).find_many(limit=1000))
+            >>> api.parallel_map(summarize, flow_ids, processes=4)
+        """
+
+        import multiprocessing
+        # The API holds locks and connections, so it is inherited by forked
+        # workers rather than pickled for spawned ones.
+        if not hasattr(os, 'fork'):
+            raise NotImplementedError('parallel_map requires os.fork')
+        context = multiprocessing
+        if hasattr(multiprocessing, 'get_context'):
+            context = multiprocessing.get_context('fork')
+        pool = context.Pool(processes, _init_worker, (self,))
+        try:
+            return pool.map(partial(_call_in_worker, fn), items, chunksize)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _after_fork(self):
+        self._views_lock = threading.Lock()
 
     def async(self, pool=None):
         """ Returns an async API proxy. All API calls will be fired in
@@ -106,6 +196,67 @@ class API(RootRequestProxy):
         self._creds = creds
         for name, service in self._services.items():
             service.creds = creds
+        with self._views_lock:
+            self._views.clear()
+            for api in self._priorities.values():
+                api.creds = creds
+
+
+class CredentialsView(API):
+    """ An API bound to other credentials, built by `API.with_creds`. Its
+    services are copies of the parent's, made the first time they are used.
+    """
+
+    def __init__(self, api, creds):
+        self._parent = api
+        self._creds = creds
+        self._async_lib = api._async_lib
+        if self._async_lib:
+            self._async_map = api._async_map
+        self._service_classes = api._service_classes
+        self._services = {}
+
+    def _create_service(self, name):
+        service = getattr(self._parent, name).with_creds(self._creds)
+        self._services[name] = service
+        setattr(self, name, service)
+        return service
+
+    def add_service(self, name, cls):
+        self._parent.add_service(name, cls)
+        self._create_service(name)
+
+    def with_creds(self, creds):
+        return self._parent.with_creds(creds)
+
+    def with_priority(self, priority):
+        return self._parent.with_priority(priority).with_creds(self._creds)
+
+    @property
+    def creds(self):
+        return self._creds
+
+
+_worker_api = None
+
+
+def _init_worker(api):
+    global _worker_api
+    _worker_api = api
+
+
+def _call_in_worker(fn, item):
+    return fn(_worker_api, item)
+
+
+def proxy_class(service, service_proxy, factory_proxy, service_and_factory_proxy):
+    """ Picks the proxy class that matches the kind of service. """
+
+    if isinstance(service, services.AbstractServiceFactory):
+        if isinstance(service, services.BaseService):
+            return service_and_factory_proxy
+        return factory_proxy
+    return service_proxy
 
 
 class AsyncAPI(RootRequestProxy):
@@ -117,18 +268,18 @@ class AsyncAPI(RootRequestProxy):
         self._api = api
         self._pool = pool
         self._queue = []
-        self._proxy_services()
 
-    def _proxy_services(self):
-        for name, service in self._api._services.items():
-            if isinstance(service, services.AbstractServiceFactory):
-                if isinstance(service, services.BaseService):
-                    proxy_class = AsyncServiceAndFactoryProxy
-                else:
-                    proxy_class = AsyncServiceFactoryProxy
-            else:
-                proxy_class = AsyncServiceProxy
-            setattr(self, name, proxy_class(service, self._pool, self._queue))
+    def __getattr__(self, name):
+        # Only services are proxied; `creds`, `with_priority` and the like
+        # belong to the API itself.
+        if name.startswith('_') or name not in self._api._service_classes:
+            raise AttributeError(name)
+        service = getattr(self._api, name)
+        proxy = proxy_class(service, AsyncServiceProxy, AsyncServiceFactoryProxy,
+                            AsyncServiceAndFactoryProxy)
+        proxy = proxy(service, self._pool, self._queue)
+        setattr(self, name, proxy)
+        return proxy
 
     def results(self, with_exceptions=False):
         """ Blocks till all requests are completed, and returns a list of all
@@ -206,19 +357,16 @@ class LazyAPI(RootRequestProxy):
     def __init__(self, api, pool):
         self._api = api
         self._pool = pool
-        self._proxy_services()
 
-    def _proxy_services(self):
-        get_method = self._api._async_map['get']
-        for name, service in self._api._services.items():
-            if isinstance(service, services.AbstractServiceFactory):
-                if isinstance(service, services.BaseService):
-                    proxy_class = LazyServiceAndFactoryProxy
-                else:
-                    proxy_class = LazyServiceFactoryProxy
-            else:
-                proxy_class = LazyServiceProxy
-            setattr(self, name, proxy_class(service, self._pool, get_method))
+    def __getattr__(self, name):
+        if name.startswith('_') or name not in self._api._service_classes:
+            raise AttributeError(name)
+        service = getattr(self._api, name)
+        proxy = proxy_class(service, LazyServiceProxy, LazyServiceFactoryProxy,
+                            LazyServiceAndFactoryProxy)
+        proxy = proxy(service, self._pool, self._api._async_map['get'])
+        setattr(self, name, proxy)
+        return proxy
 
 
 class LazyServiceProxy(object):
@@ -0,0 +1,102 @@
+from __future__ import absolute_import
+import threading
+
+from .builders import frozen
+from .exceptions import FlowThingsNotFound
+from .utils import fork_aware, check_fork
+
+
+__all__ = ('BatchLoader',)
+
+
+class Batch(object):
+    def __init__(self):
+        self.ids = []
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.results = None
+        self.refs = None
+        self.error = None
+
+    def run(self, read_many, params):
+        ids = list(dict((id, None) for id in self.ids))
+        try:
+            results = read_many(ids, **params) if ids else {}
+            if isinstance(results, tuple):
+                results, self.refs = results
+            self.results = results
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done.set()
+
+
+class BatchLoader(object):
+    """ Coalesces single reads into MGET requests. The first caller waits up
+    to `window` seconds (or until `max_batch` ids are queued) for other
+    threads or greenlets to ask for ids with the same params, then sends one
+    `read_many` for all of them and hands each caller its own item. A window
+    of 0 only yields once, so with eventlet or gevent it batches the reads
+    spawned in the same tick. Ids missing from the response raise
+    `FlowThingsNotFound` for their callers only. With `refs=True`, each
+    caller gets its item and the batch's references.
+
+    While reads aren't contended (no other read is in progress, and the last
+    batch had a single id), a read is sent at once instead of waiting out the
+    window, so lone reads aren't slowed down. Until a batch has been sent,
+    reads are assumed to be contended. """
+
+    def __init__(self, service, window=0.002, max_batch=100):
+        self._service = service
+        self.window = window
+        self.max_batch = max_batch
+        self._lock = threading.Lock()
+        self._batches = {}
+        self._loading = 0
+        self._contended = True
+        fork_aware(self)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self._batches = {}
+        self._loading = 0
+
+    def load(self, id, **kwargs):
+        check_fork()
+        key = frozen(kwargs)
+        with self._lock:
+            self._loading += 1
+            batch = self._batches.get(key)
+            leader = batch is None
+            if leader:
+                batch = self._batches[key] = Batch()
+            batch.ids.append(id)
+            if len(batch.ids) >= self.max_batch:
+                del self._batches[key]
+                batch.full.set()
+            alone = self._loading == 1 and not self._contended
+
+        try:
+            if leader:
+                if not alone:
+                    batch.full.wait(self.window)
+                with self._lock:
+                    if self._batches.get(key) is batch:
+                        del self._batches[key]
+                    self._contended = len(batch.ids) > 1
+                batch.run(self._service.read_many, kwargs)
+            else:
+                batch.done.wait()
+        finally:
+            with self._lock:
+                self._loading -= 1
+
+        if batch.error is not None:
+            raise batch.error
+        try:
+            if kwargs.get('refs'):
+                return (batch.results[id], batch.refs)
+            return batch.results[id]
+        except KeyError:
+            raise FlowThingsNotFound(errors=['Not found'], creds=self._service.creds,
+                                     method='GET', path='%s/%s' % (self._service.path, id))
@@ -1,8 +1,15 @@
 from __future__ import absolute_import
 import os
+import re
 import json
-from copy import deepcopy
+import math
+import time
+import operator
 from collections import namedtuple
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
 
 from .exceptions import FlowThingsError
 from six.moves import map
@@ -13,7 +20,9 @@ from functools import reduce
 __all__ = (
     'Token',
     'Params',
+    'FrozenParams',
     'Modify',
+    'Tracked',
     'P',
     'M',
     'mem',
@@ -59,10 +68,15 @@ class Params(object):
          'some_other_param': 'foo'}
     """
 
+    __slots__ = ('_params',)
+
     def __init__(self, **kwargs):
         self._params = {}
         for k, v in kwargs.items():
-            getattr(self, k)(v)
+            if k in BUILDER_PARAMS:
+                getattr(self, k)(v)
+            else:
+                self._params[k] = v
 
     def refs(self, toggle):
         toggle = 1 if toggle else 0
@@ -85,13 +99,60 @@ class Params(object):
     def to_dict(self):
         return self._params
 
+    def freeze(self):
+        """ Returns an immutable, hashable copy of the params, which can be
+        reused across requests and used as a cache key. """
+
+        return FrozenParams(self._params)
+
     def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
         def generic_setter(self, value):
             self._params[name] = value
             return self
         return generic_setter.__get__(self, Params)
 
 
+BUILDER_PARAMS = frozenset(['refs', 'only', 'filter'])
+
+
+class FrozenParams(dict):
+    """ An immutable params dict. Services use it as is, without copying. """
+
+    __slots__ = ('_hash',)
+
+    def __hash__(self):
+        try:
+            return self._hash
+        except AttributeError:
+            self._hash = hash(frozen(self))
+            return self._hash
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError('FrozenParams are immutable')
+
+    __setitem__ = __delitem__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+    def __reduce__(self):
+        return (FrozenParams, (dict(self),))
+
+    def to_dict(self):
+        return self
+
+    def freeze(self):
+        return self
+
+
+def frozen(val):
+    if isinstance(val, dict):
+        return frozenset((k, frozen(v)) for k, v in val.items())
+    if isinstance(val, (list, tuple)):
+        return tuple(frozen(v) for v in val)
+    return val
+
+
 class Modify(object):
     """ Use this to wrap a model dict and perform incremental updates. At the
     end you can call `done` to get a new model with the fields updated, and
@@ -102,20 +163,226 @@ class Modify(object):
         >>> mod = M(data, baz='qux')
         >>> data2, diff = mod.done()
         ({'foo': 'bar', 'baz': 'qux'}, {'baz': 'qux'})
+
+    Keys may be dotted paths to modify nested fields:
+
+        >>> M(drop).modify('elems.temp', 21).diff()
+        {'elems': {'temp': 21}}
+
+    Changes are kept as an overlay and the original model is never copied or
+    mutated. The merged model is only built when asked for, and it shares
+    any untouched nested values with the original.
     """
 
     def __init__(self, model=None, **kwargs):
-        self._model = deepcopy(model) if model else {}
-        self._changes = {}
+        self._model = model if model else {}
+        self._changes = Overlay()
+        self._merged = None
         for k, v in kwargs.items():
             self.modify(k, v)
 
     def modify(self, key, val):
-        self._model[key] = val
-        self._changes[key] = val
+        self._set(key.split('.'), val)
+        return self
+
+    def get(self, key, default=None):
+        """ Reads a (dotted) key through the changes without building the
+        merged model. """
+
+        return self._get(key.split('.'), default)
+
+    def _set(self, keys, val):
+        node = self._changes
+        for k in keys[:-1]:
+            child = node.get(k)
+            if child is None:
+                child = node[k] = Overlay()
+            elif not isinstance(child, Overlay):
+                child = node[k] = dict(child) if isinstance(child, dict) else {}
+            node = child
+        node[keys[-1]] = val
+        self._merged = None
+
+    def _get(self, keys, default=None):
+        val = self._changes
+        base = self._model
+        for k in keys:
+            if isinstance(val, Overlay):
+                base = base.get(k, MISSING) if isinstance(base, Mapping) else MISSING
+                val = val.get(k, base)
+            elif isinstance(val, dict):
+                val = val.get(k, MISSING)
+            else:
+                return default
+            if val is MISSING:
+                return default
+        if isinstance(val, Overlay):
+            return merge_overlay(base, val)
+        return val
+
+    def __getitem__(self, key):
+        val = self.get(key, MISSING)
+        if val is MISSING:
+            raise KeyError(key)
+        return val
+
+    def __contains__(self, key):
+        return self.get(key, MISSING) is not MISSING
+
+    def diff(self):
+        """ Returns just the changed fields, nested for dotted keys. """
+        return strip_overlay(self._changes)
+
+    @property
+    def model(self):
+        """ The model with all changes applied. """
+        if self._merged is None:
+            self._merged = merge_overlay(self._model, self._changes)
+        return self._merged
 
     def done(self):
-        return (self._model, self._changes)
+        return (self.model, self.diff())
+
+
+class Tracked(Modify):
+    """ A change-tracking wrapper around a fetched model. Read and write it
+    like a dict, including nested dicts such as `elems`; reads and writes are
+    recorded, and `diff` reports only the fields whose values actually
+    changed. Pass it straight to `update`, `update_many` or `save`:
+
+        >>> drop = api.drop(flow_id).read_tracked(drop_id)
+        >>> drop['elems']['temp'] = 21
+        >>> drop.diff()
+        {'elems': {'temp': 21}}
+        >>> api.drop(flow_id).save(drop)
+
+    Lists are returned as is, so assign a new list to change one. """
+
+    def __init__(self, model=None, **kwargs):
+        self.reads = set()
+        Modify.__init__(self, model, **kwargs)
+
+    def __getitem__(self, key):
+        return self._view((key,))
+
+    def __setitem__(self, key, val):
+        self._set((key,), val)
+
+    def __iter__(self):
+        return iter(self.model)
+
+    def __len__(self):
+        return len(self.model)
+
+    def keys(self):
+        return list(self.model.keys())
+
+    def items(self):
+        return [(k, self[k]) for k in self.model]
+
+    def _view(self, keys):
+        val = self._get(keys, MISSING)
+        if val is MISSING:
+            raise KeyError('.'.join(keys))
+        self.reads.add('.'.join(keys))
+        if isinstance(val, Mapping):
+            return TrackedView(self, keys)
+        return val
+
+    def diff(self):
+        """ Returns the minimal nested diff against the original model. """
+        return structural_diff(self._model, self._changes)
+
+
+class TrackedView(object):
+    """ A nested dict inside a `Tracked` model. Writes are recorded on the
+    root model. """
+
+    def __init__(self, root, keys):
+        self._root = root
+        self._keys = keys
+
+    def __getitem__(self, key):
+        return self._root._view(self._keys + (key,))
+
+    def __setitem__(self, key, val):
+        self._root._set(self._keys + (key,), val)
+
+    def __contains__(self, key):
+        return self._root._get(self._keys + (key,), MISSING) is not MISSING
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def unwrap(self):
+        return self._root._get(self._keys)
+
+    def __iter__(self):
+        return iter(self.unwrap())
+
+    def __len__(self):
+        return len(self.unwrap())
+
+    def keys(self):
+        return list(self.unwrap().keys())
+
+    def items(self):
+        return [(k, self[k]) for k in self.unwrap()]
+
+    def __eq__(self, that):
+        if isinstance(that, TrackedView):
+            that = that.unwrap()
+        return self.unwrap() == that
+
+    def __ne__(self, that):
+        return not self == that
+
+    def __repr__(self):
+        return repr(self.unwrap())
+
+
+class Overlay(dict):
+    """ A nested set of changes to be merged into a dict, as opposed to a
+    dict value replacing one. """
+    pass
+
+
+def merge_overlay(base, overlay):
+    # Any mapping, eg. the `GreenThunk` results of `api.lazy()`.
+    merged = dict(base) if isinstance(base, Mapping) else {}
+    for k, v in overlay.items():
+        if isinstance(v, Overlay):
+            v = merge_overlay(merged.get(k), v)
+        merged[k] = v
+    return merged
+
+
+def structural_diff(base, changes):
+    """ Returns the changes that differ from the base, recursing into dicts.
+    A replacement dict is only diffed when it keeps all of the base's keys,
+    since removed keys can't be expressed in a partial update. """
+
+    out = {}
+    for k, v in changes.items():
+        b = base.get(k, MISSING) if isinstance(base, Mapping) else MISSING
+        if (isinstance(v, dict) and isinstance(b, Mapping) and
+                (isinstance(v, Overlay) or set(b) <= set(v))):
+            d = structural_diff(b, v)
+            if d:
+                out[k] = d
+        elif isinstance(v, Overlay):
+            out[k] = strip_overlay(v)
+        elif type(b) is not type(v) or b != v:
+            out[k] = v
+    return out
+
+
+def strip_overlay(overlay):
+    return dict((k, strip_overlay(v) if isinstance(v, Overlay) else v)
+                for k, v in overlay.items())
 
 
 P = Params
@@ -123,12 +390,40 @@ M = Modify
 
 
 class Filter(object):
+    """ Base class for filter expressions. Besides rendering themselves to the
+    platform query language with `str`, filters can be compiled into plain
+    Python predicates and evaluated locally against models you already hold:
+
+        >>> f = (mem.elems.temp > 20).AND(EXISTS('elems.unit'))
+        >>> f.matches({'elems': {'temp': 25, 'unit': 'C'}})
+        True
+        >>> hot = list(filter(f.compile(), drops))
+    """
+
     def AND(self, that):
         return LogicalFilter(self, '&&', that)
 
     def OR(self, that):
         return LogicalFilter(self, '||', that)
 
+    def compile(self):
+        """ Returns a predicate taking a model dict and returning a bool. """
+        raise NotImplementedError('%s cannot be evaluated locally' % self.__class__.__name__)
+
+    def matches(self, model):
+        """ Evaluates the filter against a single model. The compiled
+        predicate is cached on the filter. """
+
+        predicate = self.__dict__.get('_predicate')
+        if predicate is None:
+            predicate = self._predicate = self.compile()
+        return predicate(model)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.pop('_predicate', None)
+        return state
+
 
 class PrefixFilter(Filter):
     def __init__(self, member, operator):
@@ -138,6 +433,10 @@ class PrefixFilter(Filter):
     def __str__(self):
         return '%s %s' % (self.operator, str(self.member))
 
+    def compile(self):
+        get = member_getter(self.member)
+        return lambda model: get(model) is not MISSING
+
 
 class BinaryFilter(Filter):
     def __init__(self, member, operator, operand):
@@ -148,6 +447,33 @@ class BinaryFilter(Filter):
     def __str__(self):
         return ' '.join((str(self.member), self.operator, prim_str(self.operand)))
 
+    def compile(self):
+        get = member_getter(self.member)
+
+        if isinstance(self.operand, Regex):
+            search = self.operand.compile().search
+            def predicate(model):
+                val = get(model)
+                return isinstance(val, six.string_types) and search(val) is not None
+            return predicate
+
+        if isinstance(self.operand, Member):
+            get_operand = member_getter(self.operand)
+        else:
+            operand = self.operand
+            get_operand = lambda model: operand
+
+        compare = COMPARISONS[self.operator]
+        def predicate(model):
+            val = get(model)
+            if val is MISSING:
+                return False
+            other = get_operand(model)
+            if other is MISSING:
+                return False
+            return compare(val, other)
+        return predicate
+
 
 class LogicalFilter(BinaryFilter):
     def __init__(self, f1, operator, f2):
@@ -159,6 +485,13 @@ class LogicalFilter(BinaryFilter):
     def __str__(self):
         return '(%s) %s (%s)' % (str(self.member), self.operator, str(self.operand))
 
+    def compile(self):
+        left = self.member.compile()
+        right = self.operand.compile()
+        if self.operator == '&&':
+            return lambda model: left(model) and right(model)
+        return lambda model: left(model) or right(model)
+
 
 class ListFilter(BinaryFilter):
     def __init__(self, member, operator, operand):
@@ -170,6 +503,24 @@ class ListFilter(BinaryFilter):
     def __str__(self):
         return '%s %s [%s]' % (str(self.member), self.operator, ','.join(map(prim_str, self.operand)))
 
+    def compile(self):
+        get = member_getter(self.member)
+        items = list(self.operand)
+
+        if self.operator == 'IN':
+            def predicate(model):
+                val = get(model)
+                return val is not MISSING and any(_equal(val, x) for x in items)
+            return predicate
+
+        # CONTAINS matches when the member is a list holding every item.
+        def predicate(model):
+            val = get(model)
+            if not isinstance(val, (list, tuple)):
+                return False
+            return all(any(_equal(v, x) for v in val) for x in items)
+        return predicate
+
 
 class LocationFilter(Filter):
     def __init__(self, member, unit, loc):
@@ -180,6 +531,30 @@ class LocationFilter(Filter):
     def __str__(self):
         return '%s WITHIN %s OF [%s]' % (str(self.member), self.unit, self.loc)
 
+    def compile(self):
+        if self.loc.startswith('ZIP='):
+            raise FlowThingsError('ZIP code locations cannot be evaluated locally')
+
+        num, unit = self.unit.split(' ', 1)
+        try:
+            radius = EARTH_RADIUS[unit.upper()]
+        except KeyError:
+            raise FlowThingsError('Unknown distance unit: %s' % unit)
+
+        distance = float(num)
+        lat, lon = [math.radians(float(x)) for x in self.loc.split(',')]
+        get = member_getter(self.member)
+
+        def predicate(model):
+            coords = _coords(get(model))
+            if coords is None:
+                return False
+            lat2, lon2 = coords
+            a = (math.sin((lat2 - lat) / 2) ** 2 +
+                 math.cos(lat) * math.cos(lat2) * math.sin((lon2 - lon) / 2) ** 2)
+            return 2 * radius * math.asin(min(1.0, math.sqrt(a))) <= distance
+        return predicate
+
 
 class AgeFilter(Filter):
     def __init__(self, member, operator, ms):
@@ -194,6 +569,18 @@ class AgeFilter(Filter):
         else:
             return 'AGE(%s) %s %s' % (prim_str(self.member), self.operator, self.ms)
 
+    def compile(self):
+        get = member_getter(Member(self.member or 'creationDate'))
+        compare = COMPARISONS[self.operator]
+        ms = self.ms
+
+        def predicate(model):
+            val = get(model)
+            if not isinstance(val, NUMBERS) or isinstance(val, bool):
+                return False
+            return compare(time.time() * 1000 - val, ms)
+        return predicate
+
 
 class MatchesFilter(Filter):
     def __init__(self, re):
@@ -202,6 +589,14 @@ class MatchesFilter(Filter):
     def __str__(self):
         return 'MATCHES ' + str(self.re)
 
+    def compile(self):
+        search = self.re.compile().search
+
+        def predicate(model):
+            elems = model.get('elems', model)
+            return any(search(s) is not None for s in _strings(elems))
+        return predicate
+
 
 class HasFilter(Filter):
     def __init__(self, name):
@@ -210,6 +605,16 @@ class HasFilter(Filter):
     def __str__(self):
         return 'HAS ' + str(self.name)
 
+    def compile(self):
+        name = str(self.name)
+
+        def predicate(model):
+            elems = model.get('elems')
+            if not isinstance(elems, dict):
+                return False
+            return any(_elem_type(v) == name for v in elems.values())
+        return predicate
+
 
 class NotFilter(Filter):
     def __init__(self, filter):
@@ -218,6 +623,10 @@ class NotFilter(Filter):
     def __str__(self):
         return 'NOT ' + str(self.filter)
 
+    def compile(self):
+        inner = self.filter.compile()
+        return lambda model: not inner(model)
+
 
 class Regex(object):
     def __init__(self, pattern, flags):
@@ -227,6 +636,12 @@ class Regex(object):
     def __str__(self):
         return '/%s/%s' % (self.pattern.replace('/', '\\/'), self.flags)
 
+    def compile(self):
+        flags = 0
+        for f in self.flags:
+            flags |= REGEX_FLAGS.get(f, 0)
+        return re.compile(self.pattern, flags)
+
 
 class Member(object):
     def __init__(self, name):
@@ -236,6 +651,8 @@ class Member(object):
         return self.name
 
     def __getattr__(self, attr):
+        if attr.startswith('__'):
+            raise AttributeError(attr)
         return Member('%s.%s' % (self.name, attr))
 
     def __getitem__(self, attr):
@@ -277,6 +694,8 @@ class MemberFactory(object):
         return Member(name)
 
     def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
         return Member(name)
 
 mem = MemberFactory()
@@ -340,3 +759,120 @@ def prim_str(prim):
     if isinstance(prim, (Member, Regex, int, float)):
         return str(prim)
     assert False, 'Must be a filter primitive'
+
+
+NUMBERS = six.integer_types + (float,)
+
+MISSING = object()
+
+REGEX_FLAGS = {
+    'i': re.IGNORECASE,
+    'm': re.MULTILINE,
+    's': re.DOTALL,
+    'x': re.VERBOSE,
+}
+
+EARTH_RADIUS = {
+    'MILES' : 3958.8,
+    'MI'    : 3958.8,
+    'KM'    : 6371.0,
+    'M'     : 6371000.0,
+    'METERS': 6371000.0,
+    'FEET'  : 20902231.0,
+    'FT'    : 20902231.0,
+}
+
+ELEM_TYPES = (
+    (bool, 'boolean'),
+    (six.integer_types, 'integer'),
+    (float, 'float'),
+    (six.string_types, 'string'),
+    (dict, 'map'),
+    (list, 'list'),
+)
+
+
+def member_getter(member):
+    """ Returns a function resolving a dotted member path against a model,
+    returning `MISSING` if any part of the path is absent. Typed element
+    values (`{'type': ..., 'value': ...}`) are unwrapped along the way. """
+
+    keys = [(key, int(key) if key.isdigit() else None)
+            for key in str(member).split('.')]
+
+    def get(model):
+        val = model
+        for key, index in keys:
+            if isinstance(val, dict):
+                val = val.get(key, MISSING)
+                if val is MISSING:
+                    return MISSING
+            elif index is not None and isinstance(val, (list, tuple)) and index < len(val):
+                val = val[index]
+            else:
+                return MISSING
+            if isinstance(val, dict) and 'value' in val and 'type' in val:
+                val = val['value']
+        return val
+    return get
+
+
+def _equal(a, b):
+    if isinstance(a, bool) != isinstance(b, bool):
+        return False
+    return a == b
+
+
+def _ordered(op):
+    def compare(a, b):
+        if isinstance(a, NUMBERS) and isinstance(b, NUMBERS):
+            return op(a, b)
+        if isinstance(a, six.string_types) and isinstance(b, six.string_types):
+            return op(a, b)
+        return False
+    return compare
+
+
+COMPARISONS = {
+    '==': _equal,
+    '!=': lambda a, b: not _equal(a, b),
+    '>' : _ordered(operator.gt),
+    '>=': _ordered(operator.ge),
+    '<' : _ordered(operator.lt),
+    '<=': _ordered(operator.le),
+}
+
+
+def _coords(val):
+    if isinstance(val, dict):
+        lat = val.get('lat', val.get('latitude'))
+        lon = val.get('lon', val.get('longitude'))
+    elif isinstance(val, (list, tuple)) and len(val) == 2:
+        lat, lon = val
+    else:
+        return None
+    if not isinstance(lat, NUMBERS) or not isinstance(lon, NUMBERS):
+        return None
+    return math.radians(lat), math.radians(lon)
+
+
+def _strings(val):
+    if isinstance(val, six.string_types):
+        yield val
+    elif isinstance(val, dict):
+        for v in val.values():
+            for s in _strings(v):
+                yield s
+    elif isinstance(val, (list, tuple)):
+        for v in val:
+            for s in _strings(v):
+                yield s
+
+
+def _elem_type(val):
+    if isinstance(val, dict) and 'type' in val and 'value' in val:
+        return val['type']
+    for types, name in ELEM_TYPES:
+        if isinstance(val, types):
+            return name
+    return None
@@ -0,0 +1,121 @@
+from __future__ import absolute_import
+import json
+import time
+import threading
+
+import six
+
+from .utils import default, fork_aware
+
+
+__all__ = ('AggregateCache',)
+
+
+ADDITIVE_OUTPUTS = ('$count', '$sum')
+
+
+class AggregateCache(object):
+    """ Caches `aggregate` results keyed on the normalized request, per
+    account and service path. Pass one to an API to share it between all drop
+    services:
+
+        >>> api = API(creds, aggregate_cache=AggregateCache(ttl=5))
+
+    Results are reused for `ttl` seconds. Updates and deletes made through a
+    drop service invalidate its flow, and creates expire its results; other
+    writers can call `invalidate_flow`. Expired results are kept around so
+    that incremental aggregations can build on them. """
+
+    def __init__(self, ttl=10, clock=time.time):
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = {}
+        self._lock = threading.Lock()
+        fork_aware(self)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def key(self, data):
+        """ Normalizes an aggregate request body into a cache key. """
+        return json.dumps(data, sort_keys=True)
+
+    def get(self, account, path, key, fresh=True):
+        """ Returns a `(result, fetched_at, watermark)` tuple or None, where
+        the watermark is the newest `creationDate` the result counts, if
+        known. When `fresh` is set, entries older than the TTL are ignored. """
+
+        entry = self._entries.get((account, path), {}).get(key)
+        if entry is None:
+            return None
+        if fresh and (entry[1] is None or self.clock() - entry[1] > self.ttl):
+            return None
+        return entry
+
+    def set(self, account, path, key, result, fetched_at=None, watermark=None):
+        fetched_at = default(fetched_at, self.clock())
+        with self._lock:
+            self._entries.setdefault((account, path), {})[key] = (result, fetched_at, watermark)
+
+    def expire(self, path=None):
+        """ Marks the results for a service path (or all of them) as stale,
+        but keeps them for incremental aggregations. """
+        with self._lock:
+            for scope, entries in self._entries.items():
+                if path is None or scope[1] == path:
+                    for key, entry in list(entries.items()):
+                        entries[key] = (entry[0], None, entry[2])
+
+    def invalidate(self, path=None):
+        """ Drops all cached results for a service path, or everything. """
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+            else:
+                for scope in [s for s in self._entries if s[1] == path]:
+                    del self._entries[scope]
+
+    def invalidate_flow(self, flow_id):
+        self.invalidate('/drop/' + flow_id)
+
+    def clear(self):
+        self.invalidate()
+
+
+def is_additive(output):
+    """ Whether all outputs can be combined by adding partial results. """
+    outputs = [output] if isinstance(output, six.string_types) else output
+    return all(o.split(':', 1)[0] in ADDITIVE_OUTPUTS for o in outputs)
+
+
+def merge_additive(output, previous, delta):
+    """ Combines two aggregate results of additive outputs. Rows are matched
+    on every field that isn't an output (ie. the group), and their outputs
+    are summed. """
+
+    outputs = set([output] if isinstance(output, six.string_types) else output)
+
+    def rows(result):
+        return [result] if isinstance(result, dict) else list(result or [])
+
+    def group(row):
+        return tuple(sorted((k, json.dumps(v, sort_keys=True))
+                            for k, v in row.items() if k not in outputs))
+
+    merged = []
+    index = {}
+    for row in rows(previous) + rows(delta):
+        g = group(row)
+        if g in index:
+            target = index[g]
+            for k in outputs:
+                if k in row:
+                    target[k] = target.get(k, 0) + row[k]
+        else:
+            index[g] = dict(row)
+            merged.append(index[g])
+
+    if isinstance(previous, dict):
+        return merged[0] if merged else previous
+    return merged
@@ -0,0 +1,256 @@
+from __future__ import absolute_import
+import csv
+import time
+import operator
+
+import six
+
+from .builders import (BinaryFilter, LogicalFilter, ListFilter, AgeFilter,
+                       PrefixFilter, NotFilter, Member, Regex, MISSING,
+                       NUMBERS, member_getter)
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+__all__ = (
+    'evaluate_batch',
+    'Columns',
+    'CSVWriter',
+    'NumpyWriter',
+    'ArrowWriter',
+)
+
+
+NUMBER_TYPES = frozenset(six.integer_types + (float,))
+
+STRING_TYPES = frozenset(six.string_types + (six.text_type,))
+
+ORDERINGS = {
+    '>' : operator.gt,
+    '>=': operator.ge,
+    '<' : operator.lt,
+    '<=': operator.le,
+}
+
+
+def evaluate_batch(f, models):
+    """ Evaluates a filter over a list of models, returning a NumPy boolean
+    mask. Comparison, `IN`, `AGE`, `EXISTS` and boolean filters are evaluated
+    column-wise; anything else falls back to the compiled per-model
+    predicate. Results are identical to calling `f.matches` on each model.
+
+        >>> mask = evaluate_batch(mem.elems.temp > 20, drops)
+        >>> hot = [d for d, m in zip(drops, mask) if m]
+    """
+
+    return Columns(models).evaluate(f)
+
+
+class Column(object):
+    """ A single member path projected over a batch of models, split by
+    value type so comparisons can be made vectorized. """
+
+    def __init__(self, values):
+        types = [type(v) for v in values]
+        self.present = np.array([v is not MISSING for v in values], dtype=bool)
+        self.is_num  = np.array([t in NUMBER_TYPES for t in types], dtype=bool)
+        self.is_str  = np.array([t in STRING_TYPES for t in types], dtype=bool)
+        self.is_bool = np.array([t is bool for t in types], dtype=bool)
+        self.bools   = np.array([v is True for v in values], dtype=bool)
+        self.num = np.array([v if t in NUMBER_TYPES else 0.0
+                             for v, t in zip(values, types)], dtype=float)
+        if self.is_str.any():
+            self.strs = np.array([v if t in STRING_TYPES else u''
+                                  for v, t in zip(values, types)], dtype=np.unicode_)
+        else:
+            self.strs = None
+
+    def equal(self, operand):
+        if isinstance(operand, bool):
+            return self.is_bool & (self.bools == operand)
+        if isinstance(operand, NUMBERS):
+            return self.is_num & (self.num == operand)
+        if isinstance(operand, six.string_types):
+            if self.strs is None:
+                return np.zeros(len(self.present), dtype=bool)
+            return self.is_str & (self.strs == six.text_type(operand))
+        return np.zeros(len(self.present), dtype=bool)
+
+    def ordered(self, op, operand):
+        if isinstance(operand, NUMBERS) and not isinstance(operand, bool):
+            return (self.is_num | self.is_bool) & op(np.where(self.is_bool, self.bools, self.num), operand)
+        if isinstance(operand, six.string_types) and self.strs is not None:
+            return self.is_str & op(self.strs, six.text_type(operand))
+        return np.zeros(len(self.present), dtype=bool)
+
+
+class Columns(object):
+    """ Lazily projects the member paths referenced by filters into columns
+    over a batch of models. Columns are reused across `evaluate` calls. """
+
+    def __init__(self, models):
+        if np is None:
+            raise NotImplementedError('numpy is required for batch evaluation')
+        self.models = models
+        self._columns = {}
+
+    def column(self, member):
+        name = str(member)
+        col = self._columns.get(name)
+        if col is None:
+            get = member_getter(name)
+            col = self._columns[name] = Column([get(m) for m in self.models])
+        return col
+
+    def evaluate(self, f):
+        if isinstance(f, LogicalFilter):
+            left = self.evaluate(f.member)
+            right = self.evaluate(f.operand)
+            return left & right if f.operator == '&&' else left | right
+
+        if isinstance(f, NotFilter):
+            return ~self.evaluate(f.filter)
+
+        if isinstance(f, PrefixFilter):
+            return self.column(f.member).present.copy()
+
+        if isinstance(f, ListFilter) and f.operator == 'IN':
+            col = self.column(f.member)
+            mask = np.zeros(len(self.models), dtype=bool)
+            for item in f.operand:
+                mask |= col.equal(item)
+            return mask
+
+        if isinstance(f, AgeFilter):
+            col = self.column(f.member or 'creationDate')
+            age = time.time() * 1000 - col.num
+            if f.operator in ORDERINGS:
+                return col.is_num & ORDERINGS[f.operator](age, f.ms)
+            eq = col.is_num & (age == f.ms)
+            return eq if f.operator == '==' else col.is_num & ~eq
+
+        if (type(f) is BinaryFilter and
+                not isinstance(f.operand, (Member, Regex))):
+            col = self.column(f.member)
+            if f.operator == '==':
+                return col.equal(f.operand)
+            if f.operator == '!=':
+                return col.present & ~col.equal(f.operand)
+            return col.ordered(ORDERINGS[f.operator], f.operand)
+
+        predicate = f.compile()
+        return np.fromiter((predicate(m) for m in self.models), dtype=bool,
+                           count=len(self.models))
+
+
+class CSVWriter(object):
+    """ Export writer appending rows to a CSV file object. Missing values are
+    written as empty cells. `close` returns the number of rows written.
+
+        >>> with open('drops.csv', 'w') as f:
+        ...     api.drop(flow_id).export(CSVWriter(f), fields=['id', 'elems.temp'])
+    """
+
+    def __init__(self, fileobj, header=True, **fmtparams):
+        self._writer = csv.writer(fileobj, **fmtparams)
+        self._header = header
+        self.rows = 0
+
+    def open(self, fields):
+        if self._header:
+            self._writer.writerow(fields)
+
+    def write(self, columns):
+        rows = list(zip(*columns))
+        self._writer.writerows(rows)
+        self.rows += len(rows)
+
+    def close(self):
+        return self.rows
+
+
+class NumpyWriter(object):
+    """ Export writer collecting each field into a NumPy array. `dtypes` maps
+    field names to dtypes; numeric dtypes store missing values as NaN, other
+    fields default to object arrays. `close` returns a dict of field ->
+    array. """
+
+    def __init__(self, dtypes=None):
+        if np is None:
+            raise NotImplementedError('numpy is required for NumpyWriter')
+        self._dtypes = dtypes or {}
+        self._chunks = None
+        self._fields = None
+
+    def open(self, fields):
+        self._fields = fields
+        self._chunks = dict((f, []) for f in fields)
+
+    def write(self, columns):
+        for field, col in zip(self._fields, columns):
+            dtype = np.dtype(self._dtypes.get(field, object))
+            if dtype.kind in 'fc':
+                col = [np.nan if v is None else v for v in col]
+            self._chunks[field].append(np.array(col, dtype=dtype))
+
+    def close(self):
+        result = {}
+        for field in self._fields:
+            chunks = self._chunks.pop(field)
+            dtype = self._dtypes.get(field, object)
+            result[field] = np.concatenate(chunks) if chunks else np.array([], dtype=dtype)
+        return result
+
+
+class ArrowWriter(object):
+    """ Export writer building an Arrow record batch per chunk. When `sink` is
+    given, batches are streamed to it in the Arrow IPC stream format and
+    `close` returns the number of rows written; otherwise `close` returns a
+    `pyarrow.Table`. Requires `pyarrow`. """
+
+    def __init__(self, sink=None, schema=None):
+        try:
+            import pyarrow
+        except ImportError:
+            raise NotImplementedError('pyarrow is required for ArrowWriter')
+        self._pa = pyarrow
+        self._sink = sink
+        self._schema = schema
+        self._stream = None
+        self._batches = []
+        self._fields = None
+        self.rows = 0
+
+    def open(self, fields):
+        self._fields = fields
+
+    def write(self, columns):
+        pa = self._pa
+        if self._schema is not None:
+            arrays = [pa.array(col, type=self._schema.field(f).type)
+                      for f, col in zip(self._fields, columns)]
+            batch = pa.RecordBatch.from_arrays(arrays, schema=self._schema)
+        else:
+            batch = pa.RecordBatch.from_arrays([pa.array(col) for col in columns],
+                                               names=self._fields)
+        self.rows += batch.num_rows
+
+        if self._sink is None:
+            self._batches.append(batch)
+            return
+        if self._stream is None:
+            self._schema = batch.schema
+            self._stream = pa.ipc.new_stream(self._sink, batch.schema)
+        self._stream.write_batch(batch)
+
+    def close(self):
+        if self._sink is None:
+            if not self._batches:
+                return self._pa.table(dict((f, []) for f in self._fields))
+            return self._pa.Table.from_batches(self._batches)
+        if self._stream is not None:
+            self._stream.close()
+        return self.rows
@@ -0,0 +1,272 @@
+from __future__ import absolute_import
+import time
+import logging
+import threading
+from collections import deque
+
+from .utils import fork_aware
+
+
+__all__ = ('AdaptiveLimit', 'PriorityLanes')
+
+
+logger = logging.getLogger('flowthings')
+
+
+class AdaptiveLimit(object):
+    """ Caps the number of requests in flight, and tunes the cap at runtime
+    with AIMD (additive increase, multiplicative decrease). Each time `limit`
+    requests in a row succeed quickly, the limit grows by `increase`. An
+    error (an exception, a 5xx or a 429) or a latency above `tolerance`
+    times the lowest recently seen shrinks it by `backoff`, at most once per
+    `limit` completions so that a burst of failures doesn't collapse it.
+
+    Pass one to an API and every request goes through it, so `api.async()`
+    and `api.lazy()` can use a pool larger than the backend can take; calls
+    beyond the limit wait their turn:
+
+        >>> concurrency = AdaptiveLimit(initial=16, max_limit=128)
+        >>> api = API(creds, async_lib=eventlet, concurrency=concurrency)
+        >>> concurrency.snapshot()
+        {'limit': 24, 'inflight': 3, ...}
+    """
+
+    def __init__(self, initial=8, min_limit=1, max_limit=256, increase=1, backoff=0.7,
+                 tolerance=2.0, window=100, clock=time.time):
+        self.limit = initial
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.clock = clock
+        self.inflight = 0
+        self.latency = None
+        self.increases = 0
+        self.decreases = 0
+        self.errors = 0
+        self.decisions = deque(maxlen=100)
+        self._latencies = deque(maxlen=window)
+        self._successes = 0
+        self._since_decrease = 0
+        self._cond = threading.Condition(threading.Lock())
+        fork_aware(self)
+
+    def _after_fork(self):
+        self.inflight = 0
+        self._cond = threading.Condition(threading.Lock())
+
+    def acquire(self):
+        with self._cond:
+            while self.inflight >= self.limit:
+                self._cond.wait()
+            self.inflight += 1
+
+    def release(self, latency=None, error=False):
+        """ Ends a request, and adjusts the limit from how it went. """
+
+        with self._cond:
+            self.inflight -= 1
+            self._since_decrease += 1
+            if error:
+                self.errors += 1
+                self._decrease('error')
+            elif latency is not None:
+                self._latencies.append(latency)
+                self.latency = latency if self.latency is None else \
+                    0.8 * self.latency + 0.2 * latency
+                if latency > self.tolerance * min(self._latencies):
+                    self._decrease('latency')
+                else:
+                    self._successes += 1
+                    if self._successes >= self.limit:
+                        self._change(min(self.max_limit, self.limit + self.increase), 'increase')
+            self._cond.notify_all()
+
+    def call(self, fn, *args, **kwargs):
+        """ Calls a request function returning `(body, headers, status)`
+        within the limit. """
+
+        self.acquire()
+        start = self.clock()
+        try:
+            res = fn(*args, **kwargs)
+        except Exception:
+            self.release(error=True)
+            raise
+        status = res[2]
+        self.release(self.clock() - start, error=status >= 500 or status == 429)
+        return res
+
+    def snapshot(self):
+        """ The current limit and counters, for metrics. """
+
+        return {
+            'limit': self.limit,
+            'inflight': self.inflight,
+            'latency': self.latency,
+            'increases': self.increases,
+            'decreases': self.decreases,
+            'errors': self.errors,
+        }
+
+    def _decrease(self, reason):
+        if self._since_decrease < self.limit:
+            return
+        self._change(max(self.min_limit, int(self.limit * self.backoff)), reason)
+
+    def _change(self, limit, reason):
+        old = self.limit
+        self._successes = 0
+        if limit == old:
+            return
+        if limit > old:
+            self.increases += 1
+        else:
+            self.decreases += 1
+            self._since_decrease = 0
+        self.limit = limit
+        self.decisions.append((self.clock(), reason, old, limit))
+        logger.debug('Concurrency limit %d -> %d (%s)', old, limit, reason)
+
+
+class PriorityLanes(object):
+    """ Splits up to `limit` requests in flight between priority lanes, eg.
+    user-facing reads and background backfills. Each lane has its own quota
+    of in-flight requests, so batch work can't take every slot. Lanes are
+    given highest priority first; when a slot frees up, a request queued in a
+    higher lane goes ahead of those queued in lower lanes, and requests in the
+    same lane go in order. Calls use the `default` lane (the first) unless the
+    API picks one with `with_priority`:
+
+        >>> lanes = PriorityLanes((('interactive', 16), ('batch', 4)), limit=16)
+        >>> api = API(creds, async_lib=eventlet, concurrency=lanes)
+        >>> backfill = api.with_priority('batch').async()
+
+    `limit` may be an `AdaptiveLimit`, which then tunes the total from how
+    the requests of every lane go, while the lanes split it:
+
+        >>> lanes = PriorityLanes((('interactive', 64), ('batch', 8)),
+        ...                       limit=AdaptiveLimit(initial=16, max_limit=64))
+
+    `snapshot()` reports what is in flight and queued in each lane, and how
+    long its requests waited for a slot. """
+
+    def __init__(self, lanes=(('interactive', 16), ('batch', 4)), limit=16, default=None,
+                 clock=time.time):
+        if isinstance(limit, AdaptiveLimit):
+            self.adaptive, self._limit = limit, None
+        else:
+            self.adaptive, self._limit = None, limit
+        self.clock = clock
+        self.order = [name for name, _ in lanes]
+        self.default = default or self.order[0]
+        self.inflight = 0
+        self._lanes = dict((name, Lane(self, name, quota)) for name, quota in lanes)
+        self._cond = threading.Condition(threading.Lock())
+        fork_aware(self)
+
+    def _after_fork(self):
+        self.inflight = 0
+        self._cond = threading.Condition(threading.Lock())
+        for lane in self._lanes.values():
+            lane.inflight = 0
+            lane._waiting.clear()
+
+    @property
+    def limit(self):
+        return self.adaptive.limit if self.adaptive is not None else self._limit
+
+    def lane(self, name):
+        try:
+            return self._lanes[name]
+        except KeyError:
+            raise ValueError('Unknown priority lane: %s' % name)
+
+    def call(self, fn, *args, **kwargs):
+        return self._lanes[self.default].call(fn, *args, **kwargs)
+
+    def snapshot(self):
+        """ The current totals, and the counters of each lane, for metrics. """
+
+        with self._cond:
+            snapshot = {
+                'limit': self.limit,
+                'inflight': self.inflight,
+                'lanes': dict((name, lane.snapshot()) for name, lane in self._lanes.items()),
+            }
+        if self.adaptive is not None:
+            snapshot['adaptive'] = self.adaptive.snapshot()
+        return snapshot
+
+    def _acquire(self, lane):
+        ticket = object()
+        start = self.clock()
+        with self._cond:
+            lane._waiting.append(ticket)
+            while not self._admissible(lane, ticket):
+                self._cond.wait()
+            lane._waiting.popleft()
+            lane.inflight += 1
+            self.inflight += 1
+            lane._record(self.clock() - start)
+            # The next in line may fit too.
+            self._cond.notify_all()
+
+    def _release(self, lane):
+        with self._cond:
+            lane.inflight -= 1
+            self.inflight -= 1
+            self._cond.notify_all()
+
+    def _has_slot(self, lane):
+        return lane.inflight < lane.quota and self.inflight < self.limit
+
+    def _admissible(self, lane, ticket):
+        if lane._waiting[0] is not ticket or not self._has_slot(lane):
+            return False
+        for name in self.order:
+            other = self._lanes[name]
+            if other is lane:
+                return True
+            if other._waiting and self._has_slot(other):
+                return False
+        return True
+
+
+class Lane(object):
+    """ A lane of `PriorityLanes`, with its own quota and queue. """
+
+    def __init__(self, lanes, name, quota):
+        self._lanes = lanes
+        self.name = name
+        self.quota = quota
+        self.inflight = 0
+        self.requests = 0
+        self.queue_time = 0.0
+        self.max_queue_time = 0.0
+        self._waiting = deque()
+
+    def call(self, fn, *args, **kwargs):
+        self._lanes._acquire(self)
+        try:
+            if self._lanes.adaptive is not None:
+                return self._lanes.adaptive.call(fn, *args, **kwargs)
+            return fn(*args, **kwargs)
+        finally:
+            self._lanes._release(self)
+
+    def snapshot(self):
+        return {
+            'quota': self.quota,
+            'inflight': self.inflight,
+            'queued': len(self._waiting),
+            'requests': self.requests,
+            'queue_time': self.queue_time / self.requests if self.requests else 0.0,
+            'max_queue_time': self.max_queue_time,
+        }
+
+    def _record(self, waited):
+        self.requests += 1
+        self.queue_time += waited
+        self.max_queue_time = max(self.max_queue_time, waited)
@@ -9,7 +9,9 @@ DEFAULT = {}
 class Defaults(object):
     def __init__(self, async_lib=None, secure=True, host='api.flowthings.io',
                  version='4.0', request=api_request, encoder=json,
-                 params=DEFAULT, ws_host='ws.flowthings.io', verify=True):
+                 params=DEFAULT, ws_host='ws.flowthings.io', verify=True,
+                 aggregate_cache=None, compression=None, conditional=None,
+                 hedging=None, concurrency=None, endpoints=None, ws_endpoints=None):
 
         if params is DEFAULT:
             params = {}
@@ -21,6 +23,13 @@ class Defaults(object):
         self.version = version
         self.encoder = encoder
         self.params = params
+        self.aggregate_cache = aggregate_cache
+        self.compression = compression
+        self.conditional = conditional
+        self.hedging = hedging
+        self.concurrency = concurrency
+        self.endpoints = endpoints
+        self.ws_endpoints = ws_endpoints
 
         if not verify:
             from functools import partial
@@ -0,0 +1,257 @@
+from __future__ import absolute_import
+import time
+import socket
+import logging
+import threading
+
+from six.moves.urllib.parse import urlsplit, urlunsplit
+
+from .utils import fork_aware
+
+
+__all__ = ('Endpoints',)
+
+
+logger = logging.getLogger('flowthings')
+
+
+def failover_errors():
+    """ The errors raised when a host can't be reached or drops the
+    connection, after which an idempotent request is safe to send to another
+    host. Read timeouts aren't included, as the host may still answer. """
+
+    errors = ()
+    try:
+        import requests
+        errors += (requests.ConnectionError,)
+    except ImportError:
+        pass
+    try:
+        import httpx
+        errors += (httpx.NetworkError, httpx.ConnectTimeout)
+    except ImportError:
+        pass
+    return errors
+
+
+def connect_errors():
+    """ The errors raised before a request reached the host, after which any
+    request is safe to send to another host. """
+
+    errors = ()
+    try:
+        import requests
+        errors += (requests.ConnectTimeout,)
+    except ImportError:
+        pass
+    try:
+        import httpx
+        errors += (httpx.ConnectError, httpx.ConnectTimeout)
+    except ImportError:
+        pass
+    return errors
+
+
+def connect_failed(error):
+    """ Whether the connection for a request couldn't be made, eg. it was
+    refused or timed out. `requests` reports a refused connection as a
+    `ConnectionError` around the pool's `NewConnectionError`. """
+
+    if isinstance(error, connect_errors()):
+        return True
+    try:
+        from urllib3.exceptions import NewConnectionError
+    except ImportError:
+        return False
+    reason = error.args[0] if error.args else None
+    reason = getattr(reason, 'reason', reason)
+    return isinstance(reason, NewConnectionError)
+
+
+def route(url, host):
+    """ Returns the URL with its host (and port) replaced. """
+
+    parts = urlsplit(url)
+    return urlunsplit((parts.scheme, host, parts.path, parts.query, parts.fragment))
+
+
+class Endpoint(object):
+    def __init__(self, host):
+        self.host = host
+        self.latency = None
+        self.probe_latency = None
+        self.failures = 0
+        self.down_until = 0
+
+    def snapshot(self, now):
+        return {
+            'latency': self.latency,
+            'probe_latency': self.probe_latency,
+            'failures': self.failures,
+            'healthy': now >= self.down_until,
+        }
+
+
+class Endpoints(object):
+    """ Interchangeable hosts for a service, eg. regional or private-link API
+    hosts. Each request goes to the healthy host with the lowest latency,
+    an EWMA (weighted by `alpha`) of its recent requests, or of its health
+    checks until it has served one; hosts that haven't been measured yet are
+    tried first. A host that can't be reached is marked down for
+    `retry_after` seconds and the request is sent to the next host, so
+    failover is transparent to the caller. Only when every host is down is
+    the error raised. Requests whose method isn't `idempotent` fail over
+    only when the connection couldn't be made, as a host that dropped it may
+    have acted on the request:
+
+        >>> endpoints = Endpoints(['eu.api.example.com', 'us.api.example.com'])
+        >>> api = API(creds, endpoints=endpoints)
+        >>> endpoints.start()  # Health checks in the background
+
+    `ws_endpoints` does the same for WebSocket sessions. `hosts` may include
+    ports; otherwise health checks connect to port 443, or 80 when `secure`
+    is false. """
+
+    def __init__(self, hosts, alpha=0.3, retry_after=5.0, secure=True, probe=None,
+                 idempotent=('GET', 'MGET'), clock=time.time):
+        assert hosts, 'At least one host is required'
+        self.alpha = alpha
+        self.idempotent = frozenset(idempotent)
+        self.retry_after = retry_after
+        self.secure = secure
+        self.probe = probe or self.connect
+        self.clock = clock
+        self.errors = failover_errors()
+        self._endpoints = [Endpoint(host) for host in hosts]
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        fork_aware(self)
+
+    def _after_fork(self):
+        # The health check thread isn't forked; call `start` again if needed.
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def hosts(self):
+        return [endpoint.host for endpoint in self._endpoints]
+
+    def ranked(self):
+        """ The hosts in the order they are tried: healthy hosts by latency,
+        then the hosts that are down, the soonest to be retried first. """
+
+        now = self.clock()
+        with self._lock:
+            up = [e for e in self._endpoints if now >= e.down_until]
+            down = [e for e in self._endpoints if now < e.down_until]
+        up.sort(key=self._rank)
+        down.sort(key=lambda e: e.down_until)
+        return [e.host for e in up + down]
+
+    def best(self):
+        return self.ranked()[0]
+
+    def record(self, host, latency, probe=False):
+        """ Records a request's latency (or a health check's, with `probe`),
+        and marks the host healthy. """
+
+        attr = 'probe_latency' if probe else 'latency'
+        with self._lock:
+            endpoint = self._find(host)
+            average = getattr(endpoint, attr)
+            if average is not None:
+                latency = average + self.alpha * (latency - average)
+            setattr(endpoint, attr, latency)
+            endpoint.failures = 0
+            endpoint.down_until = 0
+
+    def fail(self, host):
+        with self._lock:
+            endpoint = self._find(host)
+            endpoint.failures += 1
+            endpoint.down_until = self.clock() + self.retry_after
+        logger.info('Endpoint %s is down, retrying it in %ss', host, self.retry_after)
+
+    def call(self, fn, *args, **kwargs):
+        """ Calls `fn(host, *args, **kwargs)` on the best host, failing over
+        to the next on connection errors. The request's HTTP `method` is
+        passed as a keyword (and not on to `fn`); without one, the request
+        is taken not to be idempotent. """
+
+        idempotent = kwargs.pop('method', None) in self.idempotent
+        error = None
+        for host in self.ranked():
+            start = self.clock()
+            try:
+                res = fn(host, *args, **kwargs)
+            except self.errors as e:
+                self.fail(host)
+                if not idempotent and not connect_failed(e):
+                    raise
+                error = e
+                continue
+            self.record(host, self.clock() - start)
+            return res
+        raise error
+
+    def connect(self, host):
+        """ The default health check: opens a TCP connection to the host. """
+
+        name, _, port = host.rpartition(':')
+        if not name or not port.isdigit():
+            name, port = host, 443 if self.secure else 80
+        socket.create_connection((name, int(port)), timeout=self.retry_after).close()
+
+    def check(self):
+        """ Probes every host once, updating its latency and health. """
+
+        for host in self.hosts:
+            start = self.clock()
+            try:
+                self.probe(host)
+            except Exception:
+                self.fail(host)
+            else:
+                self.record(host, self.clock() - start, probe=True)
+
+    def start(self, interval=10):
+        """ Checks the hosts every `interval` seconds in a daemon thread. """
+
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, args=(interval,))
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def snapshot(self):
+        """ The latency and health of each host, for metrics. """
+
+        now = self.clock()
+        with self._lock:
+            return dict((e.host, e.snapshot(now)) for e in self._endpoints)
+
+    def _run(self, interval):
+        while not self._stop.is_set():
+            self.check()
+            self._stop.wait(interval)
+
+    def _rank(self, endpoint):
+        latency = endpoint.latency
+        if latency is None:
+            latency = endpoint.probe_latency
+        return -1 if latency is None else latency
+
+    def _find(self, host):
+        for endpoint in self._endpoints:
+            if endpoint.host == host:
+                return endpoint
+        raise ValueError('Unknown endpoint: %s' % host)
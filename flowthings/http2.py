@@ -0,0 +1,134 @@
+from __future__ import absolute_import
+import threading
+
+from .utils import api_request, fork_aware, STREAM_CHUNK_SIZE
+
+
+__all__ = ('HTTP2Transport',)
+
+
+class HTTP2Transport(object):
+    """ A request callable, with the same contract as `api_request`, that
+    sends requests over HTTP/2 with httpx. Concurrent requests (eg. from
+    `api.async()`) are multiplexed as streams over at most `max_connections`
+    connections per host; the server's concurrent stream limit and flow
+    control windows are honoured by the HTTP/2 stack, which opens another
+    connection when a connection's streams are used up. Servers that don't
+    negotiate HTTP/2 (through ALPN, so only over https) are spoken to over
+    HTTP/1.1, unless `prior_knowledge` is set, in which case every server is
+    spoken to over HTTP/2, also over plain http. Requests time out after
+    `timeout` seconds. Requires `httpx` with its `http2` extra:
+
+        >>> from flowthings.http2 import HTTP2Transport
+        >>> api = API(creds, request=HTTP2Transport())
+
+    `versions` counts the responses received per HTTP version.
+
+    Before httpcore 0.15 (httpx 0.23), a pool shared between threads can
+    close a connection another thread has just taken, so with those versions
+    each thread gets its own client and `shared` is False. """
+
+    def __init__(self, max_connections=4, timeout=30, prior_knowledge=False):
+        try:
+            import httpx
+            import h2
+        except ImportError:
+            raise NotImplementedError('httpx and h2 are required for HTTP/2, '
+                                      'install httpx[http2]')
+        self._httpx = httpx
+        self.shared = _pool_is_threadsafe()
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.prior_knowledge = prior_knowledge
+        self.versions = {}
+        self._clients = {}
+        self._opened = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        fork_aware(self)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._clients = {}
+        self._opened = []
+
+    def __call__(self, method, url, **kwargs):
+        return api_request(method, url, send=self.send, **kwargs)
+
+    def client(self, verify=True):
+        """ The client for this SSL verification setting: shared, or this
+        thread's own when the pool isn't thread safe. """
+
+        with self._lock:
+            if self.shared:
+                clients = self._clients
+            else:
+                clients = self._local.__dict__.setdefault('clients', {})
+            client = clients.get(verify)
+            if client is None:
+                httpx = self._httpx
+                limits = httpx.Limits(max_connections=self.max_connections,
+                                      max_keepalive_connections=self.max_connections)
+                client = clients[verify] = httpx.Client(http1=not self.prior_knowledge,
+                                                        http2=True, verify=verify,
+                                                        limits=limits,
+                                                        timeout=self.timeout)
+                self._opened.append(client)
+            return client
+
+    def send(self, method, url, params=None, data=None, verify=True, headers=None,
+             stream=False):
+        client = self.client(verify)
+        request = client.build_request(method, url, params=params, content=data,
+                                       headers=headers)
+        res = client.send(request, stream=stream)
+        with self._lock:
+            self.versions[res.http_version] = self.versions.get(res.http_version, 0) + 1
+        return Response(res)
+
+    def close(self):
+        with self._lock:
+            for client in self._opened:
+                client.close()
+            self._opened = []
+            self._clients.clear()
+            self._local = threading.local()
+
+
+def _pool_is_threadsafe():
+    try:
+        import httpcore
+    except ImportError:
+        return True
+    version = getattr(httpcore, '__version__', '')
+    try:
+        return tuple(int(n) for n in version.split('.')[:2]) >= (0, 15)
+    except ValueError:
+        return True
+
+
+class Response(object):
+    """ Presents an httpx response the way `api_request` reads a `requests`
+    one. """
+
+    raw = None
+
+    def __init__(self, res):
+        self._res = res
+        self.status_code = res.status_code
+        self.headers = res.headers
+
+    @property
+    def content(self):
+        return self._res.content
+
+    @property
+    def text(self):
+        return self._res.text
+
+    def iter_content(self, chunk_size=STREAM_CHUNK_SIZE):
+        return self._res.iter_bytes(chunk_size)
+
+    def close(self):
+        self._res.close()
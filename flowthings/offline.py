@@ -0,0 +1,408 @@
+from __future__ import absolute_import
+import os
+import json
+import mmap
+import uuid
+import zlib
+import struct
+import logging
+import threading
+from collections import deque
+
+from .exceptions import FlowThingsError, FlowThingsException, FlowThingsServerError
+from .utils import fork_aware
+
+
+__all__ = ('DropQueue', 'DropWriter')
+
+
+logger = logging.getLogger('flowthings')
+
+HEADER = struct.Struct('<IIQ')
+
+SEGMENT_SUFFIX = '.seg'
+
+
+class Segment(object):
+    """ A preallocated, memory-mapped segment file of framed records. Each
+    record is a `(length, crc32, seq)` header followed by the payload; a
+    zero length marks the end of the written data. """
+
+    def __init__(self, path, size):
+        self.path = path
+        self.first_seq = int(os.path.basename(path)[:-len(SEGMENT_SUFFIX)])
+        self.last_seq = self.first_seq - 1
+        exists = os.path.exists(path)
+        self._file = open(path, 'r+b' if exists else 'w+b')
+        if not exists:
+            self._file.truncate(size)
+        self.size = os.path.getsize(path)
+        self._map = mmap.mmap(self._file.fileno(), self.size)
+        self.offset = 0
+        for seq, _ in self.records():
+            self.last_seq = seq
+
+    def records(self):
+        """ Yields `(seq, payload)` for each intact record, stopping at the
+        end of the data or at a torn write. Updates `offset` as it goes. """
+
+        offset = 0
+        while offset + HEADER.size <= self.size:
+            length, crc, seq = HEADER.unpack_from(self._map, offset)
+            end = offset + HEADER.size + length
+            if length == 0 or end > self.size:
+                break
+            payload = self._map[offset + HEADER.size:end]
+            if zlib.crc32(payload) & 0xffffffff != crc:
+                break
+            offset = end
+            self.offset = max(self.offset, offset)
+            yield seq, payload
+
+    def fits(self, payload):
+        return self.offset + HEADER.size + len(payload) + HEADER.size <= self.size
+
+    def append(self, seq, payload):
+        header = HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff, seq)
+        end = self.offset + len(header) + len(payload)
+        self._map[self.offset:end] = header + payload
+        self.offset = end
+        self.last_seq = seq
+
+    def flush(self):
+        self._map.flush()
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def remove(self):
+        self.close()
+        os.remove(self.path)
+
+
+class DropQueue(object):
+    """ A persistent, append-only queue of drop writes, stored in
+    memory-mapped segment files of `segment_size` bytes in `directory`.
+    Appends are flushed to disk every `fsync_every` records (and on
+    `flush`/`close`); acknowledged sequence numbers are persisted, and fully
+    acknowledged segments are deleted. Records carry an id, and appending an
+    id that is already pending, or among the last `remember` acknowledged
+    (which are persisted with the acknowledgements), is a no-op.
+
+    Only one process may use a queue: in a child forked from the process
+    that opened it, its methods raise `FlowThingsError`, and the child
+    should open the directory again once the parent has closed it. """
+
+    def __init__(self, directory, segment_size=16 * 1024 * 1024, fsync_every=64,
+                 remember=10000):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync_every = fsync_every
+        self._lock = threading.RLock()
+        self._forked = False
+        self._unflushed = 0
+        self._acked = self._read_ack()
+        self._segments = [Segment(os.path.join(directory, name), segment_size)
+                          for name in sorted(os.listdir(directory))
+                          if name.endswith(SEGMENT_SUFFIX)]
+        self._next_seq = max([self._acked] + [s.last_seq for s in self._segments]) + 1
+        self._pending_ids = set(record['id'] for _, record in self.pending())
+        self._acked_ids = deque(maxlen=remember)
+        self._acked_set = set()
+        self._id_log_lines = 0
+        for id in self._read_ids():
+            self._remember(id)
+        fork_aware(self)
+
+    def _after_fork(self):
+        # Appending from both processes would interleave records in the
+        # shared segments, so the child drops its copies of the maps.
+        self._lock = threading.RLock()
+        for segment in self._segments:
+            segment.close()
+        self._segments = []
+        self._forked = True
+
+    def _check(self):
+        if self._forked:
+            raise FlowThingsError('DropQueue for %s was opened before a fork; open it '
+                                  'again in this process' % self.directory)
+
+    def __len__(self):
+        self._check()
+        return self._next_seq - 1 - self._acked
+
+    def append(self, record):
+        """ Appends a record dict, returning its sequence number, or None if
+        a record with the same `id` is already pending. """
+
+        with self._lock:
+            self._check()
+            if record['id'] in self:
+                return None
+            payload = json.dumps(record, separators=(',', ':')).encode('utf-8')
+            if HEADER.size * 2 + len(payload) > self.segment_size:
+                raise FlowThingsError('Record is larger than a queue segment')
+
+            segment = self._segments[-1] if self._segments else None
+            if segment is None or not segment.fits(payload):
+                if segment is not None:
+                    segment.flush()
+                path = os.path.join(self.directory, '%020d%s' % (self._next_seq, SEGMENT_SUFFIX))
+                segment = Segment(path, self.segment_size)
+                self._segments.append(segment)
+
+            seq = self._next_seq
+            segment.append(seq, payload)
+            self._next_seq += 1
+            self._pending_ids.add(record['id'])
+
+            self._unflushed += 1
+            if self._unflushed >= self.fsync_every:
+                self.flush()
+            return seq
+
+    def __contains__(self, id):
+        """ Whether a record id is pending or was recently acknowledged. """
+        with self._lock:
+            self._check()
+            return id in self._pending_ids or id in self._acked_set
+
+    def acked(self, id):
+        with self._lock:
+            self._check()
+            return id in self._acked_set
+
+    def pending(self):
+        """ Yields `(seq, record)` for every unacknowledged record, in
+        order. """
+
+        with self._lock:
+            self._check()
+            segments = list(self._segments)
+            acked = self._acked
+        for segment in segments:
+            if segment.last_seq <= acked:
+                continue
+            for seq, payload in segment.records():
+                if seq > acked:
+                    yield seq, json.loads(payload.decode('utf-8'))
+
+    def ack(self, seq, ids=()):
+        """ Acknowledges every record up to and including `seq`. """
+
+        with self._lock:
+            self._check()
+            if seq <= self._acked:
+                return
+            # The ids go to disk first: after a crash before the sequence is
+            # written, replay skips them instead of sending them again.
+            self._write_ids(ids)
+            self._acked = seq
+            for id in ids:
+                self._pending_ids.discard(id)
+                self._remember(id)
+            self._write_ack(seq)
+            while len(self._segments) > 1 and self._segments[0].last_seq <= seq:
+                self._segments.pop(0).remove()
+
+    def flush(self):
+        with self._lock:
+            self._check()
+            for segment in self._segments[-2:]:
+                segment.flush()
+            self._unflushed = 0
+
+    def close(self):
+        with self._lock:
+            if self._forked:
+                return
+            self.flush()
+            for segment in self._segments:
+                segment.close()
+            self._segments = []
+
+    def _ack_path(self):
+        return os.path.join(self.directory, 'ack')
+
+    def _read_ack(self):
+        try:
+            with open(self._ack_path()) as f:
+                return int(f.read().strip() or 0)
+        except (IOError, OSError, ValueError):
+            return 0
+
+    def _write_ack(self, seq):
+        self._write_atomic(self._ack_path(), str(seq))
+
+    def _write_atomic(self, path, text):
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        getattr(os, 'replace', os.rename)(tmp, path)
+
+    def _remember(self, id):
+        if len(self._acked_ids) == self._acked_ids.maxlen:
+            self._acked_set.discard(self._acked_ids[0])
+        self._acked_ids.append(id)
+        self._acked_set.add(id)
+
+    def _ids_path(self):
+        return os.path.join(self.directory, 'acked-ids')
+
+    def _read_ids(self):
+        try:
+            with open(self._ids_path()) as f:
+                ids = [line.strip() for line in f if line.endswith('\n')]
+        except (IOError, OSError):
+            return []
+        self._id_log_lines = len(ids)
+        return ids[-self._acked_ids.maxlen:]
+
+    def _write_ids(self, ids):
+        """ Appends acknowledged ids to their log, which is compacted to the
+        remembered ones once it grows to twice as many. """
+
+        ids = [str(id) for id in ids]
+        if not ids:
+            return
+        if self._id_log_lines + len(ids) > 2 * self._acked_ids.maxlen:
+            keep = (list(self._acked_ids) + ids)[-self._acked_ids.maxlen:]
+            self._write_atomic(self._ids_path(), ''.join(id + '\n' for id in keep))
+            self._id_log_lines = len(keep)
+            return
+        with open(self._ids_path(), 'a') as f:
+            f.write(''.join(id + '\n' for id in ids))
+            f.flush()
+            os.fsync(f.fileno())
+        self._id_log_lines += len(ids)
+
+
+class DropWriter(object):
+    """ Creates drops, falling back to a `DropQueue` when the platform can't
+    be reached (connection errors and 5xx responses). While anything is
+    queued, or a replay runs, new drops are queued behind it to keep them in
+    order, and `replay` sends the backlog in batches of `batch_size`,
+    acknowledging each batch on disk. Drops the platform rejects (4xx)
+    during replay are passed to `on_reject` and dropped from the queue.
+
+    Records carry a client-side id: a create with an id that is queued, being
+    sent, or among the recently acknowledged is skipped, and a replay after a
+    crash skips records whose ids were acknowledged. A request that timed out
+    after the platform created the drop is still retried, so drops may be
+    created twice. With `id_field`, the id is also sent in that field of the
+    drop, for flows whose consumers deduplicate on it.
+
+        >>> writer = DropWriter(api, DropQueue('/var/lib/gateway/drops'))
+        >>> writer.create(flow_id, {'elems': {'temp': 21}})
+        >>> writer.replay()  # eg. periodically, or when the link comes back
+    """
+
+    RETRYABLE = (IOError, OSError, FlowThingsServerError)
+
+    def __init__(self, api, queue, batch_size=100, on_reject=None, id_field=None):
+        self._api = api
+        self.queue = queue
+        self.batch_size = batch_size
+        self.id_field = id_field
+        self.on_reject = on_reject or self._log_reject
+        self._lock = threading.Lock()
+        self._replay_lock = threading.Lock()
+        self._replaying = False
+        self._sending = set()
+        fork_aware(self)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self._replay_lock = threading.Lock()
+        self._replaying = False
+        self._sending = set()
+
+    def create(self, flow_id, drop, id=None):
+        """ Creates a drop, returning the platform's response, or None if it
+        was queued. `id` is a client-side deduplication key. """
+
+        record = { 'id': id or uuid.uuid4().hex, 'flow': flow_id, 'drop': drop }
+        # The lock only covers the decision, the request is sent outside it.
+        with self._lock:
+            if record['id'] in self._sending or record['id'] in self.queue:
+                return None
+            if self._replaying or len(self.queue):
+                self.queue.append(record)
+                return None
+            self._sending.add(record['id'])
+        try:
+            return self._send(record)
+        except self.RETRYABLE as e:
+            logger.info('Queueing drop for %s: %r', flow_id, e)
+            with self._lock:
+                self.queue.append(record)
+        finally:
+            with self._lock:
+                self._sending.discard(record['id'])
+        return None
+
+    def replay(self):
+        """ Sends queued drops in order until the queue is empty or the
+        platform is unreachable. Returns the number of drops sent. """
+
+        sent = 0
+        with self._replay_lock:
+            with self._lock:
+                self._replaying = True
+            try:
+                while True:
+                    count, interrupted = self._replay_pass()
+                    sent += count
+                    with self._lock:
+                        # Drops queued by creates during the pass are sent
+                        # before creates may go to the platform directly.
+                        if interrupted or not len(self.queue):
+                            self._replaying = False
+                            return sent
+            finally:
+                with self._lock:
+                    self._replaying = False
+
+    def _replay_pass(self):
+        sent = 0
+        batch = []
+        try:
+            for seq, record in self.queue.pending():
+                try:
+                    if not self.queue.acked(record['id']):
+                        self._send(record)
+                        sent += 1
+                except self.RETRYABLE:
+                    raise
+                except FlowThingsException as e:
+                    self.on_reject(record, e)
+                batch.append((seq, record['id']))
+                if len(batch) >= self.batch_size:
+                    self._ack(batch)
+                    batch = []
+        except self.RETRYABLE as e:
+            logger.info('Replay interrupted after %d drops: %r', sent, e)
+            return sent, True
+        finally:
+            if batch:
+                self._ack(batch)
+        return sent, False
+
+    def _send(self, record):
+        drop = record['drop']
+        if self.id_field:
+            drop = dict(drop)
+            drop[self.id_field] = record['id']
+        return self._api.drop(record['flow']).create(drop)
+
+    def _ack(self, batch):
+        self.queue.ack(batch[-1][0], [id for _, id in batch])
+
+    def _log_reject(self, record, e):
+        logger.error('Dropping rejected drop for %s: %r', record['flow'], e)
@@ -1,13 +1,22 @@
 from __future__ import absolute_import
-import websocket
-from copy import copy
 
 from .exceptions import *
-from .utils import default, plat_exception
+from .utils import default, plat_exception, fork_aware, check_fork, on_fork
+from .cache import is_additive, merge_additive
+from .aggregate import LocalAggregation
+from .stream import EnvelopeReader
+from .batching import BatchLoader
+from .endpoints import route
 from .builders import *
+from .builders import member_getter, MISSING, FrozenParams
 from .default import defaults
 import six
+import copy
+import json
+import threading
+from collections import OrderedDict
 from functools import partial
+from datetime import date, datetime, timedelta
 
 
 __all__ = (
@@ -34,19 +43,49 @@ class BaseService(object):
     path = ''
 
     def __init__(self, creds, secure=None, host=None, version=None,
-                 encoder=None, params=None, request=None, verify_ssl=True, **kwargs):
+                 encoder=None, params=None, request=None, verify_ssl=True,
+                 aggregate_cache=None, compression=None, conditional=None,
+                 hedging=None, concurrency=None, priority=None, endpoints=None,
+                 **kwargs):
 
+        self._base_url  = None
         self.creds = creds
         self._secure    = default(secure, defaults.secure)
         self._host      = default(host, defaults.host)
         self._version   = default(version, defaults.version)
         self._encoder   = default(encoder, defaults.encoder)
-        self._params    = default(params, defaults.params)
+        self._params    = FrozenParams(default(params, defaults.params))
+        self._aggregate_cache = default(aggregate_cache, defaults.aggregate_cache)
+        self._compression = default(compression, defaults.compression)
+        self._conditional = default(conditional, defaults.conditional)
+        self._hedging = default(hedging, defaults.hedging)
+        self._concurrency = default(concurrency, defaults.concurrency)
+        self._priority = priority
+        self._endpoints = default(endpoints, defaults.endpoints)
         if verify_ssl:
             self._request   = default(request, defaults.request)
         else:
             self._request = partial(defaults.request, verify_ssl=False)
 
+    @property
+    def creds(self):
+        return self._creds
+
+    @creds.setter
+    def creds(self, creds):
+        self._creds = creds
+        self._base_url = None
+
+    def with_creds(self, creds):
+        """ Returns a copy of the service bound to other credentials. The
+        copy shares its options, transport and caches with this one, but not
+        the state that belongs to the credentials. """
+
+        service = copy.copy(self)
+        service.__dict__.pop('_loader', None)
+        service.creds = creds
+        return service
+
     def request(self, method, path='', data=None, params=None):
         """ A basic request method where you can supply a method, path, data
         and params. This method will parse the platform response and strip
@@ -65,41 +104,160 @@ class BaseService(object):
         raise plat_exception(res, status, creds=self.creds, method=method,
                              path=self.path + path)
 
-    def raw_request(self, method, path='', data=None, params=None):
+    def stream_request(self, method, path='', data=None, params=None):
+        """ Like `request`, but the response is parsed incrementally and the
+        items of the body are yielded one at a time (list elements, or
+        `(key, value)` pairs for objects), so large responses are never held
+        in memory whole. Requires a JSON response and a transport that
+        supports `stream=True`. """
+
+        data = self._mk_data(data)
+        params = self._mk_params(params)
+        chunks, hdr, status = self.raw_request(method, path, data, params, stream=True)
+
+        try:
+            if not 200 <= status < 400:
+                raw = b''.join(chunks).decode('utf-8')
+                raise plat_exception(self._encoder.loads(raw), status, creds=self.creds,
+                                     method=method, path=self.path + path)
+
+            loads = None if self._encoder is json else self._encoder.loads
+            for item in EnvelopeReader(chunks, loads=loads):
+                yield item
+        finally:
+            # Releases the connection when the caller stops early, too.
+            close = getattr(chunks, 'close', None)
+            if close is not None:
+                close()
+
+    def raw_request(self, method, path='', data=None, params=None, stream=False):
         """ A lower level request method that returns the raw response. This
-        doesn't touch the data or params and passes them along as is. """
+        doesn't touch the data or params and passes them along as is. With
+        `stream`, the body is an iterator of byte chunks; a concurrency limit
+        is only held until the response headers arrive. """
 
+        check_fork()
         url = self._mk_url(path)
+        limiter = self._concurrency
+        if limiter is not None:
+            if self._priority is not None:
+                limiter = limiter.lane(self._priority)
+            return limiter.call(self._send, method, url, data, params, stream)
+        return self._send(method, url, data, params, stream)
+
+    def _send(self, method, url, data, params, stream=False):
+        if self._endpoints is not None:
+            return self._endpoints.call(self._send_to, method, url, data, params, stream,
+                                        method=method)
+        return self._send_to(None, method, url, data, params, stream)
+
+    def _send_to(self, host, method, url, data, params, stream=False):
+        if host is not None:
+            url = route(url, host)
+        options = self._transport_options(stream)
+        if self._hedging is not None and method in self._hedging.methods:
+            if stream:
+                return self._hedging.call_discarding(_close_stream, self._request, method,
+                                                     url, data=data, params=params,
+                                                     creds=self.creds, **options)
+            return self._hedging.call(self._request, method, url, data=data, params=params,
+                                      creds=self.creds, **options)
         return self._request(method, url, data=data, params=params,
-                             creds=self.creds)
+                             creds=self.creds, **options)
+
+    def _transport_options(self, stream=False):
+        """ Optional transport arguments, only passed along when set so that
+        custom transports needn't accept them. """
+
+        options = {}
+        if stream:
+            options['stream'] = True
+        if self._compression is not None:
+            options['compression'] = self._compression
+        if self._conditional is not None:
+            options['conditional'] = self._conditional
+        return options
 
 
     def _mk_url(self, path):
-        return '%s://%s/v%s/%s%s%s' % (
+        base = self._base_url
+        if base is None:
+            base = self._base_url = self._mk_base_url()
+        return base + path
+
+    def _mk_base_url(self):
+        return '%s://%s/v%s/%s%s' % (
             'https' if self._secure else 'http',
             self._host,
             self._version,
             self.creds.account,
-            self.path,
-            path)
+            self.path)
 
     def _mk_data(self, data):
         return self._encoder.dumps(data) if data is not None else None
 
     def _mk_params(self, params):
-        p = copy(self._params)
-        if params is not None:
-            if not isinstance(params, dict):
-                params = params.to_dict()
-            p.update(params)
+        if params is None:
+            return self._params
+        if not isinstance(params, dict):
+            params = params.to_dict()
+        if not self._params:
+            return params
+        if not params:
+            return self._params
+        p = dict(self._params)
+        p.update(params)
         return p
 
 
+def _close_stream(res):
+    close = getattr(res[0], 'close', None)
+    if close is not None:
+        close()
+
+
+def mk_params(kwargs):
+    """ Builds request params from keyword arguments, skipping the builder
+    entirely when there are none. """
+
+    return P(**kwargs) if kwargs else None
+
+
+_loader_lock = threading.Lock()
+
+
+@on_fork
+def _reset_loader_lock():
+    global _loader_lock
+    _loader_lock = threading.Lock()
+
+
 class FindableServiceMixin(object):
     """ A mixin to support various retrieval methods. """
 
+    batch_window = 0.002
+
     def read(self, id, **kwargs):
-        return self.request('GET', '/' + id, params=P(**kwargs))
+        return self.request('GET', '/' + id, params=mk_params(kwargs))
+
+    def read_batched(self, id, **kwargs):
+        """ Like `read`, but reads made at about the same time from other
+        threads or greenlets (eg. through `api.async()`) are sent together as
+        one MGET. Missing ids raise `FlowThingsNotFound`. """
+
+        return self.loader.load(id, **kwargs)
+
+    @property
+    def loader(self):
+        """ The `BatchLoader` behind `read_batched`. """
+
+        loader = self.__dict__.get('_loader')
+        if loader is None:
+            with _loader_lock:
+                loader = self.__dict__.get('_loader')
+                if loader is None:
+                    loader = self._loader = BatchLoader(self, self.batch_window)
+        return loader
 
     def read_or_else(self, id, default=None, **kwargs):
         """ Supply a default value instead of throwing a FlowThingsNotFound
@@ -111,11 +269,17 @@ class FindableServiceMixin(object):
         except FlowThingsNotFound:
             return default
 
+    def read_tracked(self, id, **kwargs):
+        """ Reads a resource wrapped in a `Tracked` model, so that saving it
+        only sends the fields that were changed. """
+
+        return Tracked(self.read(id, **kwargs))
+
     def read_many(self, ids, **kwargs):
         """ Make an MGET query to the platform to return multiple resources
         at the same time. This returns a map of id -> resource. """
 
-        return self.request('MGET', data=ids, params=P(**kwargs))
+        return self.request('MGET', data=ids, params=mk_params(kwargs))
 
     def find_many(self, *args, **kwargs):
         """ Make a parameterized search. Args are assumed to be filters. """
@@ -126,6 +290,22 @@ class FindableServiceMixin(object):
             params = P(**kwargs)
         return self.request('GET', params=params)
 
+    def read_many_iter(self, ids, **kwargs):
+        """ A streaming `read_many`, yielding `(id, resource)` pairs as they
+        are parsed from the response. """
+
+        return self.stream_request('MGET', data=ids, params=mk_params(kwargs))
+
+    def find_iter(self, *args, **kwargs):
+        """ A streaming `find_many`, yielding resources one at a time as they
+        are parsed from the response. """
+
+        if len(args):
+            params = P(filter=args, **kwargs)
+        else:
+            params = mk_params(kwargs)
+        return self.stream_request('GET', params=params)
+
     def find(self, *args, **kwargs):
         """ Overloaded find method that intuitively calls the correct method
         based upon the type of the first argument. """
@@ -144,36 +324,40 @@ class FindableServiceMixin(object):
         return self.find_many(*args, **kwargs)
 
 
+def split_changes(model):
+    """ Returns the id and the payload to send for a model or Modify|M. A
+    Modify only reports its changes, without building the merged model. """
+
+    if isinstance(model, Modify):
+        return model['id'], model.diff()
+    return model['id'], model
+
+
 class SaveableServiceMixin(object):
     """ A mixin to support saving and updating. """
 
     def create(self, model, **kwargs):
-        return self.request('POST', data=model, params=P(**kwargs))
+        return self.request('POST', data=model, params=mk_params(kwargs))
 
     def update(self, model, **kwargs):
         """ If the provided model is an instance of `Modify|M` it will pull
         out the changes and only send what was changed. Otherwise, it will just
         send the entire payload. """
 
-        if isinstance(model, Modify):
-            model, changes = model.done()
-        else:
-            changes = model
-        return self.request('PUT', '/' + model['id'], data=changes,
-                            params=P(**kwargs))
+        id, changes = split_changes(model)
+        return self.request('PUT', '/' + id, data=changes,
+                            params=mk_params(kwargs))
 
     def update_many(self, models, **kwargs):
         """ Given a list of models or Modify|M instances, issues a bulk update
-        using MPUT. """
+        using MPUT. Tracked models without changes are left out. """
 
         data = {}
         for model in models:
-            if isinstance(model, Modify):
-                model, changes = model.done()
-            else:
-                changes = model
-            data[model['id']] = changes
-        return self.request('MPUT', data=data, params=P(**kwargs))
+            id, changes = split_changes(model)
+            if changes or not isinstance(model, Tracked):
+                data[id] = changes
+        return self.request('MPUT', data=data, params=mk_params(kwargs))
 
     def save(self, model, *args, **kwargs):
         """ Overloaded persistance method that intuitively calls the correct
@@ -190,13 +374,24 @@ class DestroyableServiceMixin(object):
     """ A mixin to support deletion. """
 
     def delete(self, id, data=None, **kwargs):
-        return self.request('DELETE', '/' + id, data=data, params=P(**kwargs))
+        return self.request('DELETE', '/' + id, data=data, params=mk_params(kwargs))
 
 
 class AggregateServiceMixin(object):
     """ A mixin to support aggregation. """
 
-    def aggregate(self, output, group_by=None, filter=None, rules=None, sorts=None):
+    watermark_page = 10
+
+    def aggregate(self, output, group_by=None, filter=None, rules=None, sorts=None,
+                  incremental=False):
+        """ Runs an aggregation on the platform. When the service has an
+        `AggregateCache`, results are reused within its TTL. With
+        `incremental` set, outputs that can simply be added (`$count`,
+        `$sum`) are aggregated up to the newest drop's `creationDate`, and an
+        expired result is updated by aggregating only the drops created after
+        it. The cutoff comes from the platform, so the client's clock doesn't
+        matter. """
+
         data = { 'output': output }
         if group_by is not None:
             data['groupBy'] = group_by
@@ -206,7 +401,61 @@ class AggregateServiceMixin(object):
             data['rules'] = dict([(k, str(v)) for k, v in six.iteritems(rules)])
         if sorts is not None:
             data['sorts'] = sorts
-        return self.request('POST', '/aggregate', data, None)
+
+        cache = self._aggregate_cache
+        if cache is None:
+            return self.request('POST', '/aggregate', data, None)
+
+        account = self.creds.account
+        key = cache.key(data)
+        entry = cache.get(account, self.path, key)
+        if entry is not None:
+            return entry[0]
+
+        now = cache.clock()
+        if not (incremental and is_additive(output)):
+            result = self.request('POST', '/aggregate', data, None)
+            cache.set(account, self.path, key, result, now)
+            return result
+
+        entry = cache.get(account, self.path, key, fresh=False)
+        previous = entry[2] if entry is not None else None
+        watermark = self._newest_creation_date()
+        if previous is not None and watermark == previous:
+            result = entry[0]
+        elif previous is not None and watermark is not None:
+            since = (mem.creationDate > previous).AND(mem.creationDate <= watermark)
+            result = merge_additive(output, entry[0],
+                                    self.request('POST', '/aggregate', self._within(data, since), None))
+        elif watermark is not None:
+            result = self.request('POST', '/aggregate',
+                                  self._within(data, mem.creationDate <= watermark), None)
+        else:
+            result = self.request('POST', '/aggregate', data, None)
+
+        cache.set(account, self.path, key, result, now, watermark)
+        return result
+
+    def _newest_creation_date(self):
+        # The platform lists drops newest first; the max over the first page
+        # doesn't depend on how drops created in the same instant are listed.
+        dates = [d['creationDate'] for d in self.find_many(limit=self.watermark_page)
+                 if d.get('creationDate') is not None]
+        return max(dates) if dates else None
+
+    def _within(self, data, bound):
+        data = dict(data)
+        data['filter'] = str(bound) if 'filter' not in data else \
+            '(%s) && (%s)' % (data['filter'], bound)
+        return data
+
+    def _invalidate_aggregates(self):
+        if self._aggregate_cache is not None:
+            self._aggregate_cache.invalidate(self.path)
+
+    def _expire_aggregates(self, path):
+        if self._aggregate_cache is not None:
+            self._aggregate_cache.expire(path)
 
 
 class FullServiceMixin(FindableServiceMixin,
@@ -237,6 +486,11 @@ class AbstractServiceFactory(object):
         args = [self.creds] + self._args
         return self.service_class(context, *args, **self._kwargs)
 
+    def with_creds(self, creds):
+        factory = copy.copy(self)
+        factory.creds = creds
+        return factory
+
 
 class IdentityService(BaseService, FullServiceMixin):
     path = '/identity'
@@ -275,45 +529,163 @@ class DropService(BaseService, FullServiceMixin, AggregateServiceMixin):
         self.path = '/drop/' + flow_id
         BaseService.__init__(self, *args, **kwargs)
 
+    def create(self, model, **kwargs):
+        drop = FullServiceMixin.create(self, model, **kwargs)
+        # New drops don't change what earlier results count, so incremental
+        # aggregations can still build on them.
+        self._expire_aggregates(self.path)
+        return drop
+
+    def update(self, model, **kwargs):
+        self._invalidate_aggregates()
+        return FullServiceMixin.update(self, model, **kwargs)
+
+    def update_many(self, models, **kwargs):
+        self._invalidate_aggregates()
+        return FullServiceMixin.update_many(self, models, **kwargs)
+
+    def delete(self, id, data=None, **kwargs):
+        self._invalidate_aggregates()
+        return FullServiceMixin.delete(self, id, data, **kwargs)
+
     def delete_all(self):
+        self._invalidate_aggregates()
         return self.request('DELETE', '')
 
+    def pages(self, *filters, **kwargs):
+        """ Generates successive pages of `find_many` results, `chunk_size`
+        drops at a time, until the flow is exhausted. """
+
+        chunk_size = kwargs.pop('chunk_size', 1000)
+        start = kwargs.pop('start', 0)
+        kwargs.pop('refs', None)
+
+        while True:
+            page = self.find_many(*filters, start=start, limit=chunk_size, **kwargs)
+            if page:
+                yield page
+            if len(page) < chunk_size:
+                break
+            start += len(page)
+
+    def export(self, writer, *filters, **kwargs):
+        """ Pages through the flow and streams the selected fields into a
+        columnar writer (see `flowthings.columnar`), one chunk at a time, so
+        memory stays bounded by `chunk_size`. Fields are member paths, taken
+        from `fields` or else the `only` param, and are also sent as `only`
+        so the platform returns nothing else. Returns `writer.close()`. """
+
+        fields = kwargs.pop('fields', None)
+        only = kwargs.pop('only', None)
+
+        if fields is None and only is not None:
+            fields = only.split(',') if isinstance(only, six.string_types) else only
+        if not fields:
+            raise FlowThingsError('Export requires a list of fields')
+
+        fields = [str(f) for f in fields]
+        getters = [member_getter(f) for f in fields]
+
+        writer.open(fields)
+        for page in self.pages(*filters, only=fields, **kwargs):
+            writer.write([[None if v is MISSING else v
+                           for v in map(get, page)] for get in getters])
+        return writer.close()
+
+    def aggregate_local(self, output, group_by=None, filter=None, rules=None,
+                        sorts=None, processes=None, chunk_size=1000, **kwargs):
+        """ Computes an aggregation client-side with the same arguments as
+        `aggregate`, for rollups the platform can't express or that are too
+        large for it. The filter is still applied by the platform while
+        paging; rules and outputs are reduced locally in a process pool. """
+
+        agg = LocalAggregation(output, group_by, rules, sorts)
+        filters = [filter] if filter is not None else []
+        return agg.reduce(self.pages(*filters, chunk_size=chunk_size, **kwargs),
+                          processes)
+
 
 class DropServiceFactory(BaseService, AbstractServiceFactory):
+    """ Binds drop services to flow ids. The most recently used `cache_size`
+    services are kept and reused, until the credentials change. """
+
     path = '/drop'
     service_class = DropService
+    cache_size = 128
 
     def __init__(self, *args, **kwargs):
+        self._services = OrderedDict()
+        self._lock = threading.Lock()
         BaseService.__init__(self, *args, **kwargs)
         AbstractServiceFactory.__init__(self, *args, **kwargs)
+        fork_aware(self)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    @property
+    def creds(self):
+        return self._creds
+
+    @creds.setter
+    def creds(self, creds):
+        BaseService.creds.fset(self, creds)
+        with self._lock:
+            self._services.clear()
+
+    def with_creds(self, creds):
+        service = copy.copy(self)
+        service._services = OrderedDict()
+        service._lock = threading.Lock()
+        service.creds = creds
+        return fork_aware(service)
+
+    def __call__(self, flow_id):
+        with self._lock:
+            service = self._services.pop(flow_id, None)
+            if service is None:
+                service = AbstractServiceFactory.__call__(self, flow_id)
+                if len(self._services) >= self.cache_size:
+                    self._services.popitem(last=False)
+            self._services[flow_id] = service
+        return service
 
     def create(self, model, **kwargs):
-        return self.request('POST', data=model, params=P(**kwargs))
+        drop = self.request('POST', data=model, params=mk_params(kwargs))
+        flow_id = drop.get('flowId') if isinstance(drop, dict) else None
+        if self._aggregate_cache is not None:
+            self._aggregate_cache.expire('/drop/' + flow_id if flow_id else None)
+        return drop
 
 
 class TokenService(BaseService, FindableServiceMixin, DestroyableServiceMixin):
     path = '/token'
 
     def create(self, model, **kwargs):
-        return self.request('POST', data=model, params=P(**kwargs))
+        return self.request('POST', data=model, params=mk_params(kwargs))
 
 
 class ShareService(BaseService, FindableServiceMixin, DestroyableServiceMixin):
     path = '/share'
 
     def create(self, model, **kwargs):
-        return self.request('POST', data=model, params=P(**kwargs))
+        return self.request('POST', data=model, params=mk_params(kwargs))
+
+
+def statistic_path(name, id, year=None, month=None, day=None):
+    path = '/%s/%s' % (name, id)
+    if year is not None:
+        path += '/%s' % year
+        if month is not None:
+            path += '/%s' % month
+            if day is not None:
+                path += '/%s' % day
+    return path
 
 
 def statistic(name):
     def method(self, id, year=None, month=None, day=None, level=None):
-        path = '/%s/%s' % (name, id)
-        if year is not None:
-            path += '/%s' % year
-            if month is not None:
-                path += '/%s' % month
-                if day is not None:
-                    path += '/%s' % day
+        path = statistic_path(name, id, year, month, day)
         if level is not None:
             params = { 'level': level }
         else:
@@ -322,8 +694,59 @@ def statistic(name):
     return method
 
 
+def plan_periods(start, end):
+    """ Covers the inclusive date range with the fewest year, month and day
+    periods, returned as `(year,)`, `(year, month)` and `(year, month, day)`
+    tuples in chronological order. """
+
+    periods = []
+    d = start
+    while d <= end:
+        if d.month == 1 and d.day == 1 and date(d.year, 12, 31) <= end:
+            periods.append((d.year,))
+            d = date(d.year + 1, 1, 1)
+            continue
+        next_month = date(d.year + d.month // 12, d.month % 12 + 1, 1)
+        if d.day == 1 and next_month - timedelta(days=1) <= end:
+            periods.append((d.year, d.month))
+            d = next_month
+            continue
+        periods.append((d.year, d.month, d.day))
+        d += timedelta(days=1)
+    return periods
+
+
+def period_end(period):
+    if len(period) == 1:
+        return date(period[0], 12, 31)
+    if len(period) == 2:
+        year, month = period
+        return date(year + month // 12, month % 12 + 1, 1) - timedelta(days=1)
+    return date(*period)
+
+
+def flatten_statistic(period, body):
+    """ Flattens a statistics body into `(period, value)` pairs. Bodies
+    broken down by `level` are maps of sub-period (eg. day or hour) to value,
+    which extend the period. """
+
+    if not isinstance(body, dict):
+        return [(period, body)]
+    items = []
+    for key, value in body.items():
+        if isinstance(key, six.string_types) and key.isdigit():
+            key = int(key)
+        items.extend(flatten_statistic(period + (key,), value))
+    return items
+
+
+def period_order(item):
+    return [(isinstance(p, six.string_types), p) for p in item[0]]
+
+
 class StatisticsService(BaseService):
     path = '/statistics'
+    cache_size = 4096
 
     flowDropAdded = statistic('flowDropAdded')
     flowTracked = statistic('flowTracked')
@@ -338,6 +761,76 @@ class StatisticsService(BaseService):
     api_call_by_identity = statistic('apiCallByIdentity')
     drop_created_by = statistic('dropCreatedBy')
 
+    def __init__(self, *args, **kwargs):
+        BaseService.__init__(self, *args, **kwargs)
+        self._cache = OrderedDict()
+
+    def with_creds(self, creds):
+        service = BaseService.with_creds(self, creds)
+        service._cache = OrderedDict()
+        return service
+
+    def range(self, name, ids, start_date, end_date=None, level=None, threads=8):
+        """ Fetches a statistic for many ids over a date range. The range is
+        covered with the fewest year/month/day requests, which are made
+        concurrently over pooled connections. Periods that ended before today
+        can no longer change, so the `cache_size` most recently used are
+        cached on the service. Returns a map of id -> time series, a list of
+        `(period, value)` in chronological order, where period is a
+        `(year[, month[, day[, ...]]])` tuple as fine as `level`. """
+
+        if '_' in name:
+            head, tail = name.split('_', 1)
+            name = head + ''.join(p.title() for p in tail.split('_'))
+        if isinstance(start_date, datetime):
+            start_date = start_date.date()
+        if isinstance(end_date, datetime):
+            end_date = end_date.date()
+        today = datetime.utcnow().date()
+        end_date = default(end_date, today)
+        if isinstance(ids, six.string_types):
+            ids = [ids]
+
+        periods = plan_periods(start_date, end_date)
+        # Keyed by the credentials too, as `API.creds` can be swapped.
+        keys = [(name, id, period, level, self.creds) for id in ids for period in periods]
+        results = {}
+        for key in keys:
+            body = self._cache.pop(key, MISSING)
+            if body is not MISSING:
+                results[key] = self._cache[key] = body
+        missing = [k for k in keys if k not in results]
+
+        def fetch(key):
+            name, id, period, level, _ = key
+            params = { 'level': level } if level is not None else None
+            return self.request('GET', statistic_path(name, id, *period), None, params)
+
+        if missing:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(min(threads, len(missing)))
+            try:
+                bodies = pool.map(fetch, missing)
+            finally:
+                pool.close()
+                pool.join()
+            for key, body in zip(missing, bodies):
+                results[key] = body
+                if period_end(key[2]) < today:
+                    self._cache[key] = body
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+        series = dict((id, []) for id in ids)
+        for key in keys:
+            series[key[1]].extend(flatten_statistic(key[2], results[key]))
+        for items in series.values():
+            items.sort(key=period_order)
+        return series
+
+    def clear_cache(self):
+        self._cache.clear()
+
 
 class WebSocketService(BaseService):
     path = '/session'
@@ -345,22 +838,33 @@ class WebSocketService(BaseService):
     def __init__(self, *args, **kwargs):
         super(WebSocketService, self).__init__(*args, **kwargs)
         self._host = default(kwargs.get('ws_host'), defaults.ws_host)
+        self._endpoints = default(kwargs.get('ws_endpoints'), defaults.ws_endpoints)
 
     def connect(self, **kwargs):
-        session = self.request('POST')
+        if self._endpoints is None:
+            return self._connect(self._host, kwargs)
+        # The socket must go to the host that made the session, so the
+        # session request is pinned to one host at a time.
+        return self._endpoints.call(self._connect, kwargs, method='POST')
+
+    def _connect(self, host, kwargs):
+        service = copy.copy(self)
+        service._host = host
+        service._base_url = None
+        service._endpoints = None
+        session = service.request('POST')
         ws_url = '%s://%s%s/%s/ws' % (
             'wss' if self._secure else 'ws',
-            self._host,
+            host,
             self.path,
             session['id'])
         return WebSocketClient(ws_url, self._encoder, **kwargs)
 
-    def _mk_url(self, path):
-        return '%s://%s%s%s' % (
+    def _mk_base_url(self):
+        return '%s://%s%s' % (
             'https' if self._secure else 'http',
             self._host,
-            self.path,
-            path)
+            self.path)
 
 
 class WebSocketClient(object):
@@ -372,9 +876,12 @@ class WebSocketClient(object):
         self.on_error   = on_error
         self.on_message = on_message
 
+        import websocket
+
         self._encoder   = encoder
         self._reply_id  = 0
         self._reply_cbs = {}
+        self._lock      = threading.Lock()
         self._app = websocket.WebSocketApp(url,
                                            on_open=self._on_open,
                                            on_close=self._on_close,
@@ -404,11 +911,25 @@ class WebSocketClient(object):
         self.send(data, callback)
 
     def send(self, data, callback=None):
+        self._send(data, callback, False)
+
+    def call(self, data, callback):
+        """ Like `send`, but the callback gets the whole reply, including its
+        head, so that errors can be told apart. Safe to call from many
+        threads at once. """
+
+        self._send(data, callback, True)
+
+    def close(self):
+        self._app.close()
+
+    def _send(self, data, callback, whole):
         if callable(callback):
-            rid = self._reply_id
+            with self._lock:
+                rid = self._reply_id
+                self._reply_id += 1
+                self._reply_cbs[rid] = (callback, whole)
             data['msgId'] = rid
-            self._reply_id += 1
-            self._reply_cbs[rid] = callback
         self._app.send(self._encoder.dumps(data))
 
     def _on_open(self, ws):
@@ -427,7 +948,8 @@ class WebSocketClient(object):
             self.on_message(self, data['resource'], data['value'])
 
         elif 'head' in data:
-            rid = data['head']['msgId']
-            if rid in self._reply_cbs:
-                self._reply_cbs[rid](self, data['body'])
-                del self._reply_cbs[rid]
+            with self._lock:
+                reply = self._reply_cbs.pop(data['head'].get('msgId'), None)
+            if reply is not None:
+                callback, whole = reply
+                callback(self, data if whole else data['body'])
@@ -0,0 +1,126 @@
+from __future__ import absolute_import
+import json
+import codecs
+
+from .exceptions import FlowThingsError
+
+
+__all__ = ('EnvelopeReader',)
+
+
+WHITESPACE = ' \t\n\r'
+
+
+class EnvelopeReader(object):
+    """ Incrementally parses a platform `{head, body}` response from an
+    iterable of byte chunks. Iterating yields the items of the body one at a
+    time: the elements of a list, `(key, value)` pairs of an object (as for
+    MGET), or a single scalar. Only the item being parsed is buffered, never
+    the whole response. `head` is set once it has been read. With `loads`
+    (eg. a service encoder's), each value is decoded by it from its JSON
+    text. """
+
+    def __init__(self, chunks, encoding='utf-8', loads=None):
+        self.head = None
+        self._loads = loads
+        self._chunks = iter(chunks)
+        self._decoder = codecs.getincrementaldecoder(encoding)()
+        self._json = json.JSONDecoder()
+        self._buf = u''
+        self._pos = 0
+        self._eof = False
+
+    def __iter__(self):
+        self._expect('{')
+        while True:
+            c = self._peek()
+            if c == '}':
+                self._pos += 1
+                return
+            key = self._value()
+            self._expect(':')
+            if key == 'body':
+                for item in self._body():
+                    yield item
+            else:
+                value = self._value()
+                if key == 'head':
+                    self.head = value
+            if self._peek() == ',':
+                self._pos += 1
+
+    def _body(self):
+        c = self._peek()
+        if c not in '[{':
+            yield self._value()
+            return
+
+        close = ']' if c == '[' else '}'
+        self._pos += 1
+        if self._peek() == close:
+            self._pos += 1
+            return
+        while True:
+            if close == '}':
+                key = self._value()
+                self._expect(':')
+                yield (key, self._value())
+            else:
+                yield self._value()
+            c = self._peek()
+            self._pos += 1
+            if c == close:
+                return
+            if c != ',':
+                raise FlowThingsError('Malformed response body')
+
+    def _fill(self):
+        """ Reads at least one more chunk, dropping what was consumed. """
+
+        if self._eof:
+            return False
+        self._buf = self._buf[self._pos:]
+        self._pos = 0
+        size = len(self._buf)
+        for chunk in self._chunks:
+            self._buf += self._decoder.decode(chunk)
+            # Keep reading until the buffer has at least doubled, so that
+            # values spanning many chunks aren't re-parsed chunk by chunk.
+            if len(self._buf) >= max(2 * size, size + 1):
+                return True
+        self._buf += self._decoder.decode(b'', final=True)
+        self._eof = True
+        return len(self._buf) > size
+
+    def _peek(self):
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                raise FlowThingsError('Unexpected end of response')
+
+    def _expect(self, c):
+        if self._peek() != c:
+            raise FlowThingsError('Malformed response, expected %r' % c)
+        self._pos += 1
+
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self._json.raw_decode(self._buf, self._pos)
+            except ValueError:
+                if not self._fill():
+                    raise FlowThingsError('Malformed response value')
+                continue
+            # A number ending the buffer may continue in the next chunk.
+            if end == len(self._buf) and not self._eof:
+                if self._fill():
+                    continue
+                value, end = self._json.raw_decode(self._buf, self._pos)
+            if self._loads is not None:
+                value = self._loads(self._buf[self._pos:end])
+            self._pos = end
+            return value
@@ -0,0 +1,501 @@
+""" An in-process fake of the flowthings platform, for tests and benchmarks
+that need a real HTTP and WebSocket endpoint without network access:
+
+    >>> from flowthings.testing import FakeServer
+    >>> with FakeServer(latency=0.005) as server:
+    ...     api = server.api()
+    ...     flow = api.flow.create({'path': '/acc/sensors'})
+    ...     api.drop(flow['id']).create({'elems': {'temp': 21}})
+
+Resources are kept in memory. Responses use the platform `{head, body}`
+envelope, and MGET, MPUT, drops, aggregation and WebSocket sessions are
+supported. Filters are not evaluated, except the `creationDate` bounds of
+aggregations. Latency and errors can be injected,
+and every request is recorded in `log`.
+"""
+
+from __future__ import absolute_import
+import re
+import json
+import time
+import zlib
+import base64
+import random
+import socket
+import struct
+import hashlib
+import operator
+import threading
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_tz, mktime_tz
+
+from six.moves.BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from six.moves.socketserver import ThreadingMixIn
+from six.moves.urllib.parse import urlsplit, parse_qsl
+
+from .builders import Token
+
+
+__all__ = ('FakePlatform', 'FakeServer')
+
+
+WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+CREATION_BOUND = re.compile(r'creationDate\s*(>=|<=|>|<)\s*(\d+)')
+
+COMPARISONS = {
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+}
+
+WS_OBJECTS = {
+    'drop'    : 'drop',
+    'flow'    : 'flow',
+    'track'   : 'track',
+    'group'   : 'group',
+    'identity': 'identity',
+    'device'  : 'device',
+}
+
+WS_METHODS = {
+    'create'  : 'POST',
+    'find'    : 'GET',
+    'findmany': 'GET',
+    'update'  : 'PUT',
+    'delete'  : 'DELETE',
+}
+
+API_PATH = re.compile(r'^/v[^/]+/([^/]+)(/.*)$')
+
+
+def envelope(status, body=None, errors=None):
+    return {
+        'head': {
+            'ok': 200 <= status < 400,
+            'status': status,
+            'errors': errors or [],
+            'messages': [],
+            'references': {},
+        },
+        'body': body,
+    }
+
+
+class FakePlatform(object):
+    """ The in-memory resource store behind a `FakeServer`. `handle` takes a
+    request and returns `(status, envelope)`. Resources of each service path
+    (eg. `/flow`, `/drop/f1`) are kept in insertion order, and listed in
+    it, except drops, which the platform lists newest first. Aggregations
+    apply the `creationDate` bounds of their filter, and ignore the rest. """
+
+    def __init__(self):
+        self.resources = {}
+        self.modified = {}
+        self.sessions = set()
+        self._ids = 0
+        self._lock = threading.RLock()
+        self._listeners = []
+
+    def listen(self, callback):
+        """ Calls `callback(flow_id, drop)` whenever a drop is created. """
+        self._listeners.append(callback)
+
+    def unlisten(self, callback):
+        if callback in self._listeners:
+            self._listeners.remove(callback)
+
+    def handle(self, method, path, params=None, data=None):
+        params = params or {}
+        if path == '/session' and method == 'POST':
+            with self._lock:
+                session = { 'id': self._mk_id('s') }
+                self.sessions.add(session['id'])
+            return 200, envelope(200, session)
+
+        route = self.route(path)
+        if route is None:
+            return 404, envelope(404, errors=['Unknown path'])
+        base, rest = route
+
+        with self._lock:
+            if base == '/drop':
+                status, res = self._create_drop_by_path(data)
+                if status == 200:
+                    self.modified['/drop/' + res['body']['flowId']] = time.time()
+                return status, res
+            if rest == ['aggregate'] and method == 'POST':
+                return self._aggregate(base, data)
+            if method not in ('GET', 'MGET'):
+                self.modified[base] = time.time()
+            if len(rest) > 1:
+                return 404, envelope(404, errors=['Unknown path'])
+            id = rest[0] if rest else None
+            return self._crud(method, base, id, params, data)
+
+    def route(self, path):
+        """ Splits an API path into the service path and the rest. """
+
+        match = API_PATH.match(path)
+        if not match:
+            return None
+        parts = match.group(2).rstrip('/').split('/')[1:]
+        if parts[0] == 'drop' and len(parts) >= 2:
+            return '/drop/' + parts[1], parts[2:]
+        return '/' + parts[0], parts[1:]
+
+    def last_modified(self, path):
+        """ When anything under the service path of `path` last changed. """
+
+        route = self.route(path)
+        return self.modified.get(route[0], 0) if route else 0
+
+    def _crud(self, method, base, id, params, data):
+        items = self.resources.setdefault(base, OrderedDict())
+
+        if method == 'GET' and id is None:
+            start = int(params.get('start', 0))
+            limit = int(params.get('limit', 20))
+            listed = list(items.values())
+            if base.startswith('/drop/'):
+                listed.reverse()
+            return 200, envelope(200, listed[start:start + limit])
+        if method == 'GET':
+            if id not in items:
+                return 404, envelope(404, errors=['Not found'])
+            return 200, envelope(200, items[id])
+        if method == 'MGET':
+            return 200, envelope(200, dict((i, items[i]) for i in data or [] if i in items))
+        if method == 'POST' and id is None:
+            return 200, envelope(200, self._create(base, data))
+        if method == 'PUT' and id is not None:
+            if id not in items:
+                return 404, envelope(404, errors=['Not found'])
+            items[id].update(data or {})
+            items[id]['id'] = id
+            return 200, envelope(200, items[id])
+        if method == 'MPUT':
+            updated = {}
+            for i, changes in (data or {}).items():
+                if i in items:
+                    items[i].update(changes)
+                    updated[i] = items[i]
+            return 200, envelope(200, updated)
+        if method == 'DELETE' and id is None and base.startswith('/drop/'):
+            items.clear()
+            return 200, envelope(200, {})
+        if method == 'DELETE' and id is not None:
+            if items.pop(id, None) is None:
+                return 404, envelope(404, errors=['Not found'])
+            return 200, envelope(200, {})
+        return 400, envelope(400, errors=['Unsupported request'])
+
+    def _create(self, base, data):
+        model = dict(data or {})
+        prefix = base.split('/')[1][0]
+        model['id'] = self._mk_id(prefix)
+        model.setdefault('creationDate', int(time.time() * 1000))
+        if base.startswith('/drop/'):
+            model['flowId'] = base[len('/drop/'):]
+        self.resources.setdefault(base, OrderedDict())[model['id']] = model
+        if base.startswith('/drop/'):
+            for listener in list(self._listeners):
+                listener(model['flowId'], model)
+        return model
+
+    def _create_drop_by_path(self, data):
+        path = (data or {}).get('path')
+        for flow in self.resources.get('/flow', {}).values():
+            if flow.get('path') == path:
+                return 200, envelope(200, self._create('/drop/' + flow['id'], data))
+        return 404, envelope(404, errors=['No flow at %s' % path])
+
+    def _aggregate(self, base, data):
+        from .aggregate import LocalAggregation
+        data = data or {}
+        agg = LocalAggregation(data.get('output', '$count'), data.get('groupBy'),
+                               sorts=data.get('sorts'))
+        drops = list(self.resources.get(base, {}).values())
+        for op, bound in CREATION_BOUND.findall(data.get('filter') or ''):
+            drops = [d for d in drops if COMPARISONS[op](d.get('creationDate', 0), int(bound))]
+        return 200, envelope(200, agg.reduce([drops], processes=1))
+
+    def _mk_id(self, prefix):
+        self._ids += 1
+        return '%s%020x' % (prefix, self._ids)
+
+
+class FakeServer(ThreadingMixIn, HTTPServer):
+    """ Serves a `FakePlatform` over HTTP and WebSockets on a local port, in a
+    background thread. `latency` (seconds, or a callable of the method and
+    path) delays every response; a fraction `error_rate` of requests fail
+    with `error_status`, and `fail_next` forces the next few to fail. GETs
+    carry the `validators` named (`etag`, `last-modified`) and honour
+    conditional requests. Both the API and WebSocket hosts point at the same
+    port. """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, platform=None, latency=0, error_rate=0, error_status=500,
+                 port=0, seed=None, validators=('etag', 'last-modified')):
+        HTTPServer.__init__(self, ('127.0.0.1', port), FakeHandler)
+        self.platform = platform or FakePlatform()
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.validators = validators
+        self.log = []
+        self._failures = []
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def host(self):
+        return '%s:%d' % self.server_address[:2]
+
+    def api(self, creds=None, **kwargs):
+        """ Returns an `API` talking to this server. """
+        from .api import API
+        kwargs.setdefault('host', self.host)
+        kwargs.setdefault('ws_host', self.host)
+        kwargs.setdefault('secure', False)
+        return API(creds or Token('acc', 'tok'), **kwargs)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def fail_next(self, count=1, status=500):
+        with self._lock:
+            self._failures.extend([status] * count)
+
+    def injected(self, method, path):
+        """ Sleeps for the configured latency, and returns the status of an
+        injected failure, if any. """
+
+        latency = self.latency(method, path) if callable(self.latency) else self.latency
+        if latency:
+            time.sleep(latency)
+        with self._lock:
+            self.log.append((method, path))
+            if self._failures:
+                return self._failures.pop(0)
+            if self.error_rate and self._random.random() < self.error_rate:
+                return self.error_status
+        return None
+
+    def respond(self, method, path, params, data):
+        status = self.injected(method, path)
+        if status is not None:
+            return status, envelope(status, errors=['Injected failure'])
+        return self.platform.handle(method, path, params, data)
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.headers.get('upgrade', '').lower() == 'websocket':
+            return WebSocketConnection(self).run()
+        self._dispatch()
+
+    def _dispatch(self):
+        self._respond(*self._read_request())
+
+    do_POST = do_PUT = do_DELETE = do_MGET = do_MPUT = _dispatch
+
+    def _read_request(self):
+        url = urlsplit(self.path)
+        length = int(self.headers.get('content-length') or 0)
+        body = self.rfile.read(length) if length else b''
+        encoding = self.headers.get('content-encoding')
+        if encoding in ('gzip', 'deflate'):
+            body = zlib.decompress(body, 31 if encoding == 'gzip' else 15)
+        data = json.loads(body.decode('utf-8')) if body else None
+        return self.command, url.path, dict(parse_qsl(url.query)), data
+
+    def _respond(self, method, path, params, data):
+        status, res = self.server.respond(method, path, params, data)
+        body = json.dumps(res, sort_keys=True).encode('utf-8')
+        headers = {}
+        if method == 'GET' and status == 200:
+            headers = self._validators(path, body)
+            if self._not_modified(headers):
+                status, body = 304, b''
+
+        self.send_response(status)
+        self.send_header('content-type', 'application/json')
+        self.send_header('content-length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _validators(self, path, body):
+        headers = {}
+        if 'etag' in self.server.validators:
+            headers['etag'] = '"%s"' % hashlib.md5(body).hexdigest()
+        if 'last-modified' in self.server.validators:
+            modified = self.server.platform.last_modified(path)
+            headers['last-modified'] = formatdate(int(modified), usegmt=True)
+        return headers
+
+    def _not_modified(self, validators):
+        etag = self.headers.get('if-none-match')
+        if etag is not None:
+            return etag == validators.get('etag')
+        since = parsedate_tz(self.headers.get('if-modified-since') or '')
+        if since is not None and 'last-modified' in validators:
+            return mktime_tz(parsedate_tz(validators['last-modified'])) <= mktime_tz(since)
+        return False
+
+
+class WebSocketConnection(object):
+    """ A minimal server side of the WebSocket protocol for a session. Handles
+    subscriptions and drop pushes, and carries CRUD messages of the form
+    `{msgId, object, type, flowId, id, value}`, replying with an envelope
+    whose head holds the `msgId`. """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.server = handler.server
+        self.subscriptions = set()
+        self._lock = threading.Lock()
+        match = re.match(r'^/session/([^/]+)/ws$', urlsplit(handler.path).path)
+        self.session = match and match.group(1)
+        self.account = handler.headers.get('x-auth-account', 'acc')
+
+    def run(self):
+        handler = self.handler
+        if self.session not in self.server.platform.sessions:
+            handler.send_error(404)
+            return
+
+        key = handler.headers['sec-websocket-key']
+        accept = base64.b64encode(hashlib.sha1((key + WS_GUID).encode('ascii')).digest())
+        handler.send_response(101)
+        handler.send_header('upgrade', 'websocket')
+        handler.send_header('connection', 'Upgrade')
+        handler.send_header('sec-websocket-accept', accept.decode('ascii'))
+        handler.end_headers()
+        handler.wfile.flush()
+
+        platform = self.server.platform
+        platform.listen(self._on_drop)
+        try:
+            while True:
+                frame = self._read_frame()
+                if frame is None:
+                    break
+                opcode, payload = frame
+                if opcode == 0x8:
+                    self._write_frame(0x8, b'')
+                    break
+                if opcode == 0x9:
+                    self._write_frame(0xA, payload)
+                elif opcode == 0x1:
+                    self._on_message(json.loads(payload.decode('utf-8')))
+        except (IOError, OSError, socket.error):
+            pass
+        finally:
+            platform.unlisten(self._on_drop)
+            handler.close_connection = True
+
+    def _on_message(self, msg):
+        kind = msg.get('type')
+        if kind in ('subscribe', 'unsubscribe'):
+            flow_id = msg.get('flowId') or self._flow_for_path(msg.get('path'))
+            if kind == 'subscribe':
+                self.subscriptions.add(flow_id)
+            else:
+                self.subscriptions.discard(flow_id)
+            status, res = 200, envelope(200, {})
+        elif kind in WS_METHODS and msg.get('object') in WS_OBJECTS:
+            base = WS_OBJECTS[msg['object']]
+            if base == 'drop':
+                base += '/' + msg.get('flowId', '')
+            path = '/v0/%s/%s' % (self.account, base)
+            if msg.get('id') and kind != 'findmany':
+                path += '/' + msg['id']
+            method = WS_METHODS[kind]
+            status, res = self.server.respond(method, path, msg.get('options') or {},
+                                              msg.get('value'))
+        else:
+            status, res = 400, envelope(400, errors=['Unsupported message'])
+
+        if 'msgId' in msg:
+            res['head']['msgId'] = msg['msgId']
+            self._send(res)
+
+    def _on_drop(self, flow_id, drop):
+        if flow_id in self.subscriptions:
+            try:
+                self._send({ 'type': 'message', 'resource': flow_id, 'value': drop })
+            except (IOError, OSError, socket.error):
+                pass
+
+    def _flow_for_path(self, path):
+        for flow in self.server.platform.resources.get('/flow', {}).values():
+            if flow.get('path') == path:
+                return flow['id']
+        return path
+
+    def _send(self, data):
+        self._write_frame(0x1, json.dumps(data).encode('utf-8'))
+
+    def _read_exact(self, n):
+        data = self.handler.rfile.read(n)
+        if len(data) < n:
+            raise IOError('Connection closed')
+        return bytearray(data)
+
+    def _read_frame(self):
+        try:
+            head = self._read_exact(2)
+        except IOError:
+            return None
+        opcode = head[0] & 0x0f
+        length = head[1] & 0x7f
+        if length == 126:
+            length = struct.unpack('>H', bytes(self._read_exact(2)))[0]
+        elif length == 127:
+            length = struct.unpack('>Q', bytes(self._read_exact(8)))[0]
+        mask = self._read_exact(4) if head[1] & 0x80 else None
+        payload = self._read_exact(length)
+        if mask:
+            for i in range(length):
+                payload[i] ^= mask[i % 4]
+        return opcode, bytes(payload)
+
+    def _write_frame(self, opcode, payload):
+        length = len(payload)
+        if length < 126:
+            head = struct.pack('>BB', 0x80 | opcode, length)
+        elif length < 1 << 16:
+            head = struct.pack('>BBH', 0x80 | opcode, 126, length)
+        else:
+            head = struct.pack('>BBQ', 0x80 | opcode, 127, length)
+        with self._lock:
+            self.handler.wfile.write(head + payload)
+            self.handler.wfile.flush()
@@ -1,14 +1,38 @@
 from __future__ import absolute_import
 
+import os
+import time
+import zlib
+import weakref
 import logging
-import requests
+import threading
+from collections import OrderedDict, deque
+from importlib import import_module
+from six.moves import queue
 
 from .exceptions import *
-from .builders import Token
+from .builders import Token, frozen
 
 
 logger = logging.getLogger('flowthings')
 
+_session = None
+
+_session_lock = threading.Lock()
+
+_workers = None
+
+_pid = os.getpid()
+
+_fork_aware = weakref.WeakSet()
+
+_fork_hooks = []
+
+# With `os.register_at_fork`, children are reset by the hook instead.
+_check_pid = not hasattr(os, 'register_at_fork')
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
 
 def default(x, d):
     """ Returns the value if it isn't None, otherwise the default. """
@@ -25,18 +49,447 @@ def mk_headers(creds):
       'x-auth-account': creds.account }
 
 
-def api_request(method, url, params=None, data=None, creds=None, verify_ssl=True):
-    """ Make a request with the proper credential headers. """
+def fork_aware(obj):
+    """ Registers an object whose `_after_fork()` is called in a child
+    process after a fork, to drop connections, locks and caches inherited
+    from the parent. Only a weak reference is kept. """
+
+    _fork_aware.add(obj)
+    return obj
+
+
+def on_fork(fn):
+    """ Registers a function called in a forked child, for module-level
+    state such as locks. Returns the function, so it can decorate. """
+
+    _fork_hooks.append(fn)
+    return fn
+
+
+def check_fork():
+    """ Resets fork-aware state if this is a forked child that hasn't been
+    reset yet. Pythons without `os.register_at_fork` rely on this check at
+    the request entry points. """
+
+    if _check_pid and os.getpid() != _pid:
+        _after_fork()
+
+
+def _after_fork():
+    global _pid, _session, _session_lock, _workers
+    _pid = os.getpid()
+    # The parent's sockets are dropped, not closed, as closing them here
+    # would shut down connections the parent is still using.
+    _session = None
+    _session_lock = threading.Lock()
+    # Nor are the worker threads forked.
+    _workers = None
+    for fn in _fork_hooks:
+        fn()
+    for obj in list(_fork_aware):
+        obj._after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def session():
+    """ Returns the shared `requests.Session`, so requests reuse pooled
+    connections instead of opening a new one each time. The session is
+    shared by every API and set of credentials, so it keeps no cookies. """
+
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                import requests
+                from six.moves.http_cookiejar import DefaultCookiePolicy
+                s = requests.Session()
+                s.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+                adapter = requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=32)
+                s.mount('http://', adapter)
+                s.mount('https://', adapter)
+                _session = s
+    return _session
+
+
+class Compression(object):
+    """ Compression options for requests. Request bodies of at least
+    `threshold` bytes are compressed with `encoding` (gzip or deflate), and
+    compressed responses are accepted. Byte counters record what was sent
+    and received before and after compression:
+
+        >>> compression = Compression(threshold=512)
+        >>> api = API(creds, compression=compression)
+        >>> api.drop(flow_id).update_many(drops)
+        >>> compression.sent_ratio
+        0.18
+    """
+
+    def __init__(self, threshold=1024, encoding='gzip', level=6,
+                 accept='gzip, deflate'):
+        assert encoding in ('gzip', 'deflate'), 'Encoding must be gzip or deflate'
+        self.threshold = threshold
+        self.encoding = encoding
+        self.level = level
+        self.accept = accept
+        self._lock = threading.Lock()
+        self.reset()
+        fork_aware(self)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self.sent_raw = 0
+            self.sent = 0
+            self.received_raw = 0
+            self.received = 0
+
+    def compress(self, data):
+        """ Returns the (possibly) compressed body and its content encoding,
+        if any. """
+
+        if data is None:
+            return data, None
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        encoding = None
+        raw_len = len(data)
+        if raw_len >= self.threshold:
+            wbits = 31 if self.encoding == 'gzip' else 15
+            c = zlib.compressobj(self.level, zlib.DEFLATED, wbits)
+            data = c.compress(data) + c.flush()
+            encoding = self.encoding
+        with self._lock:
+            self.sent_raw += raw_len
+            self.sent += len(data)
+        return data, encoding
+
+    def record_response(self, wire_bytes, decoded_bytes):
+        with self._lock:
+            self.received += wire_bytes
+            self.received_raw += decoded_bytes
+
+    @property
+    def sent_ratio(self):
+        """ Compressed / uncompressed bytes sent. """
+        return float(self.sent) / self.sent_raw if self.sent_raw else 1.0
+
+    @property
+    def received_ratio(self):
+        """ Wire / decoded bytes received. """
+        return float(self.received) / self.received_raw if self.received_raw else 1.0
+
+
+class ConditionalCache(object):
+    """ Revalidates repeated GETs instead of downloading them again. The body
+    and validators (`ETag`, `Last-Modified`) of each response are kept per
+    URL, params and token, for the `max_entries` most recently used; later
+    GETs send `If-None-Match`/`If-Modified-Since`, and a 304 returns the kept
+    body. Responses without validators aren't kept:
+
+        >>> api = API(creds, conditional=ConditionalCache())
+        >>> api.flow.read(flow_id)  # 200, stored
+        >>> api.flow.read(flow_id)  # 304, served from the cache
+    """
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        fork_aware(self)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self._entries.clear()
+
+    def key(self, url, params, creds):
+        return (url, frozen(params) if params else None, creds.token if creds else None)
+
+    def get(self, key):
+        """ Returns the kept `(text, request_headers)` for a key, or None. """
+
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+            return entry
+
+    def store(self, key, text, response_headers):
+        validators = {}
+        if response_headers.get('etag'):
+            validators['if-none-match'] = response_headers['etag']
+        if response_headers.get('last-modified'):
+            validators['if-modified-since'] = response_headers['last-modified']
+
+        with self._lock:
+            self.misses += 1
+            self._entries.pop(key, None)
+            if not validators:
+                return
+            self._entries[key] = (text, validators)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def record_hit(self):
+        with self._lock:
+            self.hits += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class Workers(object):
+    """ Daemon threads that run spawned calls. Threads are started only when
+    none is idle (up to `max_workers`, after which calls wait for one), and
+    are kept for the next call rather than exiting. """
+
+    def __init__(self, max_workers=64):
+        self.max_workers = max_workers
+        self._tasks = queue.Queue()
+        self._lock = threading.Lock()
+        self._idle = 0
+        self._threads = 0
+
+    def spawn(self, fn, *args):
+        with self._lock:
+            start = not self._idle and self._threads < self.max_workers
+            if start:
+                self._threads += 1
+            elif self._idle:
+                self._idle -= 1
+        self._tasks.put((fn, args))
+        if start:
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+
+    def _run(self):
+        while True:
+            fn, args = self._tasks.get()
+            try:
+                fn(*args)
+            except Exception:
+                logger.exception('Worker call failed')
+            with self._lock:
+                self._idle += 1
+
+
+def workers():
+    """ Returns the shared `Workers`. """
+
+    global _workers
+    if _workers is None:
+        with _session_lock:
+            if _workers is None:
+                _workers = Workers()
+    return _workers
+
+
+class Hedging(object):
+    """ Hedges idempotent requests to cut tail latency. If a response hasn't
+    arrived after `delay` seconds, a duplicate request is sent (over another
+    pooled connection) and whichever answers first wins. Without a fixed
+    `delay`, the `percentile` of recently observed latencies is used, once
+    `min_samples` are known (`initial_delay` until then). Hedges are capped
+    to a `budget` fraction of all requests, so that a slow backend isn't
+    hit with twice the load. Share one instance to share the budget:
+
+        >>> api = API(creds, hedging=Hedging(budget=0.05))
+
+    While the budget can't afford a hedge, requests are sent inline. Others
+    run on the shared `Workers` threads, or on green threads of `async_lib`
+    (eventlet or gevent) when given. A losing request can't be interrupted;
+    it is left to finish, and only its latency is kept. """
+
+    def __init__(self, delay=None, percentile=0.95, budget=0.05, methods=('GET', 'MGET'),
+                 initial_delay=0.05, min_samples=20, window=1000, async_lib=None):
+        self.fixed_delay = delay
+        self.percentile = percentile
+        self.budget = budget
+        self.methods = frozenset(methods)
+        self.initial_delay = initial_delay
+        self.min_samples = min_samples
+        self.async_lib = async_lib
+        self._latencies = deque(maxlen=window)
+        self._delay = initial_delay
+        self._since_update = 0
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        fork_aware(self)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    @property
+    def delay(self):
+        if self.fixed_delay is not None:
+            return self.fixed_delay
+        return self._delay
+
+    def record(self, latency):
+        with self._lock:
+            self._latencies.append(latency)
+            self._since_update += 1
+            count = len(self._latencies)
+            if count >= self.min_samples and (self._since_update >= 50 or count == self.min_samples):
+                ordered = sorted(self._latencies)
+                self._delay = ordered[min(len(ordered) - 1, int(len(ordered) * self.percentile))]
+                self._since_update = 0
+
+    def _can_hedge(self):
+        return self.hedges + 1 <= self.budget * self.requests
+
+    def _take_hedge(self):
+        with self._lock:
+            if not self._can_hedge():
+                return False
+            self.hedges += 1
+            return True
+
+    def _spawn(self, fn, *args):
+        if self.async_lib is not None:
+            self.async_lib.spawn(fn, *args)
+        else:
+            workers().spawn(fn, *args)
+
+    def call(self, fn, *args, **kwargs):
+        """ Calls `fn`, hedging it if it is slow. Exceptions are only raised
+        when every request sent has failed. """
+
+        return self.call_discarding(None, fn, *args, **kwargs)
+
+    def call_discarding(self, discard, fn, *args, **kwargs):
+        """ Like `call`, but the value of a losing request is passed to
+        `discard` when it arrives, eg. to close a streamed response. """
+
+        with self._lock:
+            self.requests += 1
+            inline = not self._can_hedge()
+        if inline:
+            start = time.time()
+            value = fn(*args, **kwargs)
+            self.record(time.time() - start)
+            return value
+
+        lib = queue
+        if self.async_lib is not None:
+            lib = import_module(self.async_lib.__name__ + '.queue')
+        results = lib.Queue()
+        won = []
+
+        def run(hedge):
+            start = time.time()
+            try:
+                value = fn(*args, **kwargs)
+            except Exception as e:
+                results.put((hedge, False, e))
+            else:
+                # Recorded whether or not it wins, so slow requests aren't
+                # left out of the observed latencies.
+                self.record(time.time() - start)
+                with self._lock:
+                    lost = bool(won)
+                    won.append(hedge)
+                if lost:
+                    if discard is not None:
+                        discard(value)
+                else:
+                    results.put((hedge, True, value))
+
+        self._spawn(run, False)
+        pending = 1
+        try:
+            first = results.get(timeout=self.delay)
+        except lib.Empty:
+            first = None
+            if self._take_hedge():
+                logger.info('Hedging request after %.3fs', self.delay)
+                self._spawn(run, True)
+                pending += 1
+
+        while True:
+            hedge, ok, value = first if first is not None else results.get()
+            first = None
+            pending -= 1
+            if ok:
+                if hedge:
+                    with self._lock:
+                        self.hedge_wins += 1
+                return value
+            if not pending:
+                raise value
+
+
+def api_request(method, url, params=None, data=None, creds=None, verify_ssl=True,
+                stream=False, compression=None, conditional=None, send=None):
+    """ Make a request with the proper credential headers. With `stream` set,
+    the body isn't read up front, and an iterator of byte chunks is returned
+    in place of the response text. With `compression`, large request bodies
+    are compressed and compressed responses are accepted. With a
+    `ConditionalCache`, GETs are revalidated against the kept response.
+    `send` replaces the shared session's `request` for other HTTP clients,
+    and must return a response that looks like one of `requests`. """
+    check_fork()
     logger.info('%s %s %s %s', method, url, params, data)
-    res = requests.request(method, url,
-                           params=params,
-                           data=data,
-                           verify=verify_ssl,
-                           headers=mk_headers(creds))
+    headers = mk_headers(creds)
+    if compression is not None:
+        data, encoding = compression.compress(data)
+        if encoding:
+            headers['content-encoding'] = encoding
+        headers['accept-encoding'] = compression.accept
+
+    entry = None
+    if conditional is not None and method == 'GET' and not stream:
+        key = conditional.key(url, params, creds)
+        entry = conditional.get(key)
+        if entry is not None:
+            headers.update(entry[1])
+    else:
+        conditional = None
+
+    send = send or session().request
+    res = send(method, url,
+               params=params,
+               data=data,
+               verify=verify_ssl,
+               headers=headers,
+               stream=stream)
+    if stream:
+        logger.info('%d (streamed)', res.status_code)
+        return (iter_response(res), res.headers, res.status_code)
+    if entry is not None and res.status_code == 304:
+        logger.info('304 (revalidated)')
+        conditional.record_hit()
+        return (entry[0], res.headers, 200)
     logger.info('%d %s', res.status_code, res.content)
+    if compression is not None:
+        wire = res.raw.tell() if hasattr(res.raw, 'tell') else len(res.content)
+        compression.record_response(wire or len(res.content), len(res.content))
+    if conditional is not None and res.status_code == 200:
+        conditional.store(key, res.text, res.headers)
     return (res.text, res.headers, res.status_code)
 
 
+def iter_response(res, chunk_size=STREAM_CHUNK_SIZE):
+    """ Yields the body of a streamed response in chunks, and releases its
+    connection once the body is read, or when the iterator is closed before
+    that. """
+    try:
+        for chunk in res.iter_content(chunk_size):
+            yield chunk
+    finally:
+        res.close()
+
+
 ERROR_TABLE = {
     400: FlowThingsBadRequest,
     403: FlowThingsForbidden,
@@ -0,0 +1,163 @@
+from __future__ import absolute_import
+import re
+import threading
+
+from six.moves.urllib.parse import urlsplit
+
+from .default import defaults
+from .utils import fork_aware, check_fork
+
+
+__all__ = ('WebSocketTransport',)
+
+
+WS_OBJECTS = ('drop', 'flow', 'track')
+
+SERVICE_PATH = re.compile(r'^/v[^/]+/[^/]+/(%s)(?:/([^/]+))?(?:/([^/]+))?/?$' % '|'.join(WS_OBJECTS))
+
+
+class WebSocketTransport(object):
+    """ A request callable that carries CRUD calls over a WebSocket session
+    instead of HTTP. Each call is sent as a `{msgId, object, type, ...}`
+    message and waits for the reply with its `msgId`, so calls from many
+    threads or greenlets are pipelined over the one connection. Calls the
+    WebSocket protocol has no message for (MGET, MPUT, aggregation, other
+    services), calls with other credentials, and calls made while the
+    session isn't open go to `fallback` over HTTP:
+
+        >>> transport = WebSocketTransport(api.websocket).start()
+        >>> ws_api = API(creds, request=transport)
+        >>> ws_api.drop(flow_id).create({'elems': {'temp': 21}})
+
+    Streamed calls get the whole reply as a single chunk. A call whose reply
+    doesn't arrive within `timeout` seconds, or whose session closes first,
+    raises `IOError`. """
+
+    def __init__(self, websocket, fallback=None, timeout=30):
+        self._websocket = websocket
+        self.fallback = fallback or defaults.request
+        self.timeout = timeout
+        self._client = None
+        self._opened = threading.Event()
+        self._pending = {}
+        self._lock = threading.Lock()
+        fork_aware(self)
+
+    def _after_fork(self):
+        # The session belongs to the parent; the child uses HTTP until
+        # `start` is called again.
+        self._client = None
+        self._opened = threading.Event()
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    @property
+    def connected(self):
+        return self._client is not None and self._opened.is_set()
+
+    def start(self):
+        """ Opens the session, and waits until it is ready. """
+
+        self._opened.clear()
+        client = self._websocket.connect(on_open=self._on_open,
+                                         on_close=self._on_close)
+        self._client = client
+        thread = threading.Thread(target=client.run)
+        thread.daemon = True
+        thread.start()
+        if not self._opened.wait(self.timeout):
+            raise IOError('Timed out opening the WebSocket session')
+        return self
+
+    def close(self):
+        if self._client is not None:
+            self._client.close()
+        self._on_close(None)
+
+    def __call__(self, method, url, params=None, data=None, creds=None, **kwargs):
+        check_fork()
+        message = self.message(method, url, params, data)
+        if message is None or not self.connected or creds != self._websocket.creds:
+            return self.fallback(method, url, params=params, data=data, creds=creds, **kwargs)
+
+        done = threading.Event()
+        slot = [done, None]
+        def on_reply(ws, reply):
+            slot[1] = reply
+            done.set()
+
+        with self._lock:
+            self._pending[id(slot)] = slot
+        try:
+            try:
+                self._client.call(message, on_reply)
+            except Exception:
+                # Nothing was sent, so HTTP can safely take over.
+                self._opened.clear()
+                return self.fallback(method, url, params=params, data=data, creds=creds,
+                                     **kwargs)
+            if not done.wait(self.timeout):
+                raise IOError('Timed out waiting for a WebSocket reply')
+        finally:
+            with self._lock:
+                self._pending.pop(id(slot), None)
+
+        reply = slot[1]
+        if reply is None:
+            raise IOError('WebSocket session closed')
+        status = reply['head'].get('status', 200 if reply['head'].get('ok') else 500)
+        body = self._websocket._encoder.dumps(reply)
+        if kwargs.get('stream'):
+            # Streaming callers read byte chunks; the reply is already whole.
+            if not isinstance(body, bytes):
+                body = body.encode('utf-8')
+            body = iter([body])
+        return (body, {}, status)
+
+    def message(self, method, url, params, data):
+        """ Builds the WebSocket message for a request, or returns None if
+        there isn't one. """
+
+        match = SERVICE_PATH.match(urlsplit(url).path)
+        if not match:
+            return None
+        obj, first, second = match.groups()
+        if obj == 'drop':
+            if first is None:
+                return None
+            message = { 'object': 'drop', 'flowId': first }
+            id = second
+        elif second is not None:
+            return None
+        else:
+            message = { 'object': obj }
+            id = first
+
+        if method == 'GET':
+            message['type'] = 'find' if id else 'findmany'
+            if params:
+                message['options'] = dict(params)
+        elif method == 'POST' and not id:
+            message['type'] = 'create'
+        elif method == 'PUT' and id:
+            message['type'] = 'update'
+        elif method == 'DELETE' and id:
+            message['type'] = 'delete'
+        else:
+            return None
+
+        if id:
+            message['id'] = id
+        if data is not None:
+            message['value'] = self._websocket._encoder.loads(data)
+        return message
+
+    def _on_open(self, ws):
+        self._opened.set()
+
+    def _on_close(self, ws):
+        self._opened.clear()
+        with self._lock:
+            pending = list(self._pending.values())
+        for done, _ in pending:
+            done.set()
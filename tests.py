@@ -416,6 +416,557 @@ class RequestTestCase(TestCase):
         })
 
 
+class AggregateCacheTestCase(TestCase):
+
+    def setUp(self):
+        from flowthings.cache import AggregateCache
+        self.now = 1000.0
+        self.cache = AggregateCache(ttl=5, clock=lambda: self.now)
+        self.calls = []
+        self.newest = 5000
+
+    def request(self, method, url, params=None, data=None, creds=None):
+        self.calls.append((method, url, data))
+        if method == 'GET':
+            return ({'head': {'status': 200}, 'body': [{'creationDate': self.newest}]}, {}, 200)
+        if method == 'POST' and not url.endswith('/aggregate'):
+            return ({'head': {'status': 200}, 'body': {'id': 'd', 'flowId': 'foo'}}, {}, 200)
+        if data and 'creationDate >' in data.get('filter', ''):
+            body = [{'$month': 1, '$count': 1, '$sum:foo': 10}]
+        else:
+            body = [{'$month': 1, '$count': 5, '$sum:foo': 50},
+                    {'$month': 2, '$count': 2, '$sum:foo': 20}]
+        return ({'head': {'status': 200}, 'body': body}, {}, 200)
+
+    def test_ttl(self):
+        api = TestAPI(request=self.request, aggregate_cache=self.cache)
+        a = api.drop('foo').aggregate(['$count'], group_by=['$month'])
+        b = api.drop('foo').aggregate(['$count'], group_by=['$month'])
+        self.assertEqual(a, b)
+        self.assertEqual(len(self.calls), 1)
+        api.drop('bar').aggregate(['$count'], group_by=['$month'])
+        self.assertEqual(len(self.calls), 2)
+        self.now += 10
+        api.drop('foo').aggregate(['$count'], group_by=['$month'])
+        self.assertEqual(len(self.calls), 3)
+
+    def test_invalidation(self):
+        api = TestAPI(request=self.request, aggregate_cache=self.cache)
+        api.drop('foo').aggregate(['$count'])
+        api.drop('foo').delete('d1')
+        api.drop('foo').aggregate(['$count'])
+        self.cache.invalidate_flow('foo')
+        api.drop('foo').aggregate(['$count'])
+        self.assertEqual([c[0] for c in self.calls], ['POST', 'DELETE', 'POST', 'POST'])
+
+    def test_incremental(self):
+        api = TestAPI(request=self.request, aggregate_cache=self.cache)
+        outputs = ['$count', '$sum:foo']
+        api.drop('foo').aggregate(outputs, group_by=['$month'], incremental=True)
+        self.assertEqual(self.calls[-1][2]['filter'], 'creationDate <= 5000')
+
+        # The cutoff is the newest drop's creationDate, not the local clock.
+        self.now += 10
+        self.newest = 7000
+        res = api.drop('foo').aggregate(outputs, group_by=['$month'], incremental=True)
+        self.assertEqual(self.calls[-1][2]['filter'],
+                         '(creationDate > 5000) && (creationDate <= 7000)')
+        self.assertEqual(res, [{'$month': 1, '$count': 6, '$sum:foo': 60},
+                               {'$month': 2, '$count': 2, '$sum:foo': 20}])
+
+        # Nothing new, so no aggregation is needed.
+        self.now += 10
+        calls = len(self.calls)
+        self.assertEqual(api.drop('foo').aggregate(outputs, group_by=['$month'],
+                                                   incremental=True), res)
+        self.assertEqual([c[0] for c in self.calls[calls:]], ['GET'])
+
+        self.now += 10
+        api.drop('foo').aggregate(['$avg:foo'], incremental=True)
+        self.assertNotIn('filter', self.calls[-1][2])
+
+    def test_create_expires(self):
+        api = TestAPI(request=self.request, aggregate_cache=self.cache)
+        api.drop('foo').aggregate(['$count'])
+        api.drop('foo').create({'elems': {}})
+        api.drop('foo').aggregate(['$count'])
+        api.drop.create({'path': '/foo', 'elems': {}})
+        api.drop('foo').aggregate(['$count'])
+        self.assertEqual([c[0] for c in self.calls], ['POST'] * 5)
+        self.assertEqual(len([c for c in self.calls if c[1].endswith('/aggregate')]), 3)
+
+        # Expired results are kept for incremental aggregations.
+        api.drop('foo').aggregate(['$sum:foo'], incremental=True)
+        api.drop('foo').create({'elems': {}})
+        self.newest = 6000
+        api.drop('foo').aggregate(['$sum:foo'], incremental=True)
+        self.assertEqual(self.calls[-1][2]['filter'],
+                         '(creationDate > 5000) && (creationDate <= 6000)')
+
+    def test_incremental_fake_platform(self):
+        import json
+        from flowthings.testing import FakeServer
+        from flowthings.utils import api_request
+        filters = []
+        def request(method, url, **kwargs):
+            if url.endswith('/aggregate'):
+                filters.append(json.loads(kwargs['data'])['filter'])
+            return api_request(method, url, **kwargs)
+
+        with FakeServer() as server:
+            api = server.api(aggregate_cache=self.cache, request=request)
+            flow = api.flow.create({ 'path': '/acc/inc' })
+            drops = api.drop(flow['id'])
+            for date in (1000, 3000, 2000):
+                drops.create({ 'creationDate': date, 'elems': { 'n': 1 } })
+            self.assertEqual(drops.aggregate(['$count'], incremental=True)[0]['$count'], 3)
+
+            for date in (4000, 5000):
+                drops.create({ 'creationDate': date, 'elems': { 'n': 1 } })
+            self.assertEqual(drops.aggregate(['$count'], incremental=True)[0]['$count'], 5)
+        self.assertEqual(filters, ['creationDate <= 3000',
+                                   '(creationDate > 3000) && (creationDate <= 5000)'])
+
+
+class LocalAggregationTestCase(TestCase):
+
+    DROPS = [
+        {'creationDate': 1420070400000, 'elems': {'foo': 10, 'bar': 50}},
+        {'creationDate': 1420070400000, 'elems': {'foo': 20, 'bar': 30}},
+        {'creationDate': 1422748800000, 'elems': {'foo': 30}},
+        {'creationDate': 1422748800000, 'elems': {'bar': 'x'}},
+        {'creationDate': 1422748800000, 'elems': {'foo': {'type': 'integer', 'value': 5}}},
+    ]
+
+    def request(self, method, url, params=None, data=None, creds=None):
+        self.calls.append(params)
+        start, limit = params['start'], params['limit']
+        return ({'head': {'status': 200}, 'body': self.DROPS[start:start + limit]}, {}, 200)
+
+    def aggregate(self, processes):
+        self.calls = []
+        api = TestAPI(request=self.request)
+        return api.drop('foo').aggregate_local(
+            ['$count', '$sum:foo', '$avg:foo', '$min:foo', '$max:foo', '$avg:big'],
+            group_by=['$month'],
+            filter=EXISTS('elems'),
+            rules={'big': mem.elems.bar > 40},
+            sorts=['-$month'],
+            processes=processes,
+            chunk_size=2)
+
+    def test_aggregate_local(self):
+        rows = self.aggregate(1)
+        self.assertEqual(rows, [
+            {'$month': 2, '$count': 3, '$sum:foo': 35, '$avg:foo': 17.5,
+             '$min:foo': 5, '$max:foo': 30, '$avg:big': 0.0},
+            {'$month': 1, '$count': 2, '$sum:foo': 30, '$avg:foo': 15.0,
+             '$min:foo': 10, '$max:foo': 20, '$avg:big': 0.5},
+        ])
+        self.assertEqual(len(self.calls), 3)
+        self.assertEqual(self.calls[0]['filter'], 'EXISTS elems')
+
+    def test_aggregate_local_process_pool(self):
+        self.assertEqual(self.aggregate(2), self.aggregate(1))
+
+    def test_unsupported_output(self):
+        from flowthings.aggregate import LocalAggregation
+        self.assertRaises(FlowThingsError, LocalAggregation, ['$median:foo'])
+
+    def test_filters_pickle(self):
+        import pickle
+        f = (mem.elems.foo > 1).AND(NOT(EXISTS('bar')))
+        f.matches({})
+        g = pickle.loads(pickle.dumps(f))
+        self.assertEqual(str(g), str(f))
+        self.assertTrue(g.matches({'elems': {'foo': 2}}))
+
+
+class StatisticsRangeTestCase(TestCase):
+
+    def test_plan_periods(self):
+        from datetime import date
+        from flowthings.services import plan_periods
+        self.assertEqual(plan_periods(date(2014, 12, 30), date(2016, 3, 2)), [
+            (2014, 12, 30), (2014, 12, 31), (2015,), (2016, 1), (2016, 2),
+            (2016, 3, 1), (2016, 3, 2),
+        ])
+        self.assertEqual(plan_periods(date(2015, 2, 1), date(2015, 2, 28)), [(2015, 2)])
+
+    def test_range(self):
+        import json
+        from datetime import date
+        calls = []
+        def request(method, url, params=None, data=None, creds=None):
+            calls.append((url, params))
+            if url.endswith('/2015/12'):
+                body = { '2': 4, '1': 3, '10': 5 }
+            else:
+                body = 7
+            return (json.dumps({ 'head': { 'status': 200, 'ok': True }, 'body': body }), {}, 200)
+
+        api = TestAPI(request=request, encoder=json)
+        series = api.statistics.range('flow_drop_added', ['a', 'b'],
+                                      date(2015, 11, 30), date(2015, 12, 31),
+                                      level='day')
+        self.assertEqual(len(calls), 4)
+        self.assertEqual(series['b'], [((2015, 11, 30), 7), ((2015, 12, 1), 3),
+                                       ((2015, 12, 2), 4), ((2015, 12, 10), 5)])
+        self.assertTrue(('https://test/vtest/acc/statistics/flowDropAdded/b/2015/12',
+                         { 'level': 'day' }) in calls)
+
+        api.statistics.range('flowDropAdded', ['a', 'c'],
+                             date(2015, 11, 30), date(2015, 12, 31), level='day')
+        self.assertEqual(len(calls), 6)
+
+    def test_cache_size(self):
+        from datetime import date
+        api = TestAPI()
+        api.statistics.cache_size = 3
+        api.statistics.range('flowDropAdded', ['a', 'b'], date(2015, 11, 30), date(2015, 12, 31))
+        self.assertEqual(len(api.statistics._cache), 3)
+
+    def test_cache_per_creds(self):
+        from datetime import date
+        accounts = []
+        def request(method, url, params=None, data=None, creds=None):
+            accounts.append(creds.account)
+            return ({ 'head': { 'status': 200, 'ok': True }, 'body': len(accounts) }, {}, 200)
+        api = TestAPI(request=request)
+        stats = lambda: api.statistics.range('flowDropAdded', ['a'], date(2015, 12, 1),
+                                             date(2015, 12, 31))
+        self.assertEqual(stats()['a'], [((2015, 12), 1)])
+        self.assertEqual(stats()['a'], [((2015, 12), 1)])
+        api.creds = Token('other', 'tok2')
+        # The other account's statistics aren't served from the cache.
+        self.assertEqual(stats()['a'], [((2015, 12), 2)])
+        self.assertEqual(accounts, ['acc', 'other'])
+
+
+class SessionTestCase(TestCase):
+
+    def test_no_cookies(self):
+        import threading
+        from six.moves.BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+        from flowthings.utils import session
+        seen = []
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                seen.append(self.headers.get('cookie'))
+                self.send_response(200)
+                self.send_header('set-cookie', 'tenant=a; Path=/')
+                self.send_header('content-length', '0')
+                self.end_headers()
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            url = 'http://127.0.0.1:%d/' % server.server_address[1]
+            session().get(url)
+            session().get(url)
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(seen, [None, None])
+        self.assertEqual(len(session().cookies), 0)
+
+
+class ServiceReuseTestCase(TestCase):
+
+    def test_base_url(self):
+        api = TestAPI()
+        self.assertEqual(api.flow._mk_url('/foo'), 'https://test/vtest/acc/flow/foo')
+        api.creds = Token('other', 'tok')
+        self.assertEqual(api.flow.read('foo')['url'], 'https://test/vtest/other/flow/foo')
+        self.assertEqual(api.websocket._mk_url(''), 'https://ws.test/session')
+
+    def test_drop_services_are_reused(self):
+        api = TestAPI()
+        foo = api.drop('foo')
+        self.assertTrue(api.drop('foo') is foo)
+        self.assertFalse(api.drop('bar') is foo)
+
+        api.creds = Token('other', 'tok')
+        other = api.drop('foo')
+        self.assertFalse(other is foo)
+        self.assertEqual(other.creds, Token('other', 'tok'))
+        self.assertEqual(other.read('x')['url'], 'https://test/vtest/other/drop/foo/x')
+
+    def test_drop_service_lru(self):
+        api = TestAPI()
+        api.drop.cache_size = 2
+        a = api.drop('a')
+        api.drop('b')
+        api.drop('a')
+        api.drop('c')
+        self.assertTrue(api.drop('a') is a)
+        self.assertEqual(list(api.drop._services), ['c', 'a'])
+
+
+class LazyServicesTestCase(TestCase):
+
+    def test_services_are_created_on_use(self):
+        api = TestAPI()
+        self.assertEqual(api._services, {})
+        flow = api.flow
+        self.assertTrue(api.flow is flow)
+        self.assertEqual(list(api._services), ['flow'])
+        self.assertRaises(AttributeError, lambda: api.nope)
+
+    def test_creds_apply_to_later_services(self):
+        api = TestAPI()
+        api.flow
+        api.creds = Token('other', 'tok')
+        self.assertEqual(api.flow.creds.account, 'other')
+        self.assertEqual(api.track.creds.account, 'other')
+
+    def test_add_service(self):
+        from flowthings.services import BaseService, FindableServiceMixin
+        class ThingService(BaseService, FindableServiceMixin):
+            path = '/thing'
+        api = TestAPI()
+        api.add_service('thing', ThingService)
+        self.assertEqual(api.thing.read('a')['url'], 'https://test/vtest/acc/thing/a')
+        self.assertEqual(api.async().thing.read('a').wait()['async']['method'], 'GET')
+
+    def test_proxies_only_services(self):
+        api = TestAPI()
+        self.assertEqual(api.async().flow.read('a').wait()['async']['method'], 'GET')
+        self.assertEqual(api.lazy().flow.read('a')['async']['method'], 'GET')
+        for proxy in (api.async(), api.lazy()):
+            for name in ('creds', 'with_priority', 'parallel_map', 'nope'):
+                self.assertRaises(AttributeError, getattr, proxy, name)
+
+    def test_import_is_light(self):
+        import sys
+        import subprocess
+        out = subprocess.check_output([sys.executable, '-c',
+            'import sys, flowthings; print(" ".join(sorted(sys.modules)))'])
+        modules = out.decode('utf-8').split()
+        for name in ('requests', 'websocket', 'multiprocessing'):
+            self.assertNotIn(name, modules)
+
+
+def chunked(payload, size):
+    data = payload.encode('utf-8')
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class StreamingTestCase(TestCase):
+
+    BODY = [{'id': 'd%d' % i, 'elems': {'name': u'caf\xe9 %d' % i, 'n': i * 1000}}
+            for i in range(20)]
+
+    def envelope(self, body):
+        import json
+        return json.dumps({'head': {'status': 200, 'ok': True}, 'body': body},
+                          ensure_ascii=False)
+
+    def test_reader(self):
+        from flowthings.stream import EnvelopeReader
+        for size in (1, 3, 7, 4096):
+            reader = EnvelopeReader(chunked(self.envelope(self.BODY), size))
+            self.assertEqual(list(reader), self.BODY)
+            self.assertEqual(reader.head['status'], 200)
+
+    def test_reader_shapes(self):
+        import json
+        from flowthings.stream import EnvelopeReader
+        payload = '{"body": {"a": {"x": 1}, "b": null}, "head": {"status": 200}}'
+        self.assertEqual(list(EnvelopeReader(chunked(payload, 2))),
+                         [('a', {'x': 1}), ('b', None)])
+        self.assertEqual(list(EnvelopeReader(chunked(self.envelope([]), 2))), [])
+        self.assertEqual(list(EnvelopeReader(chunked(self.envelope(12345), 2))), [12345])
+        self.assertRaises(FlowThingsError, list,
+                          EnvelopeReader(chunked(self.envelope(self.BODY)[:-20], 5)))
+
+    def test_find_iter(self):
+        import json
+        calls = []
+        def request(method, url, params=None, data=None, creds=None, stream=False):
+            calls.append((method, url, params, data, stream))
+            if url.endswith('/missing'):
+                body = json.dumps({'head': {'status': 404, 'errors': ['nope']}, 'body': None})
+                return (chunked(body, 10), {}, 404)
+            return (iter(chunked(self.envelope(self.BODY), 16)), {}, 200)
+
+        api = TestAPI(request=request, encoder=json)
+        items = api.drop('f').find_iter(mem.elems.n > 1, limit=20)
+        self.assertEqual(calls, [])
+        self.assertEqual(next(items), self.BODY[0])
+        self.assertEqual(calls[0], ('GET', 'https://test/vtest/acc/drop/f',
+                                    {'filter': 'elems.n > 1', 'limit': 20}, None, True))
+        self.assertEqual(list(items), self.BODY[1:])
+
+        list(api.flow.read_many_iter(['a', 'b']))
+        self.assertEqual(calls[-1][0], 'MGET')
+        self.assertEqual(json.loads(calls[-1][3]), ['a', 'b'])
+        self.assertRaises(FlowThingsNotFound, list, api.flow.stream_request('GET', '/missing'))
+
+    def test_releases_connection(self):
+        from flowthings.utils import api_request
+        body = self.envelope(self.BODY)
+        responses = []
+        class Response(object):
+            status_code = 200
+            headers = {}
+            closed = False
+            def iter_content(self, size):
+                return iter(chunked(body, 16))
+            def close(self):
+                self.closed = True
+        def send(method, url, **kwargs):
+            responses.append(Response())
+            return responses[-1]
+
+        chunks, _, _ = api_request('GET', 'http://test/x', creds=CREDS, stream=True, send=send)
+        next(chunks)
+        chunks.close()
+        self.assertTrue(responses[-1].closed)
+
+        import json
+        from functools import partial
+        api = TestAPI(request=partial(api_request, send=send), encoder=json)
+        items = api.drop('f').find_iter()
+        self.assertEqual(next(items), self.BODY[0])
+        items.close()
+        self.assertTrue(responses[-1].closed)
+        self.assertEqual(len(list(api.drop('f').find_iter())), len(self.BODY))
+        self.assertTrue(responses[-1].closed)
+
+    def test_limits_and_hedges(self):
+        import json
+        import time
+        from flowthings.concurrency import AdaptiveLimit, PriorityLanes
+        body = self.envelope(self.BODY)
+        opened = []
+        class Chunks(object):
+            closed = False
+            def __init__(self):
+                self._chunks = iter(chunked(body, 16))
+            def __iter__(self):
+                return self._chunks
+            def close(self):
+                self.closed = True
+        def request(method, url, params=None, data=None, creds=None, stream=False):
+            chunks = Chunks()
+            opened.append((url, stream, chunks))
+            if url.endswith('/busy'):
+                busy = json.dumps({'head': {'status': 503, 'errors': ['busy']}, 'body': None})
+                return (chunked(busy, 10), {}, 503)
+            if len(opened) == 1 and url.endswith('/slow'):
+                time.sleep(0.1)
+            return (chunks, {}, 200)
+
+        adaptive = AdaptiveLimit(initial=4)
+        lanes = PriorityLanes(limit=adaptive)
+        api = TestAPI(request=request, encoder=json, concurrency=lanes)
+        self.assertEqual(list(api.with_priority('batch').drop('f').find_iter()), self.BODY)
+        self.assertRaises(FlowThingsException, list, api.flow.stream_request('GET', '/busy'))
+        snapshot = lanes.snapshot()
+        self.assertEqual(snapshot['lanes']['batch']['requests'], 1)
+        self.assertEqual(snapshot['lanes']['interactive']['requests'], 1)
+        self.assertEqual((snapshot['adaptive']['errors'], snapshot['adaptive']['inflight']), (1, 0))
+
+        # A hedged stream closes the response that lost.
+        del opened[:]
+        hedging = Hedging(delay=0.01, budget=1)
+        api = TestAPI(request=request, encoder=json, hedging=hedging)
+        self.assertEqual(list(api.flow.stream_request('GET', '/slow')), self.BODY)
+        self.assertEqual(hedging.hedge_wins, 1)
+        time.sleep(0.2)
+        self.assertEqual([(stream, c.closed) for _, stream, c in opened],
+                         [(True, True), (True, True)])
+
+    def test_encoder(self):
+        import json
+        class Encoder(object):
+            def loads(self, s):
+                return json.loads(s, parse_int=str)
+            def dumps(self, x):
+                return json.dumps(x)
+        def request(method, url, params=None, data=None, creds=None, stream=False):
+            return (iter(chunked(self.envelope(self.BODY[:2]), 7)), {}, 200)
+
+        api = TestAPI(request=request, encoder=Encoder())
+        self.assertEqual([d['elems']['n'] for d in api.drop('f').find_iter()], ['0', '1000'])
+
+
+class CompressionTestCase(TestCase):
+
+    def test_compress(self):
+        import zlib
+        c = Compression(threshold=10)
+        self.assertEqual(c.compress('short'), (b'short', None))
+        body, enc = c.compress('x' * 1000)
+        self.assertEqual(enc, 'gzip')
+        self.assertEqual(zlib.decompress(body, 31), b'x' * 1000)
+        body, enc = Compression(threshold=0, encoding='deflate').compress('abc')
+        self.assertEqual((zlib.decompress(body), enc), (b'abc', 'deflate'))
+        self.assertEqual((c.sent_raw, c.sent), (1005, 5 + len(c.compress('x' * 1000)[0])))
+
+    def test_transport_options(self):
+        c = Compression()
+        seen = []
+        def request(method, url, params=None, data=None, creds=None, compression=None):
+            seen.append(compression)
+            return mock_api_request_ok(method, url, params, data, creds)
+        TestAPI(request=request, compression=c).flow.read('foo')
+        self.assertTrue(seen[0] is c)
+        TestAPI().flow.read('foo')
+
+    def test_roundtrip(self):
+        import gzip
+        import json
+        import threading
+        from six import BytesIO
+        from six.moves import BaseHTTPServer
+        from flowthings.utils import api_request
+
+        received = []
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_PUT(self):
+                body = self.rfile.read(int(self.headers['content-length']))
+                received.append((self.headers['content-encoding'],
+                                 self.headers['accept-encoding'],
+                                 gzip.GzipFile(fileobj=BytesIO(body)).read()))
+                out = BytesIO()
+                with gzip.GzipFile(fileobj=out, mode='wb') as f:
+                    f.write(json.dumps({'head': {'status': 200},
+                                        'body': ['y' * 5000]}).encode('utf-8'))
+                self.send_response(200)
+                self.send_header('content-encoding', 'gzip')
+                self.send_header('content-length', str(len(out.getvalue())))
+                self.end_headers()
+                self.wfile.write(out.getvalue())
+            def log_message(self, *args):
+                pass
+
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            c = Compression(threshold=100)
+            api = API(CREDS, secure=False, host='127.0.0.1:%d' % server.server_port,
+                      request=api_request, compression=c)
+            resp = api.flow.update({'id': 'f', 'description': 'x' * 5000})
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        self.assertEqual(resp, ['y' * 5000])
+        encoding, accept, body = received[0]
+        self.assertEqual((encoding, accept), ('gzip', 'gzip, deflate'))
+        self.assertEqual(json.loads(body.decode('utf-8'))['description'], 'x' * 5000)
+        self.assertTrue(c.sent_ratio < 0.1)
+        self.assertTrue(c.received_ratio < 0.1)
+
+
 class AsyncTestCase(TestCase):
 
     def test_async_methods(self):
@@ -543,6 +1094,1555 @@ class FilterTestCase(TestCase):
         self.assertEqual(str((mem.foo == 1).OR(mem.bar == 2)), '(foo == 1) || (bar == 2)')
 
 
+class ParamsTestCase(TestCase):
+
+    def test_builder(self):
+        p = P(start=10, refs=True, only=['a', 'b']).limit(5).filter(mem.foo == 1)
+        self.assertEqual(p.to_dict(), {'start': 10, 'refs': 1, 'only': 'a,b',
+                                       'limit': 5, 'filter': 'foo == 1'})
+        self.assertRaises(AttributeError, lambda: p.__foo__)
+
+    def test_frozen(self):
+        from flowthings.builders import FrozenParams
+        a = P(limit=10, sorts=['x', 'y']).freeze()
+        b = FrozenParams({'sorts': ['x', 'y'], 'limit': 10})
+        self.assertEqual(a, b)
+        self.assertEqual(hash(a), hash(b))
+        self.assertEqual(len(set([a, b])), 1)
+        self.assertTrue(a.freeze() is a)
+        self.assertRaises(TypeError, a.__setitem__, 'limit', 1)
+        self.assertRaises(TypeError, a.update, {})
+
+    def test_service_params(self):
+        api = TestAPI(params={'hints': 0})
+        service = api.flow
+        self.assertTrue(service._mk_params(None) is service._params)
+        self.assertEqual(service.read('foo')['params'], {'hints': 0})
+        self.assertEqual(service.read('foo', limit=1)['params'], {'hints': 0, 'limit': 1})
+
+        frozen = P(limit=2).freeze()
+        api = TestAPI()
+        self.assertTrue(api.flow._mk_params(frozen) is frozen)
+        self.assertEqual(api.flow.request('GET', params=frozen)['params'], {'limit': 2})
+
+
+class ModifyTestCase(TestCase):
+
+    def test_done(self):
+        data = {'foo': 'bar'}
+        self.assertEqual(M(data, baz='qux').done(),
+                         ({'foo': 'bar', 'baz': 'qux'}, {'baz': 'qux'}))
+        self.assertEqual(data, {'foo': 'bar'})
+
+    def test_nested(self):
+        elems = {'temp': 1, 'unit': 'C'}
+        big = {'a': list(range(10))}
+        drop = {'id': 'd1', 'elems': elems, 'big': big}
+        mod = M(drop).modify('elems.temp', 2).modify('elems.loc.lat', 3)
+        self.assertEqual(mod.diff(), {'elems': {'temp': 2, 'loc': {'lat': 3}}})
+        self.assertEqual(mod['elems.temp'], 2)
+        self.assertEqual(mod.get('elems.unit'), 'C')
+        self.assertEqual(mod.get('elems.nope', 'x'), 'x')
+        self.assertEqual(mod['elems'], {'temp': 2, 'unit': 'C', 'loc': {'lat': 3}})
+        self.assertEqual(mod.model['elems'], {'temp': 2, 'unit': 'C', 'loc': {'lat': 3}})
+        self.assertTrue(mod.model['big'] is big)
+        self.assertEqual(elems, {'temp': 1, 'unit': 'C'})
+
+    def test_replaced_value_is_not_mutated(self):
+        value = {'a': 1}
+        mod = M({}).modify('elems', value).modify('elems.b', 2)
+        self.assertEqual(mod.diff(), {'elems': {'a': 1, 'b': 2}})
+        self.assertEqual(value, {'a': 1})
+
+    def test_update_sends_diff(self):
+        api = TestAPI()
+        resp = api.flow.update(M({'id': 'foo', 'displayName': 'foo'}).modify('elems.x', 1))
+        self.assertEqual(resp['url'], 'https://test/vtest/acc/flow/foo')
+        self.assertEqual(resp['data'], {'elems': {'x': 1}})
+        resp = api.flow.save([M({'id': 'foo'}, displayName='bar'), {'id': 'baz'}])
+        self.assertEqual(resp['data'], {'foo': {'displayName': 'bar'}, 'baz': {'id': 'baz'}})
+
+    def test_mapping_base(self):
+        from flowthings.api import GreenThunk
+        thunk = GreenThunk(lambda: { 'id': 'f1', 'name': 'a', 'elems': { 'x': 1 } })
+        mod = M(thunk, name='b').modify('elems.y', 2)
+        self.assertEqual(mod.done()[0], { 'id': 'f1', 'name': 'b', 'elems': { 'x': 1, 'y': 2 } })
+        self.assertEqual(mod['id'], 'f1')
+        resp = TestAPI().flow.update(mod)
+        self.assertEqual(resp['url'], 'https://test/vtest/acc/flow/f1')
+
+        tracked = Tracked(GreenThunk(lambda: { 'id': 'f1', 'elems': { 'x': 1 } }))
+        tracked['elems']['x'] = 2
+        self.assertEqual(tracked.diff(), { 'elems': { 'x': 2 } })
+
+
+class TrackedTestCase(TestCase):
+
+    def drop(self):
+        return {'id': 'd1', 'path': '/foo',
+                'elems': {'temp': 1, 'unit': 'C', 'loc': {'lat': 1, 'lon': 2}}}
+
+    def test_diff(self):
+        t = Tracked(self.drop())
+        t['elems']['temp'] = 2
+        t['elems']['unit'] = 'C'
+        t['elems']['loc']['lat'] = 5
+        t['path'] = '/foo'
+        self.assertEqual(t.diff(), {'elems': {'temp': 2, 'loc': {'lat': 5}}})
+        self.assertEqual(t['elems']['temp'], 2)
+        self.assertEqual(t.model['elems']['loc'], {'lat': 5, 'lon': 2})
+        self.assertEqual(t.reads, set(['elems', 'elems.temp', 'elems.loc']))
+
+    def test_replacement_diff(self):
+        t = Tracked(self.drop())
+        t['elems'] = {'temp': 1, 'unit': 'F', 'loc': {'lat': 1, 'lon': 2}}
+        self.assertEqual(t.diff(), {'elems': {'unit': 'F'}})
+        t['elems'] = {'temp': 1}
+        self.assertEqual(t.diff(), {'elems': {'temp': 1}})
+        t['elems'] = {'temp': True, 'unit': 'C', 'loc': {'lat': 1, 'lon': 2}}
+        self.assertEqual(t.diff(), {'elems': {'temp': True}})
+
+    def test_view(self):
+        t = Tracked(self.drop())
+        elems = t['elems']
+        self.assertEqual(elems, self.drop()['elems'])
+        self.assertEqual(sorted(elems.keys()), ['loc', 'temp', 'unit'])
+        self.assertTrue('unit' in elems)
+        self.assertEqual(elems.get('nope', 3), 3)
+        self.assertRaises(KeyError, lambda: t['nope'])
+
+    def test_save(self):
+        api = TestAPI(request=mock_api_request_ok)
+        t = Tracked(self.drop())
+        t['elems']['temp'] = 3
+        resp = api.drop('f').save(t)
+        self.assertEqual(resp['method'], 'PUT')
+        self.assertEqual(resp['data'], {'elems': {'temp': 3}})
+        resp = api.drop('f').update_many([t, Tracked({'id': 'd2', 'x': 1})])
+        self.assertEqual(resp['data'], {'d1': {'elems': {'temp': 3}}})
+
+    def test_read_tracked(self):
+        api = TestAPI()
+        t = api.flow.read_tracked('foo')
+        self.assertTrue(isinstance(t, Tracked))
+        t['method'] = 'POST'
+        self.assertEqual(t.diff(), {'method': 'POST'})
+
+
+class FilterEvaluationTestCase(TestCase):
+
+    DROP = {
+        'id': 'd1',
+        'creationDate': 0,
+        'elems': {
+            'temp': {'type': 'integer', 'value': 25},
+            'name': 'Sensor Foo',
+            'tags': ['a', 'b', 'c'],
+            'loc': {'type': 'location', 'value': {'lat': 40.7128, 'lon': -74.0060}},
+        },
+    }
+
+    def test_comparisons(self):
+        self.assertTrue((mem.elems.temp == 25).matches(self.DROP))
+        self.assertTrue((mem.elems.temp > 20).matches(self.DROP))
+        self.assertFalse((mem.elems.temp < 20).matches(self.DROP))
+        self.assertFalse((mem.elems.temp > 'a').matches(self.DROP))
+        self.assertFalse((mem.elems.missing != 1).matches(self.DROP))
+        self.assertTrue(mem.elems['name'].re('^sensor', 'i').matches(self.DROP))
+
+    def test_lists(self):
+        self.assertTrue(mem.elems.temp.IN(1, 25).matches(self.DROP))
+        self.assertFalse(mem.elems.temp.IN(1, 2).matches(self.DROP))
+        self.assertTrue(mem.elems.tags.CONTAINS('a', 'c').matches(self.DROP))
+        self.assertFalse(mem.elems.tags.CONTAINS('a', 'd').matches(self.DROP))
+
+    def test_prefix_filters(self):
+        self.assertTrue(EXISTS('elems.name').matches(self.DROP))
+        self.assertFalse(EXISTS(mem.elems.nope).matches(self.DROP))
+        self.assertTrue(HAS('location').matches(self.DROP))
+        self.assertTrue(HAS('list').matches(self.DROP))
+        self.assertFalse(HAS('float').matches(self.DROP))
+        self.assertTrue(MATCHES('foo', 'i').matches(self.DROP))
+        self.assertTrue(NOT(mem.elems.temp == 1).matches(self.DROP))
+        self.assertTrue((AGE > 1000).matches(self.DROP))
+        self.assertFalse(AGE('creationDate').__lt__(1000).matches(self.DROP))
+
+    def test_logical(self):
+        f = (mem.elems.temp > 30).OR(mem.elems['name'] == 'Sensor Foo')
+        self.assertTrue(f.matches(self.DROP))
+        self.assertFalse(f.AND(mem.id == 'd2').matches(self.DROP))
+        drops = [self.DROP, {'id': 'd2', 'elems': {'temp': 40}}]
+        self.assertEqual([d['id'] for d in filter((mem.elems.temp > 30).compile(), drops)], ['d2'])
+
+    def test_within(self):
+        self.assertTrue(mem.elems.loc.WITHIN(10, 'KM', [40.73, -73.99]).matches(self.DROP))
+        self.assertFalse(mem.elems.loc.WITHIN(1, 'MILES', [41.0, -74.0]).matches(self.DROP))
+        self.assertRaises(FlowThingsError, mem.elems.loc.WITHIN(1, zip=10001).compile)
+
+
+class BatchEvaluationTestCase(TestCase):
+
+    DROPS = [
+        {'id': 'a', 'creationDate': 0, 'elems': {'temp': 25, 'name': 'foo'}},
+        {'id': 'b', 'creationDate': 0, 'elems': {'temp': {'type': 'float', 'value': 12.5}}},
+        {'id': 'c', 'elems': {'temp': 'hot', 'name': 'bar', 'ok': True}},
+        {'id': 'd', 'creationDate': 10 ** 15, 'elems': {'temp': True}},
+        {'id': 'e', 'elems': {}},
+    ]
+
+    FILTERS = [
+        mem.elems.temp > 20,
+        mem.elems.temp <= 12.5,
+        mem.elems.temp == 25,
+        mem.elems.temp != 25,
+        mem.elems.temp == True,
+        mem.elems['name'] >= 'bar',
+        mem.elems['name'].IN('foo', 'baz', 25),
+        mem.elems.temp.IN(12.5, 'hot'),
+        mem.elems['name'].re('^f'),
+        AGE > 1000,
+        AGE <= 1000,
+        EXISTS('elems.name'),
+        NOT(EXISTS('elems.name')).OR(mem.elems.ok == True),
+        (mem.elems.temp > 1).AND(NOT(mem.id == 'd')),
+        HAS('boolean'),
+    ]
+
+    def setUp(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest('numpy is not installed')
+
+    def test_matches_scalar_evaluation(self):
+        from flowthings.columnar import evaluate_batch
+        for f in self.FILTERS:
+            expected = [f.matches(d) for d in self.DROPS]
+            self.assertEqual(list(evaluate_batch(f, self.DROPS)), expected, str(f))
+
+    def test_columns_are_reused(self):
+        from flowthings.columnar import Columns
+        cols = Columns(self.DROPS)
+        cols.evaluate(mem.elems.temp > 20)
+        cols.evaluate(mem.elems.temp < 20)
+        self.assertEqual(list(cols._columns), ['elems.temp'])
+
+
+class ExportTestCase(TestCase):
+
+    DROPS = [{'id': 'd%d' % i, 'elems': {'temp': i}} for i in range(5)]
+
+    def setUp(self):
+        self.calls = []
+
+    def paged_request(self, method, url, params=None, data=None, creds=None):
+        self.calls.append(params)
+        start, limit = params['start'], params['limit']
+        body = self.DROPS[start:start + limit]
+        if 'e' in params.get('filter', ''):
+            body = body[:-1]
+        return ({'head': {'status': 200}, 'body': body}, {}, 200)
+
+    def test_export_csv(self):
+        from six import StringIO
+        from flowthings.columnar import CSVWriter
+        api = TestAPI(request=self.paged_request)
+        out = StringIO()
+        rows = api.drop('foo').export(CSVWriter(out, lineterminator='\n'),
+                                      fields=['id', 'elems.temp', 'elems.nope'],
+                                      chunk_size=2)
+        self.assertEqual(rows, 5)
+        self.assertEqual(out.getvalue().splitlines()[:3],
+                         ['id,elems.temp,elems.nope', 'd0,0,', 'd1,1,'])
+        self.assertEqual([(c['start'], c['limit'], c['only']) for c in self.calls],
+                         [(0, 2, 'id,elems.temp,elems.nope'),
+                          (2, 2, 'id,elems.temp,elems.nope'),
+                          (4, 2, 'id,elems.temp,elems.nope')])
+
+    def test_export_numpy_only(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest('numpy is not installed')
+        from flowthings.columnar import NumpyWriter
+        api = TestAPI(request=self.paged_request)
+        res = api.drop('foo').export(NumpyWriter({'elems.temp': float}),
+                                     mem.id == 'e', only='id,elems.temp',
+                                     chunk_size=5)
+        self.assertEqual(list(res['id']), ['d0', 'd1', 'd2', 'd3'])
+        self.assertEqual(res['elems.temp'].dtype, numpy.float64)
+        self.assertEqual(len(self.calls), 1)
+
+    def test_export_requires_fields(self):
+        api = TestAPI(request=self.paged_request)
+        self.assertRaises(FlowThingsError, api.drop('foo').export, None)
+
+
+class OfflineQueueTestCase(TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.dir)
+
+    def record(self, i):
+        return { 'id': 'r%d' % i, 'flow': 'f', 'drop': { 'elems': { 'n': i } } }
+
+    def test_append_and_recover(self):
+        from flowthings.offline import DropQueue
+        q = DropQueue(self.dir, segment_size=256)
+        for i in range(10):
+            self.assertEqual(q.append(self.record(i)), i + 1)
+        self.assertEqual(q.append(self.record(3)), None)
+        q.ack(4, ['r0', 'r1', 'r2', 'r3'])
+        q.close()
+
+        q = DropQueue(self.dir, segment_size=256)
+        self.assertEqual(len(q), 6)
+        self.assertEqual([r['id'] for _, r in q.pending()],
+                         ['r%d' % i for i in range(4, 10)])
+        self.assertEqual(q.append(self.record(10)), 11)
+        q.close()
+
+    def test_torn_write(self):
+        import os
+        from flowthings.offline import DropQueue
+        q = DropQueue(self.dir)
+        q.append(self.record(0))
+        q.append(self.record(1))
+        q.close()
+        seg = [f for f in os.listdir(self.dir) if f.endswith('.seg')][0]
+        with open(os.path.join(self.dir, seg), 'r+b') as f:
+            data = f.read(200)
+            f.seek(data.index(b'"r1"'))
+            f.write(b'X')
+
+        q = DropQueue(self.dir)
+        self.assertEqual([r['id'] for _, r in q.pending()], ['r0'])
+        self.assertEqual(q.append(self.record(2)), 2)
+        q.close()
+
+    def test_segments_removed_when_acked(self):
+        import os
+        from flowthings.offline import DropQueue
+        q = DropQueue(self.dir, segment_size=256)
+        for i in range(10):
+            q.append(self.record(i))
+        segments = lambda: [f for f in os.listdir(self.dir) if f.endswith('.seg')]
+        self.assertTrue(len(segments()) > 2)
+        q.ack(10)
+        self.assertEqual(len(segments()), 1)
+        self.assertEqual(len(q), 0)
+        self.assertRaises(FlowThingsError, q.append,
+                          { 'id': 'big', 'flow': 'f', 'drop': 'x' * 1000 })
+        q.close()
+
+    def test_writer(self):
+        from flowthings.offline import DropQueue, DropWriter
+        state = { 'up': False, 'sent': [] }
+        def request(method, url, params=None, data=None, creds=None):
+            if not state['up']:
+                raise IOError('offline')
+            if data['elems']['n'] == 2:
+                raise FlowThingsBadRequest
+            state['sent'].append(data['elems']['n'])
+            return mock_api_request_ok(method, url, params, data, creds)
+
+        rejected = []
+        q = DropQueue(self.dir)
+        writer = DropWriter(TestAPI(request=request), q, batch_size=2,
+                            on_reject=lambda r, e: rejected.append(r['id']))
+        for i in range(4):
+            self.assertEqual(writer.create('f', { 'elems': { 'n': i } }, id='r%d' % i), None)
+        self.assertEqual(writer.replay(), 0)
+        self.assertEqual(len(q), 4)
+
+        state['up'] = True
+        # Queued drops keep their place ahead of new ones.
+        writer.create('f', { 'elems': { 'n': 4 } })
+        self.assertEqual(writer.replay(), 4)
+        self.assertEqual(state['sent'], [0, 1, 3, 4])
+        self.assertEqual(rejected, ['r2'])
+        self.assertEqual(len(q), 0)
+        self.assertEqual(writer.create('f', { 'elems': { 'n': 5 } })['method'], 'POST')
+        q.close()
+
+    def test_acked_ids_persist(self):
+        import os
+        from flowthings.offline import DropQueue
+        q = DropQueue(self.dir, remember=3)
+        for i in range(8):
+            q.append(self.record(i))
+        for i in range(8):
+            q.ack(i + 1, ['r%d' % i])
+        q.close()
+        with open(os.path.join(self.dir, 'acked-ids')) as f:
+            self.assertTrue(len(f.readlines()) <= 6)
+
+        q = DropQueue(self.dir, remember=3)
+        self.assertEqual(q.append(self.record(7)), None)
+        self.assertEqual(q.append(self.record(5)), None)
+        self.assertEqual(q.append(self.record(4)), 9)
+        q.close()
+
+    def test_replay_after_crash(self):
+        from flowthings.offline import DropQueue, DropWriter
+        sent = []
+        def request(method, url, params=None, data=None, creds=None):
+            sent.append(data['elems']['n'])
+            return mock_api_request_ok(method, url, params, data, creds)
+
+        q = DropQueue(self.dir)
+        q.append(self.record(0))
+        q.append(self.record(1))
+        # The ids were logged, but the process stopped before the ack.
+        q._write_ids(['r0'])
+        q.close()
+
+        q = DropQueue(self.dir)
+        self.assertEqual(DropWriter(TestAPI(request=request), q).replay(), 1)
+        self.assertEqual((sent, len(q)), ([1], 0))
+        q.close()
+
+    def test_id_field(self):
+        from flowthings.offline import DropQueue, DropWriter
+        sent = []
+        def request(method, url, params=None, data=None, creds=None):
+            sent.append(data)
+            return mock_api_request_ok(method, url, params, data, creds)
+
+        q = DropQueue(self.dir)
+        DropWriter(TestAPI(request=request), q).create('f', { 'elems': {} }, id='a')
+        DropWriter(TestAPI(request=request), q, id_field='clientId').create('f', { 'elems': {} }, id='b')
+        self.assertEqual(sent, [{ 'elems': {} }, { 'elems': {}, 'clientId': 'b' }])
+        q.close()
+
+    def test_concurrent_creates(self):
+        import time
+        import threading
+        from flowthings.offline import DropQueue, DropWriter
+        state = { 'inflight': 0, 'peak': 0 }
+        lock = threading.Lock()
+        def request(method, url, params=None, data=None, creds=None):
+            with lock:
+                state['inflight'] += 1
+                state['peak'] = max(state['peak'], state['inflight'])
+            time.sleep(0.05)
+            with lock:
+                state['inflight'] -= 1
+            return mock_api_request_ok(method, url, params, data, creds)
+
+        q = DropQueue(self.dir)
+        writer = DropWriter(TestAPI(request=request), q)
+        threads = [threading.Thread(target=writer.create, args=('f', { 'elems': {} }))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Sends overlap rather than waiting on each other.
+        self.assertEqual((state['peak'], len(q)), (4, 0))
+        q.close()
+
+
+class FakeServerTestCase(TestCase):
+
+    def setUp(self):
+        from flowthings.testing import FakeServer
+        self.server = FakeServer(seed=0).start()
+        self.api = self.server.api()
+        self.flow = self.api.flow.create({ 'path': '/acc/test' })
+        self.drops = self.api.drop(self.flow['id'])
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_crud(self):
+        drop = self.drops.create({ 'elems': { 'n': 1 } })
+        self.assertEqual(self.drops.read(drop['id'])['elems'], { 'n': 1 })
+        self.drops.update(M(drop).modify('elems.n', 2))
+        self.drops.update_many([{ 'id': drop['id'], 'elems': { 'n': 3 } }])
+        self.assertEqual(self.drops.read_many([drop['id'], 'missing']),
+                         { drop['id']: self.drops.read(drop['id']) })
+        self.assertEqual(self.drops.read(drop['id'])['elems'], { 'n': 3 })
+        self.api.drop.create({ 'path': '/acc/test', 'elems': { 'n': 4 } })
+        self.assertEqual(self.drops.aggregate(['$count', '$sum:n']),
+                         [{ '$count': 2, '$sum:n': 7 }])
+        self.drops.delete(drop['id'])
+        self.assertRaises(FlowThingsNotFound, self.drops.read, drop['id'])
+        self.assertEqual(self.server.log[-1],
+                         ('GET', '/v4.0/acc/drop/%s/%s' % (self.flow['id'], drop['id'])))
+
+    def test_injected_failures(self):
+        self.server.fail_next(2, status=400)
+        self.assertRaises(FlowThingsBadRequest, self.api.flow.read, self.flow['id'])
+        self.assertRaises(FlowThingsBadRequest, self.api.flow.read, self.flow['id'])
+        self.assertEqual(self.api.flow.read(self.flow['id'])['path'], '/acc/test')
+        self.server.error_rate = 1
+        self.assertRaises(FlowThingsServerError, self.api.flow.read, self.flow['id'])
+        self.server.error_rate = 0
+        seen = []
+        self.server.latency = lambda method, path: seen.append(method) or 0
+        self.api.flow.read(self.flow['id'])
+        self.assertEqual(seen, ['GET'])
+
+    def test_websocket(self):
+        import threading
+        got = []
+        def on_open(ws):
+            ws.subscribe(self.flow['id'],
+                         lambda ws, body: self.drops.create({ 'elems': { 'n': 5 } }))
+        def on_message(ws, resource, value):
+            got.append((resource, value['elems']))
+            ws.send({ 'object': 'drop', 'type': 'find', 'flowId': resource,
+                      'id': value['id'] }, on_find)
+        def on_find(ws, body):
+            got.append(body['elems'])
+            ws._app.close()
+
+        client = self.api.websocket.connect(on_open=on_open, on_message=on_message)
+        thread = threading.Thread(target=client.run)
+        thread.start()
+        thread.join(10)
+        self.assertEqual(got, [(self.flow['id'], { 'n': 5 }), { 'n': 5 }])
+
+
+class BatchLoaderTestCase(TestCase):
+
+    def setUp(self):
+        from flowthings.testing import FakeServer
+        self.server = FakeServer().start()
+        self.api = self.server.api()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def read_concurrently(self, service, ids, **kwargs):
+        import threading
+        results = {}
+        def read(id):
+            try:
+                results[id] = service.read_batched(id, **kwargs)
+            except FlowThingsException as e:
+                results[id] = e
+        threads = [threading.Thread(target=read, args=(id,)) for id in ids]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+    def test_coalesces_reads(self):
+        flows = [self.api.flow.create({ 'path': '/acc/%d' % i }) for i in range(5)]
+        self.api.flow.loader.window = 0.05
+        del self.server.log[:]
+
+        ids = [f['id'] for f in flows] + [flows[0]['id'], 'missing']
+        results = self.read_concurrently(self.api.flow, ids)
+        self.assertEqual([m for m, _ in self.server.log], ['MGET'])
+        for f in flows:
+            self.assertEqual(results[f['id']]['path'], f['path'])
+        self.assertTrue(isinstance(results['missing'], FlowThingsNotFound))
+        self.assertEqual(results['missing'].path, '/flow/missing')
+
+    def test_batches_by_params_and_size(self):
+        flows = [self.api.flow.create({ 'path': '/acc/%d' % i }) for i in range(4)]
+        self.api.flow.loader.window = 0.05
+        self.api.flow.loader.max_batch = 2
+        del self.server.log[:]
+        self.read_concurrently(self.api.flow, [f['id'] for f in flows])
+        self.assertEqual([m for m, _ in self.server.log], ['MGET', 'MGET'])
+
+        self.api.flow.loader.max_batch = 100
+        del self.server.log[:]
+        results = self.read_concurrently(self.api.flow, [flows[0]['id']], only='path')
+        results.update(self.read_concurrently(self.api.flow, [flows[1]['id']]))
+        self.assertEqual(len(self.server.log), 2)
+        self.assertEqual(len(results), 2)
+
+    def test_lone_reads_dont_wait(self):
+        import time
+        flows = [self.api.flow.create({ 'path': '/acc/%d' % i }) for i in range(3)]
+        self.api.flow.loader.window = 0.2
+        start = time.time()
+        for f in flows:
+            self.assertEqual(self.api.flow.read_batched(f['id'])['path'], f['path'])
+        # Only the first read waits, until reads are seen to be uncontended.
+        self.assertTrue(time.time() - start < 0.35)
+
+    def test_refs(self):
+        flows = [self.api.flow.create({ 'path': '/acc/%d' % i }) for i in range(2)]
+        self.api.flow.loader.window = 0.05
+        results = self.read_concurrently(self.api.flow, [f['id'] for f in flows], refs=True)
+        for f in flows:
+            self.assertEqual(results[f['id']], (f, {}))
+
+    def test_errors_reach_every_caller(self):
+        flow = self.api.flow.create({ 'path': '/acc/x' })
+        self.api.flow.loader.window = 0.05
+        self.server.fail_next()
+        results = self.read_concurrently(self.api.flow, [flow['id'], 'other'])
+        self.assertTrue(all(isinstance(r, FlowThingsServerError) for r in results.values()))
+
+
+class ConditionalCacheTestCase(TestCase):
+
+    def serve(self, **kwargs):
+        from flowthings.testing import FakeServer
+        server = FakeServer(**kwargs).start()
+        self.addCleanup(server.stop)
+        self.cache = ConditionalCache(max_entries=2)
+        api = server.api(conditional=self.cache)
+        return api, api.flow.create({ 'path': '/acc/x' })
+
+    def test_etag(self):
+        api, flow = self.serve(validators=('etag',))
+        self.assertEqual(api.flow.read(flow['id']), flow)
+        self.assertEqual(api.flow.read(flow['id']), flow)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+        api.flow.update(M(flow).modify('description', 'changed'))
+        self.assertEqual(api.flow.read(flow['id'])['description'], 'changed')
+        self.assertEqual(api.flow.read(flow['id'])['description'], 'changed')
+        self.assertEqual((self.cache.hits, self.cache.misses), (2, 2))
+
+        # Params are part of the key.
+        api.flow.read(flow['id'], only='path')
+        self.assertEqual((self.cache.hits, self.cache.misses), (2, 3))
+
+    def test_last_modified(self):
+        api, flow = self.serve(validators=('last-modified',))
+        api.flow.read(flow['id'])
+        api.flow.find_many(limit=5)
+        self.assertEqual(api.flow.read(flow['id']), flow)
+        self.assertEqual(api.flow.find_many(limit=5), [flow])
+        self.assertEqual(self.cache.hits, 2)
+
+    def test_without_validators(self):
+        api, flow = self.serve(validators=())
+        api.flow.read(flow['id'])
+        self.assertEqual(api.flow.read(flow['id']), flow)
+        self.assertEqual(self.cache.hits, 0)
+        self.assertEqual(self.cache.get(self.cache.key(
+            'http://%s/v4.0/acc/flow/%s' % (api.flow._host, flow['id']), None, CREDS)), None)
+
+    def test_lru(self):
+        api, flow = self.serve()
+        other = api.flow.create({ 'path': '/acc/y' })
+        api.flow.read(flow['id'])
+        api.flow.read(other['id'])
+        api.flow.find_many()
+        api.flow.read(flow['id'])
+        self.assertEqual(self.cache.hits, 0)
+        api.flow.read(flow['id'])
+        self.assertEqual(self.cache.hits, 1)
+
+
+class HedgingTestCase(TestCase):
+
+    def slow_then_fast(self, slow=0.5, error=None):
+        import time
+        calls = []
+        def request(method, url, params=None, data=None, creds=None):
+            calls.append(method)
+            if len(calls) == 1:
+                time.sleep(slow)
+                if error:
+                    raise error
+            return mock_api_request_ok(method, url, params, data, creds)
+        return request, calls
+
+    def test_hedges_slow_reads(self):
+        import time
+        request, calls = self.slow_then_fast()
+        hedging = Hedging(delay=0.02, budget=1)
+        api = TestAPI(request=request, hedging=hedging)
+        start = time.time()
+        self.assertEqual(api.flow.read('f')['method'], 'GET')
+        self.assertTrue(time.time() - start < 0.4)
+        self.assertEqual((hedging.requests, hedging.hedges, hedging.hedge_wins), (1, 1, 1))
+        self.assertEqual(len(calls), 2)
+
+        # Writes are never hedged.
+        api.flow.create({})
+        self.assertEqual(hedging.requests, 1)
+
+    def test_budget(self):
+        request, calls = self.slow_then_fast(slow=0.1)
+        hedging = Hedging(delay=0.01, budget=0.5)
+        api = TestAPI(request=request, hedging=hedging)
+        api.flow.read('f')
+        self.assertEqual((hedging.hedges, len(calls)), (0, 1))
+
+    def test_failures(self):
+        request, calls = self.slow_then_fast(slow=0.05, error=IOError('reset'))
+        hedging = Hedging(delay=0.01, budget=1)
+        api = TestAPI(request=request, hedging=hedging)
+        self.assertEqual(api.flow.read('f')['method'], 'GET')
+
+        def fail(method, url, params=None, data=None, creds=None):
+            raise IOError('down')
+        api = TestAPI(request=fail, hedging=hedging)
+        self.assertRaises(IOError, api.flow.read, 'f')
+
+    def test_observed_delay(self):
+        hedging = Hedging(percentile=0.9, min_samples=10, initial_delay=1)
+        for i in range(9):
+            hedging.record(i / 100.0)
+        self.assertEqual(hedging.delay, 1)
+        hedging.record(0.09)
+        self.assertEqual(hedging.delay, 0.09)
+        self.assertEqual(Hedging(delay=0.2).delay, 0.2)
+
+    def test_inline_without_budget(self):
+        import threading
+        threads = []
+        def request(method, url, params=None, data=None, creds=None):
+            threads.append(threading.current_thread())
+            return mock_api_request_ok(method, url, params, data, creds)
+        hedging = Hedging(delay=0.01, budget=0.01)
+        api = TestAPI(request=request, hedging=hedging)
+        api.flow.read('f')
+        self.assertEqual(threads, [threading.current_thread()])
+        self.assertEqual(len(hedging._latencies), 1)
+
+    def test_reuses_workers(self):
+        import time
+        from flowthings.utils import workers
+        hedging = Hedging(delay=1, budget=1)
+        api = TestAPI(hedging=hedging)
+        api.flow.read('f')
+        time.sleep(0.01)
+        threads = workers()._threads
+        for i in range(20):
+            api.flow.read('f')
+            time.sleep(0.001)
+        self.assertEqual(workers()._threads, threads)
+
+    def test_records_both(self):
+        import time
+        request, calls = self.slow_then_fast(slow=0.1)
+        hedging = Hedging(delay=0.01, budget=1)
+        api = TestAPI(request=request, hedging=hedging)
+        api.flow.read('f')
+        time.sleep(0.2)
+        latencies = sorted(hedging._latencies)
+        self.assertEqual(len(latencies), 2)
+        self.assertTrue(latencies[1] >= 0.1)
+
+    def test_async_lib(self):
+        import sys
+        import types
+        import threading
+        from six.moves import queue
+        spawned = []
+        lib = types.ModuleType('fakegreen')
+        def spawn(fn, *args):
+            spawned.append(fn)
+            threading.Thread(target=fn, args=args).start()
+        lib.spawn = spawn
+        sys.modules['fakegreen'] = lib
+        sys.modules['fakegreen.queue'] = queue
+        try:
+            request, calls = self.slow_then_fast(slow=0.1)
+            hedging = Hedging(delay=0.01, budget=1, async_lib=lib)
+            api = TestAPI(request=request, hedging=hedging)
+            self.assertEqual(api.flow.read('f')['method'], 'GET')
+            self.assertEqual((len(spawned), hedging.hedge_wins), (2, 1))
+        finally:
+            del sys.modules['fakegreen'], sys.modules['fakegreen.queue']
+
+
+class AdaptiveLimitTestCase(TestCase):
+
+    def test_increase(self):
+        from flowthings.concurrency import AdaptiveLimit
+        limit = AdaptiveLimit(initial=2, max_limit=3)
+        for i in range(6):
+            limit.acquire()
+            limit.release(0.01)
+        self.assertEqual(limit.limit, 3)
+        self.assertEqual(limit.increases, 1)
+        self.assertEqual([d[1:] for d in limit.decisions], [('increase', 2, 3)])
+
+    def test_decrease(self):
+        from flowthings.concurrency import AdaptiveLimit
+        limit = AdaptiveLimit(initial=10, backoff=0.5, min_limit=2)
+        for i in range(10):
+            limit.acquire()
+            limit.release(0.01)
+        self.assertEqual(limit.limit, 11)
+
+        # A burst of errors only backs off once per `limit` completions.
+        for i in range(3):
+            limit.acquire()
+            limit.release(error=True)
+        self.assertEqual((limit.limit, limit.decreases, limit.errors), (5, 1, 3))
+
+        for i in range(5):
+            limit.acquire()
+            limit.release(0.05)
+        self.assertEqual(limit.limit, 2)
+        self.assertEqual([d[1] for d in limit.decisions], ['increase', 'error', 'latency'])
+        self.assertEqual(limit.snapshot()['inflight'], 0)
+
+    def test_limits_requests(self):
+        import time
+        import threading
+        from flowthings.concurrency import AdaptiveLimit
+        state = { 'inflight': 0, 'peak': 0 }
+        lock = threading.Lock()
+        def request(method, url, params=None, data=None, creds=None):
+            with lock:
+                state['inflight'] += 1
+                state['peak'] = max(state['peak'], state['inflight'])
+            time.sleep(0.01)
+            with lock:
+                state['inflight'] -= 1
+            resp = { 'head': { 'ok': False, 'status': 503, 'errors': ['busy'],
+                               'messages': [], 'references': {} },
+                     'body': None }
+            return (resp, {}, 503)
+
+        concurrency = AdaptiveLimit(initial=4, min_limit=2, backoff=0.5)
+        api = TestAPI(request=request, concurrency=concurrency)
+        raised = []
+        def read():
+            try:
+                api.flow.read('f')
+            except Exception as e:
+                raised.append(e)
+        threads = [threading.Thread(target=read) for i in range(12)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(raised), 12)
+        self.assertTrue(all(type(e) is FlowThingsException for e in raised))
+        self.assertTrue(state['peak'] <= 4)
+        self.assertEqual(concurrency.limit, 2)
+        self.assertEqual(concurrency.errors, 12)
+
+
+class PriorityLanesTestCase(TestCase):
+
+    def run_calls(self, lanes, calls, hold):
+        """ Starts `calls` of `(lane, label)` in order behind a held slot, and
+        returns the order they ran in. """
+        import time
+        import threading
+        ran = []
+        release = threading.Event()
+        def blocker():
+            release.wait()
+        threads = [threading.Thread(target=lanes.lane(hold).call, args=(blocker,))]
+        for lane, label in calls:
+            threads.append(threading.Thread(target=lanes.lane(lane).call,
+                                            args=(ran.append, label)))
+        for thread in threads:
+            thread.start()
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+        return ran
+
+    def test_preempts_queued_batch_work(self):
+        from flowthings.concurrency import PriorityLanes
+        lanes = PriorityLanes((('interactive', 1), ('batch', 1)), limit=1)
+        ran = self.run_calls(lanes, [('batch', 'b1'), ('batch', 'b2'), ('interactive', 'i1')],
+                             hold='batch')
+        self.assertEqual(ran, ['i1', 'b1', 'b2'])
+
+        stats = lanes.snapshot()['lanes']
+        self.assertEqual((stats['batch']['requests'], stats['interactive']['requests']), (3, 1))
+        self.assertEqual(stats['batch']['queued'], 0)
+        self.assertTrue(stats['batch']['max_queue_time'] > stats['interactive']['queue_time'] > 0)
+
+    def test_quotas(self):
+        from flowthings.concurrency import PriorityLanes
+        lanes = PriorityLanes((('interactive', 2), ('batch', 1)), limit=2)
+        # The batch lane is full, so interactive calls don't wait behind it.
+        ran = self.run_calls(lanes, [('batch', 'b1'), ('interactive', 'i1')], hold='batch')
+        self.assertEqual(ran, ['i1', 'b1'])
+        self.assertRaises(ValueError, lanes.lane, 'bulk')
+
+    def test_with_priority(self):
+        from flowthings.concurrency import PriorityLanes
+        lanes = PriorityLanes()
+        api = TestAPI(concurrency=lanes)
+        batch = api.with_priority('batch')
+        self.assertTrue(api.with_priority('batch') is batch)
+        batch.flow.read('f')
+        batch.drop('f').find()
+        api.flow.read('f')
+        api.with_creds(Token('other', 'token')).with_priority('batch').flow.read('f')
+        stats = lanes.snapshot()['lanes']
+        self.assertEqual((stats['interactive']['requests'], stats['batch']['requests']), (1, 3))
+
+        self.assertRaises(ValueError, api.with_priority, 'bulk')
+        self.assertRaises(ValueError, TestAPI().with_priority, 'batch')
+
+    def test_adaptive_limit(self):
+        import time
+        import threading
+        from flowthings.concurrency import AdaptiveLimit, PriorityLanes
+        state = { 'inflight': 0, 'peak': 0 }
+        lock = threading.Lock()
+        def request(method, url, params=None, data=None, creds=None):
+            with lock:
+                state['inflight'] += 1
+                state['peak'] = max(state['peak'], state['inflight'])
+            time.sleep(0.01)
+            with lock:
+                state['inflight'] -= 1
+            resp = { 'head': { 'ok': False, 'status': 503, 'errors': ['busy'],
+                               'messages': [], 'references': {} },
+                     'body': None }
+            return (resp, {}, 503)
+
+        adaptive = AdaptiveLimit(initial=4, min_limit=2, backoff=0.5)
+        lanes = PriorityLanes((('interactive', 4), ('batch', 2)), limit=adaptive)
+        api = TestAPI(request=request, concurrency=lanes)
+        batch = api.with_priority('batch')
+        raised = []
+        def read(api):
+            try:
+                api.flow.read('f')
+            except FlowThingsException as e:
+                raised.append(e)
+        threads = [threading.Thread(target=read, args=(api if i % 2 else batch,))
+                   for i in range(12)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(raised), 12)
+        self.assertTrue(state['peak'] <= 4)
+        self.assertEqual((adaptive.limit, adaptive.errors), (2, 12))
+        snapshot = lanes.snapshot()
+        self.assertEqual(snapshot['limit'], 2)
+        self.assertEqual(snapshot['adaptive']['inflight'], 0)
+        self.assertEqual(snapshot['lanes']['batch']['requests'], 6)
+
+
+class HTTP2TransportTestCase(TestCase):
+
+    def setUp(self):
+        from flowthings.http2 import HTTP2Transport
+        from flowthings.testing import FakeServer
+        try:
+            self.transport = HTTP2Transport()
+        except NotImplementedError:
+            self.skipTest('httpx is not installed')
+        self.server = FakeServer().start()
+        self.api = self.server.api(request=self.transport, compression=Compression(threshold=0))
+
+    def tearDown(self):
+        self.transport.close()
+        self.server.stop()
+
+    def test_requires_httpx(self):
+        import sys
+        from flowthings.http2 import HTTP2Transport
+        httpx = sys.modules['httpx']
+        sys.modules['httpx'] = None
+        try:
+            self.assertRaises(NotImplementedError, HTTP2Transport)
+        finally:
+            sys.modules['httpx'] = httpx
+
+    def test_requests(self):
+        flow = self.api.flow.create({ 'path': '/acc/h2' })
+        drops = self.api.drop(flow['id'])
+        ids = [drops.create({ 'elems': { 'n': i } })['id'] for i in range(3)]
+        self.assertEqual(sorted(drops.read_many(ids)), sorted(ids))
+        self.assertEqual([d['id'] for d in drops.find_iter()], ids[::-1])
+        self.assertRaises(FlowThingsNotFound, drops.read, 'missing')
+        # Plain http can't negotiate HTTP/2, so this falls back to HTTP/1.1.
+        self.assertEqual(list(self.transport.versions), ['HTTP/1.1'])
+
+    def test_threads(self):
+        import threading
+        flow = self.api.flow.create({ 'path': '/acc/h2' })
+        drops = self.api.drop(flow['id'])
+        ids = [drops.create({ 'elems': { 'n': i } })['id'] for i in range(3)]
+        results = []
+        threads = [threading.Thread(target=lambda id=id: results.append(drops.read(id)))
+                   for id in ids * 4]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(results), 12)
+        # Before httpcore 0.15 every thread, this one too, gets its own client.
+        self.assertEqual(len(self.transport._opened), 1 if self.transport.shared else 13)
+
+    def test_multiplexes(self):
+        import json
+        import socket
+        import threading
+        import h2.config
+        import h2.connection
+        import h2.events
+        from flowthings.http2 import HTTP2Transport
+        if not self.transport.shared:
+            self.skipTest('threads only share connections from httpcore 0.15')
+
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(4)
+        body = json.dumps({ 'head': { 'ok': True, 'status': 200, 'errors': [],
+                                      'messages': [], 'references': {} },
+                            'body': {} }).encode('utf-8')
+        state = { 'connections': 0, 'concurrent': 0 }
+
+        def serve(sock):
+            # Answers only once 4 requests are open at the same time, or
+            # after a second, so requests in turn can't make it pass.
+            conn = h2.connection.H2Connection(h2.config.H2Configuration(client_side=False))
+            conn.initiate_connection()
+            sock.sendall(conn.data_to_send())
+            sock.settimeout(1)
+            waiting = []
+            while True:
+                try:
+                    data = sock.recv(65535)
+                except socket.timeout:
+                    data = None
+                if data == b'':
+                    break
+                for event in conn.receive_data(data or b''):
+                    if isinstance(event, h2.events.StreamEnded):
+                        waiting.append(event.stream_id)
+                state['concurrent'] = max(state['concurrent'], len(waiting))
+                if len(waiting) >= 4 or data is None:
+                    for stream_id in waiting:
+                        conn.send_headers(stream_id, [(':status', '200'),
+                                                      ('content-type', 'application/json')])
+                        conn.send_data(stream_id, body, end_stream=True)
+                    waiting = []
+                sock.sendall(conn.data_to_send())
+            sock.close()
+
+        def accept():
+            while True:
+                sock, _ = listener.accept()
+                state['connections'] += 1
+                thread = threading.Thread(target=serve, args=(sock,))
+                thread.daemon = True
+                thread.start()
+
+        thread = threading.Thread(target=accept)
+        thread.daemon = True
+        thread.start()
+
+        transport = HTTP2Transport(max_connections=1, prior_knowledge=True)
+        url = 'http://127.0.0.1:%d/v0.1/acc/drop/f' % listener.getsockname()[1]
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(transport('GET', url, creds=CREDS)))
+                   for i in range(4)]
+        try:
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            transport.close()
+            listener.close()
+        self.assertEqual([status for _, _, status in results], [200] * 4)
+        self.assertEqual(transport.versions, { 'HTTP/2': 4 })
+        self.assertEqual((state['connections'], state['concurrent']), (1, 4))
+
+
+class HTTP2ClientTestCase(TestCase):
+    """ Runs the transport against a stand-in for httpx, so that it is
+    covered where httpx isn't installed. """
+
+    def setUp(self):
+        import sys
+        import types
+        self.sent = []
+        self.clients = []
+        test = self
+
+        class Response(object):
+            status_code = 200
+            http_version = 'HTTP/2'
+            headers = { 'content-type': 'application/json' }
+            text = '{"ok": true}'
+            content = b'{"ok": true}'
+            closed = False
+
+            def iter_bytes(self, chunk_size):
+                return iter([self.content])
+
+            def close(self):
+                self.closed = True
+
+        class Client(object):
+            def __init__(self, **kwargs):
+                self.kwargs = kwargs
+                self.closed = False
+                test.clients.append(self)
+
+            def build_request(self, method, url, **kwargs):
+                return (method, url, kwargs)
+
+            def send(self, request, stream=False):
+                test.sent.append((request, stream))
+                return Response()
+
+            def close(self):
+                self.closed = True
+
+        httpx = types.ModuleType('httpx')
+        httpx.Client = Client
+        httpx.Limits = lambda **kwargs: kwargs
+        self.httpcore = types.ModuleType('httpcore')
+        self.httpcore.__version__ = '0.15.0'
+        self.modules = dict((name, sys.modules.get(name))
+                            for name in ('httpx', 'httpcore', 'h2'))
+        sys.modules['httpx'] = httpx
+        sys.modules['httpcore'] = self.httpcore
+        sys.modules['h2'] = types.ModuleType('h2')
+
+    def tearDown(self):
+        import sys
+        for name, module in self.modules.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+
+    def test_requests(self):
+        from flowthings.http2 import HTTP2Transport
+        transport = HTTP2Transport(max_connections=2)
+        text, headers, status = transport('POST', 'https://api.test/x', data='{}', creds=CREDS)
+        self.assertEqual((text, status), ('{"ok": true}', 200))
+        (method, url, kwargs), stream = self.sent[0]
+        self.assertEqual((method, url, kwargs['content'], stream), ('POST', 'https://api.test/x', '{}', False))
+        self.assertEqual(kwargs['headers']['x-auth-token'], 'tok')
+        self.assertEqual(transport.versions, { 'HTTP/2': 1 })
+
+        chunks, _, _ = transport('GET', 'https://api.test/x', creds=CREDS, stream=True)
+        self.assertEqual(list(chunks), [b'{"ok": true}'])
+
+        # One client is shared, with a finite timeout by default.
+        self.assertEqual(len(self.clients), 1)
+        client = self.clients[0]
+        self.assertEqual(client.kwargs['timeout'], 30)
+        self.assertEqual(client.kwargs['limits']['max_connections'], 2)
+        self.assertEqual((client.kwargs['http1'], client.kwargs['http2']), (True, True))
+        transport.close()
+        self.assertTrue(client.closed)
+
+    def test_thread_clients(self):
+        import threading
+        from flowthings.http2 import HTTP2Transport
+        self.assertTrue(HTTP2Transport().shared)
+        self.httpcore.__version__ = '0.14.7'
+        transport = HTTP2Transport()
+        self.assertFalse(transport.shared)
+        transport('GET', 'https://api.test/x', creds=CREDS)
+        transport('GET', 'https://api.test/x', creds=CREDS)
+        thread = threading.Thread(target=transport, args=('GET', 'https://api.test/x'),
+                                  kwargs={ 'creds': CREDS })
+        thread.start()
+        thread.join()
+        # One client for this thread, reused, and another for the other one.
+        self.assertEqual(len(self.clients), 2)
+        transport.close()
+        self.assertEqual([c.closed for c in self.clients], [True, True])
+        transport('GET', 'https://api.test/x', creds=CREDS)
+        self.assertEqual(len(self.clients), 3)
+
+
+class WebSocketTransportTestCase(TestCase):
+
+    def setUp(self):
+        from flowthings.ws import WebSocketTransport
+        from flowthings.testing import FakeServer
+        from flowthings.utils import api_request
+        self.server = FakeServer().start()
+        api = self.server.api()
+        self.http = []
+        def fallback(method, url, **kwargs):
+            self.http.append(method)
+            return api_request(method, url, **kwargs)
+        self.transport = WebSocketTransport(api.websocket, fallback=fallback).start()
+        self.api = self.server.api(request=self.transport)
+        self.flow = api.flow.create({ 'path': '/acc/ws' })
+
+    def tearDown(self):
+        self.transport.close()
+        self.server.stop()
+
+    def test_crud(self):
+        drops = self.api.drop(self.flow['id'])
+        drop = drops.create({ 'elems': { 'n': 1 } })
+        self.assertEqual(drops.read(drop['id'])['elems'], { 'n': 1 })
+        drops.update(M(drop).modify('elems.n', 2))
+        self.assertEqual(drops.find_many(limit=1)[0]['elems'], { 'n': 2 })
+        self.assertEqual(self.api.flow.read(self.flow['id'])['path'], '/acc/ws')
+        drops.delete(drop['id'])
+        self.assertRaises(FlowThingsNotFound, drops.read, drop['id'])
+        self.assertEqual(self.http, [])
+
+        drops.read_many([drop['id']])
+        drops.aggregate('$count')
+        self.assertEqual(self.http, ['MGET', 'POST'])
+
+    def test_stream(self):
+        drops = self.api.drop(self.flow['id'])
+        ids = [drops.create({ 'elems': { 'n': i } })['id'] for i in range(3)]
+        self.assertEqual(sorted(d['id'] for d in drops.find_iter()), sorted(ids))
+        self.assertEqual(self.http, [])
+
+    def test_pipelined(self):
+        import threading
+        drops = self.api.drop(self.flow['id'])
+        created = []
+        threads = [threading.Thread(target=lambda i=i: created.append(
+                       drops.create({ 'elems': { 'n': i } })['elems']['n']))
+                   for i in range(20)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(sorted(created), list(range(20)))
+        self.assertEqual(self.http, [])
+
+    def test_fallback(self):
+        other = self.server.api(Token('acc', 'other'), request=self.transport)
+        other.flow.read(self.flow['id'])
+        self.transport.close()
+        self.assertFalse(self.transport.connected)
+        self.api.flow.read(self.flow['id'])
+        self.assertEqual(self.http, ['GET', 'GET'])
+
+    def test_messages(self):
+        msg = self.transport.message
+        self.assertEqual(msg('GET', 'http://h/v4.0/acc/drop/f1/d1', None, None),
+                         { 'object': 'drop', 'flowId': 'f1', 'id': 'd1', 'type': 'find' })
+        self.assertEqual(msg('POST', 'http://h/v4.0/acc/flow', None, '{"path": "/a"}'),
+                         { 'object': 'flow', 'type': 'create', 'value': { 'path': '/a' } })
+        self.assertEqual(msg('MGET', 'http://h/v4.0/acc/flow', None, '[]'), None)
+        self.assertEqual(msg('POST', 'http://h/v4.0/acc/drop/f1/aggregate', None, '{}'), None)
+        self.assertEqual(msg('GET', 'http://h/v4.0/acc/group/g1', None, None), None)
+        self.assertEqual(msg('POST', 'http://h/v4.0/acc/drop', None, '{}'), None)
+
+
+class CredentialsViewTestCase(TestCase):
+
+    def test_with_creds(self):
+        api = TestAPI()
+        other = Token('other', 'tok2')
+        view = api.with_creds(other)
+        res = view.flow.read('f')
+        self.assertEqual(res['creds'], other)
+        self.assertTrue('/other/flow/f' in res['url'])
+        res = view.drop('f').create({})
+        self.assertEqual(res['creds'], other)
+        self.assertTrue('/other/drop/f' in res['url'])
+        self.assertEqual(view.creds, other)
+
+        # The parent is untouched, and shares its services' options.
+        self.assertEqual(api.flow.read('f')['creds'], CREDS)
+        self.assertEqual(api.drop('f').create({})['creds'], CREDS)
+        self.assertTrue(view.flow._request is api.flow._request)
+        self.assertTrue(view.flow._params is api.flow._params)
+        self.assertFalse(view.drop('f') is api.drop('f'))
+
+    def test_views_are_reused(self):
+        api = TestAPI()
+        api.view_cache_size = 2
+        a, b, c = Token('a', 'x'), Token('b', 'x'), Token('c', 'x')
+        view = api.with_creds(a)
+        self.assertTrue(api.with_creds(a) is view)
+        self.assertTrue(view.with_creds(b) is api.with_creds(b))
+        api.with_creds(c)
+        self.assertFalse(api.with_creds(a) is view)
+        self.assertRaises(AttributeError, setattr, view, 'creds', b)
+
+    def test_async(self):
+        view = TestAPI().with_creds(Token('a', 'x'))
+        proxy = view.async()
+        proxy.flow.read('f')
+        self.assertEqual(proxy.results()[0]['async']['creds'], Token('a', 'x'))
+        self.assertEqual(view.lazy().flow.read('f')['async']['creds'], Token('a', 'x'))
+
+    def test_concurrent_tenants(self):
+        import threading
+        api = TestAPI()
+        errors = []
+        def work(n):
+            creds = Token('acc%d' % n, 'tok')
+            for i in range(50):
+                res = api.with_creds(creds).drop('f%d' % i).read('d')
+                if res['creds'] != creds or '/acc%d/drop/f%d/d' % (n, i) not in res['url']:
+                    errors.append(res)
+        threads = [threading.Thread(target=work, args=(n,)) for n in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+
+
+def flow_path(api, flow_id):
+    import os
+    return api.flow.read(flow_id)['path'], os.getpid()
+
+
+class ForkTestCase(TestCase):
+
+    def in_child(self, check):
+        """ Runs `check` in a forked child, returning whether it passed. """
+        import os
+        if not hasattr(os, 'fork'):
+            self.skipTest('fork is not available')
+        pid = os.fork()
+        if pid == 0:
+            try:
+                ok = check()
+            except Exception:
+                ok = False
+            os._exit(0 if ok else 1)
+        return os.waitpid(pid, 0)[1] == 0
+
+    def test_resets_in_child(self):
+        from flowthings import utils
+        from flowthings.cache import AggregateCache
+        utils.session()
+        conditional = ConditionalCache()
+        conditional.store('k', 'body', { 'etag': '"x"' })
+        aggregates = AggregateCache()
+        aggregates.set('acc', '/drop/f', 'k', [])
+        api = TestAPI()
+        api.flow.loader._lock.acquire()
+
+        def check():
+            utils.check_fork()
+            return (utils._session is None and
+                    conditional.get('k') is None and
+                    aggregates.get('acc', '/drop/f', 'k') is None and
+                    api.flow.loader._lock.acquire(False))
+
+        try:
+            self.assertTrue(self.in_child(check))
+        finally:
+            api.flow.loader._lock.release()
+        self.assertTrue(utils._session is not None)
+        self.assertEqual(conditional.get('k')[0], 'body')
+
+    def test_drop_queue_in_child(self):
+        import shutil
+        import tempfile
+        from flowthings.offline import DropQueue, DropWriter
+        directory = tempfile.mkdtemp()
+        try:
+            queue = DropQueue(directory, segment_size=4096)
+            queue.append({ 'id': 'a', 'flow': 'f', 'drop': {} })
+            writer = DropWriter(TestAPI(), queue)
+
+            def check():
+                from flowthings import utils
+                utils.check_fork()
+                for use in (lambda: queue.append({ 'id': 'b', 'flow': 'f', 'drop': {} }),
+                            lambda: list(queue.pending()), lambda: len(queue),
+                            lambda: writer.create('f', {}), writer.replay):
+                    try:
+                        use()
+                    except FlowThingsError:
+                        continue
+                    return False
+                queue.close()
+                return True
+
+            self.assertTrue(self.in_child(check))
+            self.assertEqual([record['id'] for _, record in queue.pending()], ['a'])
+            queue.append({ 'id': 'c', 'flow': 'f', 'drop': {} })
+            self.assertEqual(len(queue), 2)
+            queue.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_parallel_map(self):
+        import os
+        from flowthings.testing import FakeServer
+        with FakeServer() as server:
+            api = server.api()
+            ids = [api.flow.create({ 'path': '/acc/%d' % i })['id'] for i in range(6)]
+            results = api.parallel_map(flow_path, ids, processes=2)
+        self.assertEqual([path for path, _ in results], ['/acc/%d' % i for i in range(6)])
+        pids = set(pid for _, pid in results)
+        self.assertTrue(os.getpid() not in pids)
+
+    def test_parallel_map_spawn_default(self):
+        import multiprocessing
+        from flowthings.testing import FakeServer
+        if not hasattr(multiprocessing, 'get_context'):
+            self.skipTest('start methods are not available')
+        # Eg. macOS and Windows, where the API couldn't be pickled.
+        pool = multiprocessing.Pool
+        multiprocessing.Pool = multiprocessing.get_context('spawn').Pool
+        try:
+            with FakeServer() as server:
+                api = server.api()
+                flow = api.flow.create({ 'path': '/acc/spawn' })
+                results = api.parallel_map(flow_path, [flow['id']], processes=1)
+        finally:
+            multiprocessing.Pool = pool
+        self.assertEqual(results[0][0], '/acc/spawn')
+
+    def test_loader_lock_in_child(self):
+        from flowthings import services, utils
+        services._loader_lock.acquire()
+
+        def check():
+            utils.check_fork()
+            return TestAPI().flow.loader is not None
+
+        try:
+            self.assertTrue(self.in_child(check))
+        finally:
+            services._loader_lock.release()
+
+
+class EndpointsTestCase(TestCase):
+
+    def setUp(self):
+        import socket
+        from flowthings.testing import FakeServer, FakePlatform
+        platform = FakePlatform()
+        self.slow = FakeServer(platform, latency=0.02).start()
+        self.fast = FakeServer(platform).start()
+        # A port nothing listens on.
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        self.dead = '127.0.0.1:%d' % sock.getsockname()[1]
+        sock.close()
+
+    def tearDown(self):
+        self.slow.stop()
+        self.fast.stop()
+
+    def endpoints(self, hosts, **kwargs):
+        from flowthings.endpoints import Endpoints
+        return Endpoints(hosts, secure=False, **kwargs)
+
+    def test_failover(self):
+        endpoints = self.endpoints([self.dead, self.fast.host])
+        api = self.fast.api(endpoints=endpoints)
+        flow = api.flow.create({ 'path': '/acc/x' })
+        self.assertEqual(api.flow.read(flow['id'])['path'], '/acc/x')
+        self.assertEqual(dict(api.flow.stream_request('GET', '/' + flow['id']))['path'], '/acc/x')
+        self.assertEqual(endpoints.ranked(), [self.fast.host, self.dead])
+        stats = endpoints.snapshot()
+        self.assertEqual((stats[self.dead]['healthy'], stats[self.dead]['failures']), (False, 1))
+        self.assertTrue(stats[self.fast.host]['healthy'])
+        self.assertEqual(len(self.fast.log), 3)
+
+        endpoints = self.endpoints([self.dead])
+        api = self.fast.api(endpoints=endpoints)
+        self.assertRaises(IOError, api.flow.read, flow['id'])
+
+    def test_fastest_host(self):
+        endpoints = self.endpoints([self.slow.host, self.fast.host])
+        api = self.slow.api(endpoints=endpoints)
+        flow = api.flow.create({ 'path': '/acc/x' })
+        for i in range(10):
+            api.flow.read(flow['id'])
+        self.assertEqual(endpoints.best(), self.fast.host)
+        self.assertEqual(len(self.slow.log), 1)
+        self.assertEqual(len(self.fast.log), 10)
+
+    def test_retry_after(self):
+        now = [0]
+        endpoints = self.endpoints(['a', 'b'], retry_after=5, clock=lambda: now[0])
+        endpoints.record('a', 0.2)
+        endpoints.record('b', 0.1)
+        endpoints.fail('b')
+        self.assertEqual(endpoints.ranked(), ['a', 'b'])
+        now[0] = 5
+        self.assertEqual(endpoints.ranked(), ['b', 'a'])
+        self.assertRaises(ValueError, endpoints.record, 'c', 0.1)
+
+    def test_health_check(self):
+        endpoints = self.endpoints([self.dead, self.fast.host])
+        endpoints.check()
+        self.assertEqual(endpoints.ranked(), [self.fast.host, self.dead])
+        stats = endpoints.snapshot()[self.fast.host]
+        # Probes are kept apart from the latency of requests.
+        self.assertTrue(stats['probe_latency'] is not None)
+        self.assertTrue(stats['latency'] is None)
+        endpoints.start(interval=0.01)
+        endpoints.stop()
+
+        endpoints = self.endpoints(['a', 'b'], probe=lambda host: None)
+        endpoints.record('a', 0.2)
+        endpoints.record('b', 0.1, probe=True)
+        endpoints.record('b', 0.3)
+        self.assertEqual(endpoints.ranked(), ['a', 'b'])
+
+    def test_unsafe_failover(self):
+        import requests
+        calls = []
+        def fail(error):
+            def send(host):
+                calls.append(host)
+                if host == 'a':
+                    raise error
+                return host
+            return send
+        reset = requests.ConnectionError('Connection reset by peer')
+
+        # A dropped connection may have reached the host, so only
+        # idempotent requests are sent again.
+        endpoints = self.endpoints(['a', 'b'])
+        self.assertRaises(requests.ConnectionError, endpoints.call, fail(reset), method='POST')
+        self.assertEqual((calls, endpoints.ranked()), (['a'], ['b', 'a']))
+        endpoints = self.endpoints(['a', 'b'])
+        self.assertEqual(endpoints.call(fail(reset), method='GET'), 'b')
+
+        # Failed connections can be retried whatever the method.
+        for error in (requests.ConnectTimeout('timed out'),):
+            endpoints = self.endpoints(['a', 'b'])
+            self.assertEqual(endpoints.call(fail(error), method='DELETE'), 'b')
+        endpoints = self.endpoints([self.dead, self.fast.host])
+        api = self.fast.api(endpoints=endpoints)
+        api.flow.create({ 'path': '/acc/x' })
+        self.assertEqual(len(self.fast.log), 1)
+
+        # Read timeouts never fail over.
+        endpoints = self.endpoints(['a', 'b'])
+        self.assertRaises(requests.ReadTimeout, endpoints.call,
+                          fail(requests.ReadTimeout('slow')), method='GET')
+
+    def test_httpx_errors(self):
+        try:
+            import httpx
+        except ImportError:
+            self.skipTest('httpx is not installed')
+        endpoints = self.endpoints(['a', 'b'])
+        def send(host):
+            if host == 'a':
+                raise httpx.ConnectError('refused')
+            return host
+        self.assertEqual(endpoints.call(send, method='POST'), 'b')
+
+    def test_websocket(self):
+        endpoints = self.endpoints([self.dead, self.fast.host])
+        api = self.fast.api(ws_host=self.dead, ws_endpoints=endpoints)
+        client = api.websocket.connect()
+        self.assertTrue(client._app.url.startswith('ws://%s/session/' % self.fast.host))
+        self.assertEqual(self.fast.log[-1][0], 'POST')
+
+
 class BluemixTestCase(TestCase):
 
     def test_load_env(self):